@@ -1,12 +1,37 @@
 from enum import Enum 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from typing import List, Tuple, Optional, Any, Callable
+from typing import List, Dict, Tuple, Optional, Any, Callable
 
 class ServerStatus(str, Enum):
     ALIVE:str='ALIVE'
     READY:str='READY'
 
+class EmbeddingPrecision(str, Enum):
+    FLOAT32:str='float32'
+    FLOAT16:str='float16'
+
+class TextrankWeighting(str, Enum):
+    DEGREE:str='degree'  # mean similarity of each sentence to the others 
+    PAGERANK:str='pagerank'
+
+class RequestPriority(str, Enum):
+    INTERACTIVE:str='interactive'  # served first 
+    BULK:str='bulk'  # indexing traffic 
+
+class JobStatus(str, Enum):
+    PENDING:str='pending'
+    RUNNING:str='running'
+    DONE:str='done'
+    FAILED:str='failed'
+    CANCELLED:str='cancelled'
+
+class EmbeddingFormat(str, Enum):
+    JSON:str='application/json'
+    BASE64:str='application/vnd.embedding.base64+json'
+    MSGPACK:str='application/x-msgpack'
+    BINARY:str='application/octet-stream'
+
 class GenericResponseModel(BaseModel):
     status:bool 
     content:Any 
@@ -15,18 +40,116 @@ class GenericResponseModel(BaseModel):
 class EntrypointResponseContentModel(BaseModel):
     status:ServerStatus=ServerStatus.ALIVE 
     message:str
+    admission:Optional[Dict[str, Any]]=None  # queue depth, wait times and rejections 
+    models:Optional[Dict[str, Any]]=None  # ready vectorizers of each model 
 
 class EntrypointResponseModel(GenericResponseModel):
     content:Optional[EntrypointResponseContentModel]=None 
 
 
-class ComputeEmbeddingRequestModel(BaseModel):
+class SentenceDetailsRequestModel(BaseModel):
+    # sentence level outputs computed from the same encode pass as the document embedding 
+    top_k:int=Field(default=0, ge=0)  # number of sentences of the extractive summary, ranked by semantic textrank 
+    return_sentences:bool=False  # every sentence with its index and score 
+    return_sentence_embeddings:bool=False  # every sentence with its embedding (implies return_sentences) 
+
+class ComputeEmbeddingRequestModel(SentenceDetailsRequestModel):
     request_id:str 
     text:str 
+    timeout_ms:Optional[int]=None 
+    precision:EmbeddingPrecision=EmbeddingPrecision.FLOAT32
+    weighting:TextrankWeighting=TextrankWeighting.DEGREE
+    priority:RequestPriority=RequestPriority.INTERACTIVE
+    model:Optional[str]=None  # name of the model in the registry, None : the default model 
+
+class SentenceModel(BaseModel):
+    index:int  # position of the sentence in the document 
+    text:str 
+    score:float  # semantic textrank score, degree centrality for the documents embedded in streaming mode 
+    embedding:Optional[List[float]]=None 
+    encoded_embedding:Optional[str]=None 
 
 class ComputeEmbeddingResponseContentModel(BaseModel):
     embedding:List[float]=[]
+    encoded_embedding:Optional[str]=None  # base64 of the raw buffer (Accept: application/vnd.embedding.base64+json)
+    dtype:Optional[str]=None 
+    summary:Optional[List[SentenceModel]]=None  # top_k sentences, best first 
+    sentences:Optional[List[SentenceModel]]=None  # every sentence in document order 
 
 class ComputeEmbeddingResponseModel(GenericResponseModel):
     request_id:str 
-    content:Optional[ComputeEmbeddingResponseContentModel]=None
\ No newline at end of file
+    content:Optional[ComputeEmbeddingResponseContentModel]=None
+
+class ComputeEmbeddingItemModel(BaseModel):
+    request_id:str 
+    text:str 
+
+class ComputeEmbeddingsRequestModel(SentenceDetailsRequestModel):
+    items:List[ComputeEmbeddingItemModel]
+    timeout_ms:Optional[int]=None 
+    precision:EmbeddingPrecision=EmbeddingPrecision.FLOAT32
+    weighting:TextrankWeighting=TextrankWeighting.DEGREE
+    priority:RequestPriority=RequestPriority.INTERACTIVE
+    model:Optional[str]=None  # name of the model in the registry, None : the default model 
+
+class ComputeEmbeddingsResponseModel(GenericResponseModel):
+    content:List[ComputeEmbeddingResponseModel]=[]
+
+class JobRequestModel(BaseModel):
+    items:List[ComputeEmbeddingItemModel]
+    precision:EmbeddingPrecision=EmbeddingPrecision.FLOAT32
+    weighting:TextrankWeighting=TextrankWeighting.DEGREE
+    model:Optional[str]=None 
+
+class JobContentModel(BaseModel):
+    job_id:str 
+    status:JobStatus 
+    model:str 
+    nb_items:int 
+    nb_completed:int=0  # failed items included 
+    nb_failed:int=0 
+    created_at:float 
+    finished_at:Optional[float]=None 
+    expires_at:Optional[float]=None  # the results are evicted after this time 
+    results:Optional[List[ComputeEmbeddingResponseModel]]=None  # completed items, in the order of the request 
+
+class JobResponseModel(GenericResponseModel):
+    content:Optional[JobContentModel]=None
+
+class IndexAddRequestModel(BaseModel):
+    items:List[ComputeEmbeddingItemModel]  # request_id is the id of the vector in the index 
+    timeout_ms:Optional[int]=None 
+    weighting:TextrankWeighting=TextrankWeighting.DEGREE
+    priority:RequestPriority=RequestPriority.BULK
+    model:Optional[str]=None 
+
+class IndexQueryRequestModel(BaseModel):
+    text:Optional[str]=None  # embedded by the vectorizers of the model 
+    embedding:Optional[List[float]]=None  # or a vector computed beforehand 
+    top_k:int=Field(default=10, ge=1)
+    nprobe:Optional[int]=Field(default=None, ge=1)  # clusters scanned in ivf mode, None : the --index_nprobe option 
+    timeout_ms:Optional[int]=None 
+    weighting:TextrankWeighting=TextrankWeighting.DEGREE
+    priority:RequestPriority=RequestPriority.INTERACTIVE
+    model:Optional[str]=None 
+
+class IndexSnapshotRequestModel(BaseModel):
+    name:str  # letters, digits, - and _ 
+    model:Optional[str]=None 
+
+class IndexMatchModel(BaseModel):
+    id:str 
+    score:float  # cosine similarity 
+
+class IndexContentModel(BaseModel):
+    model:str 
+    size:int  # number of indexed vectors 
+    dimension:Optional[int]=None 
+    mode:str  # exact or ivf 
+    nb_added:Optional[int]=None 
+    nb_updated:Optional[int]=None 
+    failed:Optional[List[str]]=None  # ids whose text could not be embedded 
+    matches:Optional[List[IndexMatchModel]]=None  # best first 
+
+class IndexResponseModel(GenericResponseModel):
+    content:Optional[IndexContentModel]=None
@@ -0,0 +1,92 @@
+import click
+import httpx
+
+import asyncio as aio
+
+from time import perf_counter
+from collections import Counter
+from typing import List, Dict, Any
+
+from libraries.log import logger
+from libraries.corpus import make_synthetic_documents
+
+from benchmarks.report import write_report, summarize_latencies
+
+# closed loop load generator : `concurrency` clients send requests back to back
+# python -m benchmarks.load --url http://localhost:8000 --concurrency 16 --duration 30 --nb_sentences 20 --output load.json
+# start the service with --encoder_backend mock --sentence_splitter regex to measure the zeromq / fastapi overhead without any model
+
+async def run_client(client:httpx.AsyncClient, url:str, documents:List[str], client_index:int, stop_time:float, payload_options:Dict[str, Any], latencies:List[float], status_codes:Counter):
+    request_index = 0
+    while perf_counter() < stop_time:
+        document = documents[(client_index + request_index) % len(documents)]
+        payload = dict(payload_options, request_id=f'{client_index}-{request_index}', text=document)
+        start = perf_counter()
+        try:
+            response = await client.post(url, json=payload)
+            status_codes[str(response.status_code)] += 1
+            if response.status_code == 200:
+                latencies.append(perf_counter() - start)
+        except httpx.HTTPError as e:
+            status_codes[type(e).__name__] += 1
+        request_index += 1
+
+async def run_load(url:str, concurrency:int, duration:float, warmup:float, documents:List[str], payload_options:Dict[str, Any]) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        if warmup > 0:
+            await aio.gather(*[ run_client(client, url, documents, idx, perf_counter() + warmup, payload_options, [], Counter()) for idx in range(concurrency) ])
+
+        latencies = []
+        status_codes = Counter()
+        start = perf_counter()
+        await aio.gather(*[ run_client(client, url, documents, idx, start + duration, payload_options, latencies, status_codes) for idx in range(concurrency) ])
+        elapsed = perf_counter() - start
+
+    return {
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 3),
+        'requests': sum(status_codes.values()),
+        'successes': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 3),
+        'status_codes': dict(status_codes),
+        **summarize_latencies(latencies)
+    }
+
+@click.command()
+@click.option('--url', type=str, default='http://localhost:8000')
+@click.option('--concurrency', help='comma separated levels of concurrency, one run per level', type=str, default='1,8,32')
+@click.option('--duration', help='duration (s) of each run', type=click.FloatRange(min=0.1), default=20)
+@click.option('--warmup', help='duration (s) of the warmup before each run', type=click.FloatRange(min=0), default=2)
+@click.option('--nb_sentences', help='number of sentences per synthetic document', type=click.IntRange(min=1), default=20)
+@click.option('--nb_documents', help='number of distinct documents, small values exercise the embedding cache', type=click.IntRange(min=1), default=256)
+@click.option('--weighting', type=click.Choice(['degree', 'pagerank']), default='degree')
+@click.option('--priority', type=click.Choice(['interactive', 'bulk']), default='interactive')
+@click.option('--seed', type=int, default=0)
+@click.option('--output', help='path of the json report', type=click.Path(dir_okay=False), default=None)
+def benchmark_load(url:str, concurrency:str, duration:float, warmup:float, nb_sentences:int, nb_documents:int, weighting:str, priority:str, seed:int, output:str):
+    documents = make_synthetic_documents(nb_sentences, nb_documents, seed=seed)
+    payload_options = {'weighting': weighting, 'priority': priority}
+    endpoint = url.rstrip('/') + '/compute_embedding'
+
+    results = []
+    for level in map(int, concurrency.split(',')):
+        result = aio.run(run_load(endpoint, level, duration, warmup, documents, payload_options))
+        results.append(result)
+        logger.info(f"concurrency {level:4d} | {result['throughput_rps']:9.1f} req/s | p50 {result.get('p50_ms', 0):8.1f}ms | p95 {result.get('p95_ms', 0):8.1f}ms | p99 {result.get('p99_ms', 0):8.1f}ms | {result['status_codes']}")
+
+    parameters = {
+        'url': url,
+        'concurrency': concurrency,
+        'duration': duration,
+        'warmup': warmup,
+        'nb_sentences': nb_sentences,
+        'nb_documents': nb_documents,
+        'weighting': weighting,
+        'priority': priority,
+        'seed': seed
+    }
+    write_report(output, 'load', parameters, results)
+
+if __name__ == '__main__':
+    benchmark_load()
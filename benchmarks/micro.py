@@ -0,0 +1,78 @@
+import click
+
+import torch as th
+
+from time import perf_counter
+from typing import List, Dict, Any, Callable
+
+from libraries.log import logger
+from libraries.corpus import make_synthetic_documents
+from libraries.encoders import load_encoder, ENCODER_BACKENDS
+from libraries.strategies import (
+    load_language_model, to_sentences, compute_pairwise_matrix, semantic_textrank, EncodeScheduler
+)
+
+from benchmarks.report import write_report, summarize_latencies
+
+# python -m benchmarks.micro --encoder_backend mock --sizes 8,32,128,512 --output micro.json
+
+def measure(function:Callable[[], Any], repeat:int) -> List[float]:
+    function()  # warmup
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        durations.append(perf_counter() - start)
+    return durations
+
+@click.command()
+@click.option('--transformers_cache', envvar='TRANSFORMERS_CACHE', default='cache')
+@click.option('--transformer_model_name', type=str, default='Sahajtomar/french_semantic')
+@click.option('--language_model_name', type=str, default='fr_core_news_md')
+@click.option('--encoder_backend', type=click.Choice(ENCODER_BACKENDS), default='mock')
+@click.option('--sizes', help='comma separated numbers of sentences per document', type=str, default='8,32,128,512')
+@click.option('--repeat', help='number of measures per stage and size', type=click.IntRange(min=1), default=10)
+@click.option('--token_budget', type=click.IntRange(min=1), default=8192)
+@click.option('--num_threads', type=click.IntRange(min=1), default=None)
+@click.option('--seed', type=int, default=0)
+@click.option('--output', help='path of the json report', type=click.Path(dir_okay=False), default=None)
+def benchmark_stages(transformers_cache:str, transformer_model_name:str, language_model_name:str, encoder_backend:str, sizes:str, repeat:int, token_budget:int, num_threads:int, seed:int, output:str):
+    if num_threads is not None:
+        th.set_num_threads(num_threads)
+    spacy_model = load_language_model(language_model_name)
+    encoder = load_encoder(encoder_backend, transformer_model_name, transformers_cache, th.device('cpu'), num_threads=num_threads)
+    encode_scheduler = EncodeScheduler(encoder, token_budget=token_budget)
+
+    results = []
+    for nb_sentences in map(int, sizes.split(',')):
+        document = make_synthetic_documents(nb_sentences, nb_documents=1, seed=seed)[0]
+        sentences = to_sentences(document, spacy_model, valid_length=1)
+        embeddings = encode_scheduler.encode(sentences)
+        adjacency_matrix = compute_pairwise_matrix(embeddings)
+
+        stages:Dict[str, Callable[[], Any]] = {
+            'to_sentences': lambda: to_sentences(document, spacy_model, valid_length=1),
+            'encode': lambda: encode_scheduler.encode(sentences),
+            'compute_pairwise_matrix': lambda: compute_pairwise_matrix(embeddings),
+            'semantic_textrank': lambda: semantic_textrank(adjacency_matrix)
+        }
+        for stage, function in stages.items():
+            latencies = summarize_latencies(measure(function, repeat))
+            result = {'stage': stage, 'nb_sentences': len(sentences), 'nb_characters': len(document), **latencies}
+            results.append(result)
+            logger.info(f"{stage:<24} {len(sentences):5d} sentences | p50 {latencies['p50_ms']:9.3f}ms | p95 {latencies['p95_ms']:9.3f}ms")
+
+    parameters = {
+        'transformer_model_name': transformer_model_name,
+        'language_model_name': language_model_name,
+        'encoder_backend': encoder_backend,
+        'sizes': sizes,
+        'repeat': repeat,
+        'token_budget': token_budget,
+        'num_threads': th.get_num_threads(),
+        'seed': seed
+    }
+    write_report(output, 'micro', parameters, results)
+
+if __name__ == '__main__':
+    benchmark_stages()
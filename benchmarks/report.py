@@ -0,0 +1,45 @@
+import sys
+import json
+import platform
+import subprocess
+
+import numpy as np
+
+from os import path
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def summarize_latencies(latencies:List[float]) -> Dict[str, float]:
+    # latencies in seconds => percentiles in milliseconds
+    if len(latencies) == 0:
+        return {}
+    values = np.array(latencies) * 1000
+    return {
+        'mean_ms': round(float(np.mean(values)), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(np.max(values)), 3)
+    }
+
+def write_report(output:Optional[str], benchmark:str, parameters:Dict[str, Any], results:List[Dict[str, Any]]):
+    # one json file per run : the commit and the parameters make runs comparable across commits
+    if output is None:
+        return
+    report = {
+        'benchmark': benchmark,
+        'commit': get_git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results
+    }
+    with open(output, 'w') as fp:
+        json.dump(report, fp, indent=2)
@@ -0,0 +1,72 @@
+import click
+
+from time import perf_counter
+from collections import Counter
+from typing import List, Dict
+
+from libraries.log import logger
+from libraries.corpus import french_paragraphs
+from libraries.splitters import SentenceSplitter, SENTENCE_SPLITTERS
+
+from benchmarks.report import write_report
+
+# python -m benchmarks.sentence_splitters --language_model_name fr_core_news_md --repeat 50
+
+def compare_splits(predicted:List[List[str]], reference:List[List[str]]) -> Dict[str, float]:
+    nb_matches = nb_predicted = nb_reference = 0
+    for predicted_sentences, reference_sentences in zip(predicted, reference):
+        matches = Counter(predicted_sentences) & Counter(reference_sentences)
+        nb_matches += sum(matches.values())
+        nb_predicted += len(predicted_sentences)
+        nb_reference += len(reference_sentences)
+    precision = nb_matches / max(nb_predicted, 1)
+    recall = nb_matches / max(nb_reference, 1)
+    f1_score = 2 * precision * recall / max(precision + recall, 1e-8)
+    return {'precision': precision, 'recall': recall, 'f1': f1_score}
+
+@click.command()
+@click.option('--language_model_name', type=str, default='fr_core_news_md')
+@click.option('--splitters', help='comma separated list of backends', type=str, default=','.join(SENTENCE_SPLITTERS))
+@click.option('--repeat', help='number of copies of the sample corpus', type=click.IntRange(min=1), default=20)
+@click.option('--n_process', type=click.IntRange(min=1), default=1)
+@click.option('--batch_size', type=click.IntRange(min=1), default=32)
+@click.option('--output', help='path of the json report', type=click.Path(dir_okay=False), default=None)
+def benchmark_splitters(language_model_name:str, splitters:str, repeat:int, n_process:int, batch_size:int, output:str):
+    texts = french_paragraphs * repeat
+    nb_characters = sum(map(len, texts))
+
+    # boundaries of the full spacy pipeline are the reference
+    reference_splitter = SentenceSplitter('full', language_model_name)
+    reference = reference_splitter.split_many(french_paragraphs)
+
+    report = []
+    for backend in splitters.split(','):
+        splitter = SentenceSplitter(backend, language_model_name, n_process=n_process, batch_size=batch_size)
+        splitter.split_many(french_paragraphs)  # warmup
+
+        start = perf_counter()
+        sentences_per_text = splitter.split_many(texts)
+        duration = perf_counter() - start
+
+        quality = compare_splits(sentences_per_text[:len(french_paragraphs)], reference)
+        result = {
+            'splitter': backend,
+            'documents_per_second': len(texts) / duration,
+            'characters_per_second': nb_characters / duration,
+            'sentences': sum(map(len, sentences_per_text)),
+            **quality
+        }
+        report.append(result)
+        logger.info(f"{backend:<12} {result['documents_per_second']:10.1f} docs/s | f1 {quality['f1']:.3f} | precision {quality['precision']:.3f} | recall {quality['recall']:.3f}")
+
+    parameters = {
+        'language_model_name': language_model_name,
+        'splitters': splitters,
+        'repeat': repeat,
+        'n_process': n_process,
+        'batch_size': batch_size
+    }
+    write_report(output, 'sentence_splitters', parameters, report)
+
+if __name__ == '__main__':
+    benchmark_splitters()
@@ -0,0 +1,188 @@
+import zmq
+import json
+import errno
+
+import multiprocessing as mp
+
+from time import sleep, perf_counter
+from typing import Dict, List, Any
+
+from libraries.log import logger
+
+class ZMQBroker:
+    status_interval = 1.0  # s, PUB drops the messages sent before a subscriber joins : the status is published periodically
+
+    def __init__(self, workers_barrier:mp.Barrier, router_address:str, backend_address:str, publisher_address:str):
+        self.workers_barrier = workers_barrier
+        self.router_address = router_address
+        self.backend_address = backend_address
+        self.publisher_address = publisher_address
+
+        self.map_worker2credits:Dict[bytes, int] = {}
+        self.map_worker2requests:Dict[bytes, Dict[bytes, bytes]] = {}  # correlation_id => client_address of the requests held by each worker
+        self.nb_registered_workers = 0
+        self.last_status = 0.0
+        self.zeromq_initialized = 0
+
+    def pick_worker(self) -> bytes:
+        # least busy worker => the one with the highest number of free slots
+        return max(self.map_worker2credits, key=self.map_worker2credits.get)
+
+    def available_credits(self) -> int:
+        return sum(self.map_worker2credits.values())
+
+    def send_unavailable(self, client_address:bytes, correlation_id:bytes):
+        # same layout as a vectorizer reply : the server releases the request instead of waiting for its deadline
+        header = {'correlation_id': correlation_id.decode(), 'status': 'unavailable', 'items': []}
+        self.frontend_socket.send_multipart([client_address, b'', json.dumps(header).encode()])
+
+    def remove_worker(self, worker_id:bytes, reason:str) -> bool:
+        # the requests still held by the worker will never get a reply
+        self.map_worker2credits.pop(worker_id, None)
+        lost_requests = self.map_worker2requests.pop(worker_id, {})
+        for correlation_id, client_address in lost_requests.items():
+            self.send_unavailable(client_address, correlation_id)
+        logger.warning(f'a worker {reason}, {len(lost_requests)} pending requests were released, {len(self.map_worker2credits)} workers remaining')
+        self.publish_status()
+        return len(self.map_worker2credits) > 0
+
+    def send_to_worker(self, worker_id:bytes, frames:List[Any]) -> bool:
+        # ROUTER_MANDATORY : sending to a worker whose process died (oom, kill, segfault) fails instead of dropping the frames
+        try:
+            self.backend_socket.send_multipart([worker_id] + frames, copy=False)
+            return True
+        except zmq.ZMQError as e:
+            if e.errno != errno.EHOSTUNREACH:
+                raise
+            return False
+
+    def dispatch_request(self, frames:List[zmq.Frame]) -> bool:
+        # a request is [client_address, delimiter, header, text_0, ..., text_k]
+        client_address = frames[0].bytes
+        correlation_id = json.loads(frames[2].bytes)['correlation_id'].encode()
+        while len(self.map_worker2credits) > 0:
+            worker_id = self.pick_worker()
+            if self.send_to_worker(worker_id, frames):
+                self.map_worker2credits[worker_id] -= 1
+                self.map_worker2requests[worker_id][correlation_id] = client_address
+                return True
+            self.remove_worker(worker_id, 'has died without notice')
+        self.send_unavailable(client_address, correlation_id)
+        return False
+
+    def probe_workers(self) -> bool:
+        # a dead worker is found even when no new request is sent to it : its pending requests are released at once
+        for worker_id in list(self.map_worker2credits):
+            if not self.send_to_worker(worker_id, [b'PING']):
+                self.remove_worker(worker_id, 'has died without notice')
+        return len(self.map_worker2credits) > 0 or self.nb_registered_workers == 0
+
+    def publish_status(self):
+        status = {'workers': len(self.map_worker2credits), 'credits': self.available_credits()}
+        self.publisher_socket.send_multipart([b'STATUS', json.dumps(status).encode()])
+        self.last_status = perf_counter()
+
+    def handle_worker_message(self, frames:List[bytes]) -> bool:
+        worker_id, command, *remaining_frames = [frames[0].bytes, frames[1].bytes] + frames[2:]
+        if command == b'READY':
+            credits = int(remaining_frames[0].bytes.decode())
+            self.map_worker2credits[worker_id] = credits
+            self.map_worker2requests[worker_id] = {}
+            self.nb_registered_workers += 1
+            logger.debug(f'broker has registered a new worker with {credits} slots ({len(self.map_worker2credits)} workers)')
+            self.publish_status()
+            return True
+
+        if command == b'REPLY':  # [correlation_id, client_address, delimiter, header, buffers...]
+            correlation_id, *remaining_frames = remaining_frames
+            if worker_id in self.map_worker2credits:
+                self.map_worker2credits[worker_id] += 1
+                self.map_worker2requests[worker_id].pop(correlation_id.bytes, None)
+            self.frontend_socket.send_multipart(remaining_frames, copy=False)
+            return True
+
+        if command == b'DROP':  # expired request : the slot is released without any reply
+            if worker_id in self.map_worker2credits:
+                self.map_worker2credits[worker_id] += 1
+                self.map_worker2requests[worker_id].pop(remaining_frames[0].bytes, None)
+            return True
+
+        if command == b'METRICS':  # snapshot of the worker metrics, the server subscribes to them
+            self.publisher_socket.send_multipart([b'METRICS', remaining_frames[0]], copy=False)
+            return True
+
+        if command == b'EXIT':
+            return self.remove_worker(worker_id, 'has left the pool')
+
+        logger.warning(f'broker get an unknown command from a worker : {command}')
+        return True
+
+    def start_loop(self):
+        if self.zeromq_initialized == 0:
+            return 0
+
+        logger.debug('broker starts the event loop')
+        keep_loop = True
+        while keep_loop:
+            try:
+                poller = zmq.Poller()
+                poller.register(self.backend_socket, zmq.POLLIN)
+                if self.available_credits() > 0:  # backpressure : requests stay in the frontend queue
+                    poller.register(self.frontend_socket, zmq.POLLIN)
+
+                map_socket2status = dict(poller.poll(int(self.status_interval * 1000)))  # wait for the next message, wakes up at least once per status interval
+                if perf_counter() - self.last_status > self.status_interval:
+                    keep_loop = self.probe_workers()
+                    self.publish_status()
+
+                if map_socket2status.get(self.backend_socket) == zmq.POLLIN:
+                    frames = self.backend_socket.recv_multipart(copy=False)  # embeddings are forwarded without copy
+                    keep_loop = self.handle_worker_message(frames) and keep_loop
+
+                if map_socket2status.get(self.frontend_socket) == zmq.POLLIN:
+                    frames = self.frontend_socket.recv_multipart(copy=False)
+                    keep_loop = self.dispatch_request(frames) and keep_loop
+            except KeyboardInterrupt:
+                keep_loop = False
+                logger.warning('broker get the ctl+c signal')
+            except Exception as e:
+                logger.error(e)
+        # end while loop ...!
+
+        logger.debug('broker quits the event loop : no more worker is alive')
+        self.publisher_socket.send(b'EXIT_LOOP', flags=zmq.SNDMORE)
+        self.publisher_socket.send(b'')
+        sleep(0.1)  # wait 100ms
+
+    def __enter__(self):
+        try:
+            self.ctx = zmq.Context()
+            self.frontend_socket:zmq.Socket = self.ctx.socket(zmq.ROUTER)
+            self.frontend_socket.bind(self.router_address)
+
+            self.backend_socket:zmq.Socket = self.ctx.socket(zmq.ROUTER)
+            self.backend_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+            self.backend_socket.bind(self.backend_address)
+
+            self.publisher_socket:zmq.Socket = self.ctx.socket(zmq.PUB)
+            self.publisher_socket.bind(self.publisher_address)
+
+            self.zeromq_initialized = 1
+            logger.success('broker has initialized its zeromq ressources')
+            self.workers_barrier.wait()  # wait the server and the vectorizers ...!
+        except Exception as e:
+            logger.error(e)
+        return self
+
+    def __exit__(self, exc, val, traceback):
+        if self.zeromq_initialized == 1:
+            self.publisher_socket.close(linger=0)
+            self.backend_socket.close(linger=0)
+            self.frontend_socket.close(linger=0)
+            self.ctx.term()
+            logger.success('broker has released all zeromq ressources')
+        logger.debug('broker shutdown...!')
+
+def start_broker(router_address:str, backend_address:str, publisher_address:str, workers_barrier:mp.Barrier):
+    with ZMQBroker(router_address=router_address, backend_address=backend_address, publisher_address=publisher_address, workers_barrier=workers_barrier) as agent:
+        agent.start_loop()
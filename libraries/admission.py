@@ -0,0 +1,136 @@
+import asyncio as aio
+
+import time
+import heapq
+import itertools as it
+
+import numpy as np
+
+from math import ceil
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, AsyncIterator
+
+from libraries.metrics import Histogram
+
+# lower rank is served first
+PRIORITY_RANKS = {'interactive': 0, 'bulk': 1}
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason:str, retry_after:int):
+        super(AdmissionRejected, self).__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after  # seconds
+
+class AdmissionController:
+    # at most max_inflight requests are forwarded to the vectorizers, the others wait in a bounded priority queue
+    # a request is rejected right away when the queue is full, or when it has waited more than max_queue_wait (ms)
+    # a full queue makes room for a higher priority request : the newest waiter of the lowest priority is rejected instead
+    def __init__(self, max_inflight:int, max_queue_depth:int, max_queue_wait:int):
+        self.max_inflight = max_inflight
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait  # ms
+
+        self.inflight = 0
+        self.nb_waiting = 0
+        self.waiters:List[List[Any]] = []  # heap of [rank, sequence, priority, future], cancelled futures are removed lazily
+        self.sequence = it.count()
+
+        self.counters = {'admitted': 0, 'rejected_queue_full': 0, 'rejected_queue_wait': 0, 'rejected_evicted': 0}
+        self.wait_times = deque(maxlen=1024)  # s
+        self.service_times = deque(maxlen=1024)  # s
+        self.wait_histograms = { priority: Histogram() for priority in PRIORITY_RANKS }  # s, exposed on /metrics
+
+    def retry_after(self) -> int:
+        # time needed to drain the queue at the current service rate
+        service_time = np.mean(self.service_times) if len(self.service_times) > 0 else 1.0
+        estimation = (self.nb_waiting + 1) / self.max_inflight * service_time
+        return int(min(max(ceil(estimation), 1), 60))
+
+    async def acquire(self, priority:str, deadline:float):
+        start = time.monotonic()
+        if self.inflight < self.max_inflight and self.nb_waiting == 0:
+            self.inflight += 1
+            self.counters['admitted'] += 1
+            self.wait_times.append(0.0)
+            self.wait_histograms[priority].observe(0.0)
+            return
+
+        if self.nb_waiting >= self.max_queue_depth and not self.evict_waiter(priority):
+            self.counters['rejected_queue_full'] += 1
+            raise AdmissionRejected('the request queue is full', self.retry_after())
+
+        future = aio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, [PRIORITY_RANKS[priority], next(self.sequence), priority, future])
+        self.nb_waiting += 1
+        if len(self.waiters) > 2 * self.max_queue_depth:
+            self.waiters = [ waiter for waiter in self.waiters if not waiter[3].done() ]
+            heapq.heapify(self.waiters)
+
+        timeout = min(self.max_queue_wait / 1000, deadline - start)
+        try:
+            await aio.wait_for(future, timeout=max(timeout, 0))
+        except aio.TimeoutError:
+            self.nb_waiting -= 1
+            self.counters['rejected_queue_wait'] += 1
+            raise AdmissionRejected('the request has waited too long in the queue', self.retry_after())
+        except aio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release(0.0)  # the slot was granted to a client that went away
+            elif not future.done() or future.cancelled():
+                self.nb_waiting -= 1  # an evicted waiter was already taken out of the count by evict_waiter
+            raise
+
+        waited = time.monotonic() - start
+        self.counters['admitted'] += 1
+        self.wait_times.append(waited)
+        self.wait_histograms[priority].observe(waited)
+
+    def evict_waiter(self, priority:str) -> bool:
+        # the queue is full : its newest waiter of a lower priority than the incoming request gets a 429
+        rank = PRIORITY_RANKS[priority]
+        candidates = [ waiter for waiter in self.waiters if waiter[0] > rank and not waiter[3].done() ]
+        if len(candidates) == 0:
+            return False
+        _, _, _, future = max(candidates, key=lambda waiter: (waiter[0], waiter[1]))
+        self.nb_waiting -= 1
+        self.counters['rejected_evicted'] += 1
+        future.set_exception(AdmissionRejected('the request was evicted from the queue by a higher priority request', self.retry_after()))
+        return True
+
+    def release(self, service_time:float):
+        self.service_times.append(service_time)
+        while len(self.waiters) > 0:
+            _, _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.nb_waiting -= 1
+                future.set_result(None)  # the slot goes to the next waiter, inflight does not change
+                return
+        self.inflight -= 1
+
+    @asynccontextmanager
+    async def admit(self, priority:str, deadline:float) -> AsyncIterator[None]:
+        await self.acquire(priority, deadline)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        queue_depths = {priority: 0 for priority in PRIORITY_RANKS}
+        for _, _, priority, future in self.waiters:
+            if not future.done():
+                queue_depths[priority] += 1
+        wait_times = np.array(self.wait_times) * 1000 if len(self.wait_times) > 0 else np.zeros(1)
+        return dict(
+            self.counters,
+            inflight=self.inflight,
+            queue_depth=self.nb_waiting,
+            queue_depths=queue_depths,
+            queue_wait_ms={
+                'mean': round(float(np.mean(wait_times)), 2),
+                'p95': round(float(np.percentile(wait_times, 95)), 2),
+                'max': round(float(np.max(wait_times)), 2)
+            }
+        )
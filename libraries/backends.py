@@ -0,0 +1,6 @@
+# names of the pluggable backends 
+# this module has no heavy dependency : the cli lists the choices without importing torch or spacy 
+
+SENTENCE_SPLITTERS = ['full', 'parser', 'senter', 'sentencizer', 'regex']
+
+ENCODER_BACKENDS = ['torch', 'quantized', 'onnx', 'mock']
@@ -0,0 +1,148 @@
+import json
+import hashlib
+
+import numpy as np
+
+from os import path, makedirs
+from collections import OrderedDict
+
+from typing import Dict, Optional
+
+from libraries.log import logger
+
+class DiskEmbeddingStore:
+    # fixed capacity ring of (key, embedding) rows held in memory-mapped files
+    # the oldest rows are overwritten once the ring is full
+    key_size = 16
+
+    def __init__(self, folder:str, capacity:int):
+        self.folder = folder
+        self.capacity = capacity
+        self.meta_path = path.join(folder, 'meta.json')
+        self.keys_path = path.join(folder, 'keys.u8')
+        self.embeddings_path = path.join(folder, 'embeddings.f32')
+
+        self.dimension = None
+        self.cursor = 0
+        self.evictions = 0
+        self.map_key2row:Dict[bytes, int] = {}
+
+        makedirs(folder, exist_ok=True)
+        if path.isfile(self.meta_path):
+            with open(self.meta_path, 'r') as fp:
+                meta = json.load(fp)
+            if meta['capacity'] == capacity:
+                self.open_files(meta['dimension'], mode='r+')
+                self.cursor = meta['cursor']
+                for row, key in enumerate(self.keys):
+                    if key.any():
+                        self.map_key2row[key.tobytes()] = row
+                logger.debug(f'embedding store {folder} was loaded with {len(self.map_key2row)} entries')
+            else:
+                logger.warning(f'embedding store {folder} has a different capacity, it will be recreated')
+
+    def open_files(self, dimension:int, mode:str):
+        self.dimension = dimension
+        self.keys = np.memmap(self.keys_path, dtype=np.uint8, mode=mode, shape=(self.capacity, self.key_size))
+        self.embeddings = np.memmap(self.embeddings_path, dtype=np.float32, mode=mode, shape=(self.capacity, dimension))
+
+    def get(self, key:bytes) -> Optional[np.ndarray]:
+        row = self.map_key2row.get(key, None)
+        if row is None:
+            return None
+        return np.array(self.embeddings[row])
+
+    def put(self, key:bytes, embedding:np.ndarray):
+        if self.dimension is None:
+            self.open_files(len(embedding), mode='w+')
+        if key in self.map_key2row or len(embedding) != self.dimension:
+            return
+
+        row = self.cursor % self.capacity
+        old_key = self.keys[row].tobytes()
+        if self.map_key2row.get(old_key, None) == row:
+            del self.map_key2row[old_key]
+            self.evictions += 1
+
+        # the embedding is written before its key : a partial write is never indexed after a restart
+        self.embeddings[row] = embedding
+        self.keys[row] = np.frombuffer(key, dtype=np.uint8)
+        self.map_key2row[key] = row
+        self.cursor += 1
+
+    def __len__(self) -> int:
+        return len(self.map_key2row)
+
+    def flush(self):
+        if self.dimension is None:
+            return
+        self.embeddings.flush()
+        self.keys.flush()
+        with open(self.meta_path, 'w') as fp:
+            json.dump({'dimension': self.dimension, 'capacity': self.capacity, 'cursor': self.cursor}, fp)
+
+class EmbeddingCache:
+    # content addressed cache : key = hash(namespace, level, normalized text)
+    # level is either document or sentence, namespace identifies the models
+    def __init__(self, namespace:str, max_bytes:int, disk_folder:Optional[str]=None, disk_capacity:int=1000000):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.nb_bytes = 0
+        self.entries:OrderedDict = OrderedDict()
+
+        self.disk_store = None
+        if disk_folder is not None:
+            namespace_id = hashlib.blake2b(namespace.encode('utf-8'), digest_size=8).hexdigest()
+            self.disk_store = DiskEmbeddingStore(path.join(disk_folder, namespace_id), capacity=disk_capacity)
+
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def make_key(self, level:str, text:str) -> bytes:
+        # the exact text : a normalization that differs from the cleaning of the pipeline would merge texts that are encoded differently
+        content = '\x00'.join([self.namespace, level, text])
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=DiskEmbeddingStore.key_size).digest()
+
+    def get(self, key:bytes) -> Optional[np.ndarray]:
+        embedding = self.entries.get(key, None)
+        if embedding is not None:
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return embedding
+
+        if self.disk_store is not None:
+            embedding = self.disk_store.get(key)
+            if embedding is not None:
+                self.counters['disk_hits'] += 1
+                self.insert(key, embedding)
+                return embedding
+
+        self.counters['misses'] += 1
+        return None
+
+    def put(self, key:bytes, embedding:np.ndarray):
+        embedding = np.array(embedding, dtype=np.float32)  # a copy : slices must not retain their parent batch
+        self.insert(key, embedding)
+        if self.disk_store is not None:
+            self.disk_store.put(key, embedding)
+
+    def insert(self, key:bytes, embedding:np.ndarray):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = embedding
+        self.nb_bytes += embedding.nbytes + len(key)
+        while self.nb_bytes > self.max_bytes and len(self.entries) > 0:
+            old_key, old_embedding = self.entries.popitem(last=False)
+            self.nb_bytes -= old_embedding.nbytes + len(old_key)
+            self.counters['evictions'] += 1
+
+    def stats(self) -> Dict[str, int]:
+        stats = dict(self.counters, entries=len(self.entries), bytes=self.nb_bytes)
+        if self.disk_store is not None:
+            stats['disk_entries'] = len(self.disk_store)
+            stats['disk_evictions'] = self.disk_store.evictions
+        return stats
+
+    def flush(self):
+        if self.disk_store is not None:
+            self.disk_store.flush()
@@ -0,0 +1,38 @@
+# small french corpus used by the benchmarks and the encoder accuracy checks
+# it mixes short and long sentences, abbreviations, numbers, quotes and line breaks
+
+import random 
+
+from typing import List 
+
+french_paragraphs = [
+    "La ville de Lyon a annoncé hier un nouveau plan de mobilité. Les pistes cyclables seront prolongées de 40 km d'ici 2026. Le maire a précisé que les travaux commenceront au printemps.",
+    "M. Dupont est arrivé en retard à la réunion. Il a expliqué que son train avait été annulé. Personne ne lui en a tenu rigueur.",
+    "Le taux d'inflation s'est établi à 2,4 % en mars, contre 3,1 % le mois précédent. Les prix de l'énergie ont reculé de 1,8 %. En revanche, les services continuent d'augmenter.",
+    "« Nous ne pouvons pas attendre plus longtemps », a déclaré la ministre. Elle souhaite une loi avant la fin de l'année. Les syndicats réclament davantage de concertation.",
+    "Le contrat prévoit une période d'essai de trois mois, renouvelable une fois. Le salarié peut y mettre fin sans préavis. L'employeur doit respecter un délai de prévenance de 48 heures.",
+    "Mélangez la farine, le sucre et les œufs dans un saladier. Ajoutez le lait petit à petit pour éviter les grumeaux. Laissez reposer la pâte une heure avant la cuisson.",
+    "Le Dr. Martin recommande de boire au moins 1,5 litre d'eau par jour. Selon lui, la déshydratation est souvent sous-estimée chez les personnes âgées.",
+    "Les résultats du troisième trimestre dépassent les attentes des analystes. Le chiffre d'affaires progresse de 12 %, porté par l'export. La direction relève ses prévisions annuelles.",
+    "Pourquoi le ciel est-il bleu ? La lumière du soleil est diffusée par les molécules de l'air. Les courtes longueurs d'onde sont plus diffusées que les longues !",
+    "Article 3 : le locataire s'engage à entretenir le logement.\nArticle 4 : le bailleur assure les grosses réparations.\nArticle 5 : le dépôt de garantie est restitué dans un délai d'un mois.",
+    "L'équipe de France s'est imposée 3 buts à 1 face à l'Italie. Le sélectionneur a salué l'engagement de ses joueurs. Le prochain match aura lieu samedi à Marseille.",
+    "La société S.A.R.L. Dubois et fils a été fondée en 1952. Elle emploie aujourd'hui 230 personnes, principalement dans la région de Nantes.",
+    "Le réchauffement climatique accélère la fonte des glaciers alpins. Certains pourraient disparaître avant 2050. Les scientifiques appellent à réduire rapidement les émissions.",
+    "Veuillez trouver ci-joint la facture n° 2023-114. Le règlement est attendu sous trente jours. En cas de retard, des pénalités seront appliquées, etc.",
+    "Le roman raconte l'histoire d'une famille sur trois générations. L'auteur alterne les points de vue avec finesse. La critique a salué un récit émouvant et maîtrisé.",
+    "Pour installer l'application, téléchargez le fichier depuis le site officiel. Lancez ensuite l'assistant et suivez les instructions. Un redémarrage peut être nécessaire.",
+    "Le tribunal a rendu sa décision le 12 janvier. La demande du plaignant a été rejetée. Celui-ci dispose d'un mois pour faire appel.",
+    "Les abeilles jouent un rôle essentiel dans la pollinisation. Leur déclin inquiète les agriculteurs. Plusieurs pesticides ont été interdits pour les protéger.",
+    "Le musée du Louvre a accueilli près de 9 millions de visiteurs l'an dernier. La Joconde reste l'œuvre la plus photographiée. Une nouvelle aile ouvrira en 2027.",
+    "Je vous remercie pour votre message. Malheureusement, je ne serai pas disponible lundi. Pourrions-nous décaler la réunion à mardi 10 h ?",
+]
+
+def make_synthetic_document(nb_sentences:int, seed:int=0) -> str:
+    # reproducible french document of nb_sentences sentences drawn from the sample corpus 
+    rng = random.Random(seed)
+    sentences = [ sent for paragraph in french_paragraphs for sent in paragraph.replace('\n', ' ').split('. ') ]
+    return ' '.join( sent.rstrip('.') + '.' for sent in rng.choices(sentences, k=nb_sentences) )
+
+def make_synthetic_documents(nb_sentences:int, nb_documents:int, seed:int=0) -> List[str]:
+    return [ make_synthetic_document(nb_sentences, seed=seed + idx) for idx in range(nb_documents) ]
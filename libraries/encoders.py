@@ -0,0 +1,242 @@
+import json
+import zlib
+import inspect
+import hashlib
+
+import numpy as np
+import torch as th
+
+from os import path, makedirs
+from time import perf_counter, sleep
+from typing import List, Dict, Tuple
+
+from libraries.log import logger
+from libraries.strategies import load_sentence_transformer, normalize_embeddings
+from libraries.backends import ENCODER_BACKENDS
+from libraries.snapshots import find_snapshot
+
+def resolve_model_path(model_name:str, cache_folder:str) -> str:
+    # the snapshot saved by prepare-models loads from disk without any call to the hub 
+    snapshot_path = find_snapshot(cache_folder, 'transformer', model_name)
+    if snapshot_path is not None:
+        logger.debug(f'{model_name} will be loaded from the snapshot {snapshot_path}')
+        return snapshot_path 
+    return model_name 
+
+def pad_input_ids(input_ids:List[List[int]], pad_token_id:int) -> Tuple[np.ndarray, np.ndarray]:
+    longest = max( len(ids) for ids in input_ids )
+    padded_ids = np.full((len(input_ids), longest), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(input_ids), longest), dtype=np.int64)
+    for row, ids in enumerate(input_ids):
+        padded_ids[row, :len(ids)] = ids 
+        attention_mask[row, :len(ids)] = 1
+    return padded_ids, attention_mask
+
+class BaseEncoder:
+    # subclasses set self.tokenizer, self.max_seq_length and self.do_lower_case 
+    # the scheduler tokenizes once : tokenize gives the lengths of the batches, encode_tokenized pads and runs the forward pass 
+    def tokenize(self, sentences:List[str]) -> List[List[int]]:
+        sentences = [ sent.strip() for sent in sentences ]
+        if self.do_lower_case:
+            sentences = [ sent.lower() for sent in sentences ]
+        return self.tokenizer(
+            sentences, 
+            truncation=True, 
+            max_length=self.max_seq_length, 
+            return_attention_mask=False, 
+            return_token_type_ids=False
+        )['input_ids']
+
+    def count_tokens(self, sentences:List[str]) -> np.ndarray:
+        return np.array([ len(ids) for ids in self.tokenize(sentences) ], dtype=np.int64)
+
+class TorchEncoder(BaseEncoder):
+    def __init__(self, model_name:str, cache_folder:str, device:th.device):
+        self.device = device
+        self.sentence_model = load_sentence_transformer(resolve_model_path(model_name, cache_folder), cache_folder, device=device)
+        self.sentence_model.eval()
+        self.tokenizer = self.sentence_model.tokenizer
+        self.max_seq_length = self.sentence_model.max_seq_length
+        self.do_lower_case = getattr(self.sentence_model[0], 'do_lower_case', False)
+
+    def encode(self, sentences:List[str], batch_size:int=32) -> np.ndarray:
+        return self.sentence_model.encode(sentences, batch_size=batch_size, device=self.device, convert_to_numpy=True)
+
+    def encode_tokenized(self, input_ids:List[List[int]]) -> np.ndarray:
+        padded_ids, attention_mask = pad_input_ids(input_ids, self.tokenizer.pad_token_id)
+        features = {
+            'input_ids': th.from_numpy(padded_ids).to(self.device), 
+            'attention_mask': th.from_numpy(attention_mask).to(self.device)
+        }
+        with th.no_grad():
+            embeddings = self.sentence_model(features)['sentence_embedding']
+        return embeddings.float().cpu().numpy()
+
+class QuantizedEncoder(TorchEncoder):
+    # dynamic int8 quantization of the linear layers, cpu only
+    def __init__(self, model_name:str, cache_folder:str, device:th.device):
+        super(QuantizedEncoder, self).__init__(model_name, cache_folder, th.device('cpu'))
+        if device.type != 'cpu':
+            logger.warning(f'quantized encoder runs on cpu, the device {device} is ignored')
+        self.sentence_model = th.quantization.quantize_dynamic(self.sentence_model, {th.nn.Linear}, dtype=th.qint8)
+
+class OnnxEncoder(BaseEncoder):
+    # the transformer is exported once to transformers_cache/onnx/<model_name>/model.onnx
+    # the tokenizer and the pooling config are saved next to the graph : later starts never load the torch weights
+    # tokenization and pooling stay in python, the forward pass runs in onnxruntime
+    def __init__(self, model_name:str, cache_folder:str, num_threads:int=None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        onnx_folder = path.join(cache_folder, 'onnx', model_name.strip('/').replace('/', '__'))
+        onnx_path = path.join(onnx_folder, 'model.onnx')
+        config_path = path.join(onnx_folder, 'encoder_config.json')
+        if not path.isfile(onnx_path) or not path.isfile(config_path):
+            sentence_model = load_sentence_transformer(resolve_model_path(model_name, cache_folder), cache_folder, device='cpu')
+            export_to_onnx(sentence_model, onnx_path)
+            del sentence_model
+
+        with open(config_path, 'r') as fp:
+            config = json.load(fp)
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_folder)
+        self.max_seq_length = config['max_seq_length']
+        self.pooling_mode = config['pooling_mode']
+        self.normalize = config['normalize']
+        self.do_lower_case = config.get('do_lower_case', False)
+
+        session_options = ort.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, sess_options=session_options, providers=['CPUExecutionProvider'])
+        self.input_names = [ node.name for node in self.session.get_inputs() ]
+        logger.debug(f'onnx encoder was loaded from {onnx_path}')
+
+    def encode(self, sentences:List[str], batch_size:int=32) -> np.ndarray:
+        input_ids = self.tokenize(sentences)
+        return np.concatenate([ self.encode_tokenized(input_ids[start:start + batch_size]) for start in range(0, len(input_ids), batch_size) ], axis=0)
+
+    def encode_tokenized(self, input_ids:List[List[int]]) -> np.ndarray:
+        padded_ids, attention_mask = pad_input_ids(input_ids, self.tokenizer.pad_token_id)
+        features = {'input_ids': padded_ids, 'attention_mask': attention_mask}
+        token_embeddings = self.session.run(None, { name: features[name] for name in self.input_names })[0]
+        embeddings = pool_token_embeddings(token_embeddings, attention_mask, self.pooling_mode).astype(np.float32)
+        if self.normalize:
+            embeddings = normalize_embeddings(embeddings)
+        return embeddings
+
+class MockEncoder:
+    # deterministic fake model : no weights to download, measures the zeromq / fastapi overhead 
+    # each sentence gets a pseudo random unit vector seeded by its hash, token_latency (ms) simulates the compute 
+    def __init__(self, dimension:int=768, token_latency:float=0.0, max_seq_length:int=128):
+        self.dimension = dimension
+        self.token_latency = token_latency
+        self.max_seq_length = max_seq_length
+
+    def tokenize(self, sentences:List[str]) -> List[List[int]]:
+        # one fake token per word between two special tokens 
+        return [ ([0] + [ zlib.crc32(word.encode('utf-8')) for word in sent.split() ])[:self.max_seq_length - 1] + [1] for sent in sentences ]
+
+    def count_tokens(self, sentences:List[str]) -> np.ndarray:
+        return np.array([ len(ids) for ids in self.tokenize(sentences) ], dtype=np.int64)
+
+    def encode(self, sentences:List[str], batch_size:int=32) -> np.ndarray:
+        return self.encode_tokenized(self.tokenize(sentences))
+
+    def encode_tokenized(self, input_ids:List[List[int]]) -> np.ndarray:
+        embeddings = np.empty((len(input_ids), self.dimension), dtype=np.float32)
+        for idx, ids in enumerate(input_ids):
+            seed = int.from_bytes(hashlib.blake2b(np.asarray(ids, dtype=np.int64).tobytes(), digest_size=8).digest(), 'little')
+            embeddings[idx] = np.random.default_rng(seed).standard_normal(self.dimension, dtype=np.float32)
+        if self.token_latency > 0:
+            sleep(sum( len(ids) for ids in input_ids ) * self.token_latency / 1000)
+        return normalize_embeddings(embeddings)
+
+class TransformerForExport(th.nn.Module):
+    def __init__(self, auto_model:th.nn.Module):
+        super(TransformerForExport, self).__init__()
+        self.auto_model = auto_model
+
+    def forward(self, input_ids:th.Tensor, attention_mask:th.Tensor) -> th.Tensor:
+        return self.auto_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+def get_pooling_mode(pooling_module:th.nn.Module) -> str:
+    if getattr(pooling_module, 'pooling_mode_cls_token', False):
+        return 'cls'
+    if getattr(pooling_module, 'pooling_mode_max_tokens', False):
+        return 'max'
+    return 'mean'
+
+def pool_token_embeddings(token_embeddings:np.ndarray, attention_mask:np.ndarray, pooling_mode:str) -> np.ndarray:
+    if pooling_mode == 'cls':
+        return token_embeddings[:, 0]
+    mask = attention_mask[:, :, None].astype(token_embeddings.dtype)
+    if pooling_mode == 'max':
+        return np.max(np.where(mask > 0, token_embeddings, -1e9), axis=1)
+    return np.sum(token_embeddings * mask, axis=1) / np.clip(np.sum(mask, axis=1), 1e-9, None)
+
+def export_to_onnx(sentence_model:th.nn.Module, onnx_path:str):
+    # the graph, the tokenizer and encoder_config.json : everything the onnx encoder needs at runtime 
+    onnx_folder = path.dirname(onnx_path)
+    makedirs(onnx_folder, exist_ok=True)
+    logger.debug(f'the transformer will be exported to {onnx_path}')
+    features = sentence_model.tokenizer(['exemple de phrase'], return_tensors='pt')
+    module = TransformerForExport(sentence_model[0].auto_model).eval()
+    export_options = {}
+    if 'dynamo' in inspect.signature(th.onnx.export).parameters:
+        export_options['dynamo'] = False  # recent torch defaults to the dynamo exporter (onnxscript), keep the torchscript one 
+    with th.no_grad():
+        th.onnx.export(
+            module,
+            (features['input_ids'], features['attention_mask']),
+            onnx_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['token_embeddings'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'token_embeddings': {0: 'batch', 1: 'sequence'}
+            },
+            opset_version=14,
+            **export_options
+        )
+    sentence_model.tokenizer.save_pretrained(onnx_folder)
+    with open(path.join(onnx_folder, 'encoder_config.json'), 'w') as fp:
+        json.dump({
+            'max_seq_length': sentence_model.max_seq_length,
+            'pooling_mode': get_pooling_mode(sentence_model[1]) if len(sentence_model) > 1 else 'mean',
+            'normalize': any( type(module).__name__ == 'Normalize' for module in sentence_model ),
+            'do_lower_case': getattr(sentence_model[0], 'do_lower_case', False)
+        }, fp)
+    logger.success(f'the transformer was exported to {onnx_path}')
+
+def load_encoder(backend:str, model_name:str, cache_folder:str, device:th.device, num_threads:int=None, mock_token_latency:float=0.0):
+    if backend == 'torch':
+        return TorchEncoder(model_name, cache_folder, device)
+    if backend == 'quantized':
+        return QuantizedEncoder(model_name, cache_folder, device)
+    if backend == 'onnx':
+        return OnnxEncoder(model_name, cache_folder, num_threads=num_threads)
+    if backend == 'mock':
+        return MockEncoder(token_latency=mock_token_latency)
+    raise ValueError(f'unknown encoder backend : {backend}, available : {ENCODER_BACKENDS}')
+
+def check_encoder_agreement(reference_encoder, candidate_encoder, sentences:List[str], batch_size:int=32) -> Dict[str, float]:
+    # cosine agreement between a candidate backend and the fp32 reference on the same sentences
+    start = perf_counter()
+    reference_embeddings = reference_encoder.encode(sentences, batch_size=batch_size)
+    reference_duration = perf_counter() - start
+
+    start = perf_counter()
+    candidate_embeddings = candidate_encoder.encode(sentences, batch_size=batch_size)
+    candidate_duration = perf_counter() - start
+
+    cosines = np.sum(normalize_embeddings(reference_embeddings) * normalize_embeddings(candidate_embeddings), axis=1)
+    return {
+        'nb_sentences': len(sentences),
+        'mean_cosine': float(np.mean(cosines)),
+        'min_cosine': float(np.min(cosines)),
+        'p01_cosine': float(np.percentile(cosines, 1)),
+        'reference_duration': reference_duration,
+        'candidate_duration': candidate_duration,
+        'speedup': reference_duration / candidate_duration
+    }
@@ -0,0 +1,304 @@
+import os
+import re
+import json
+import shutil
+
+import numpy as np
+
+from os import path, makedirs, replace, remove
+from typing import List, Dict, Tuple, Optional, Any
+
+# in-process vector index, one per model : folder/<model>/
+#     vectors.f32 : normalized float32 rows in a memory-mapped file, it grows by doubling
+#     ids.jsonl : id of each row, one json string per line, appended by each add after its vectors
+#     state.json : dimension and kmeans state
+#     centroids.npy, assignments.npy : inverted file, only when nlist > 0, the rows added after assignments.npy are assigned at load
+# snapshots are compact copies of these files under folder/<model>/snapshots/<name>/
+
+INDEX_FILES = ['vectors.f32', 'ids.jsonl', 'state.json', 'centroids.npy', 'assignments.npy']
+
+def normalize_rows(vectors:np.ndarray) -> np.ndarray:
+    # same cosine as compute_pairwise_matrix, but the norms are divided once at insertion : a query is a dot product
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / (norms + 1e-8)
+
+def select_top_k(scores:np.ndarray, rows:np.ndarray, top_k:int) -> Tuple[np.ndarray, np.ndarray]:
+    # scores, rows : (nb_queries, nb_candidates) => the top_k best candidates of each query, best first
+    if scores.shape[1] > top_k:
+        selected = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        scores = np.take_along_axis(scores, selected, axis=1)
+        rows = np.take_along_axis(rows, selected, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+class VectorIndex:
+    # exact mode : a query is scanned against every row by blocks, a few million rows fit a single cpu node
+    # ivf mode (nlist > 0) : the rows are clustered by spherical kmeans, a query scans only its nprobe closest clusters
+    block_size = 65536  # rows per matrix product : bounds the memory of a query
+    min_rows_per_centroid = 39  # below this the kmeans is not worth it, the index stays exact
+
+    def __init__(self, folder:str, nlist:int=0, nprobe:int=8, initial_capacity:int=4096, flush_size:int=16384):
+        self.folder = folder
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.initial_capacity = initial_capacity
+        self.flush_size = flush_size  # rows written between two flushes to the disk
+        self.ids_file = None
+        self.reset()
+        makedirs(folder, exist_ok=True)
+        if path.isfile(path.join(folder, 'state.json')):
+            self.read_files()
+
+    def reset(self):
+        if self.ids_file is not None:
+            self.ids_file.close()
+        self.ids_file = None
+        self.nb_unflushed = 0
+        self.dimension:Optional[int] = None
+        self.capacity = 0
+        self.vectors:Optional[np.memmap] = None
+        self.ids:List[str] = []
+        self.map_id2row:Dict[str, int] = {}
+        self.centroids:Optional[np.ndarray] = None
+        self.assignments = np.zeros(0, dtype=np.int32)  # cluster of each row
+        self.inverted_lists:Optional[Tuple[np.ndarray, np.ndarray]] = None  # rows sorted by cluster and the bounds of each cluster, rebuilt after the adds
+        self.trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def open_vectors(self, capacity:int):
+        # the rows already written stay in place when the file grows
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        vectors_path = path.join(self.folder, 'vectors.f32')
+        with open(vectors_path, 'r+b' if path.isfile(vectors_path) else 'w+b') as fp:
+            fp.truncate(capacity * self.dimension * 4)
+        self.vectors = np.memmap(vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dimension))
+        assignments = np.full(capacity, -1, dtype=np.int32)
+        assignments[:len(self.assignments)] = self.assignments[:capacity]
+        self.assignments = assignments
+        self.capacity = capacity
+
+    def read_ids(self) -> List[str]:
+        ids_path = path.join(self.folder, 'ids.jsonl')
+        if not path.isfile(ids_path):
+            return []
+        with open(ids_path, 'rb') as fp:
+            content = fp.read()
+        valid_size = content.rfind(b'\n') + 1
+        if valid_size < len(content):
+            with open(ids_path, 'r+b') as fp:
+                fp.truncate(valid_size)  # the last line was cut by a crash : its vectors were written, but the add never returned
+        return [ json.loads(line) for line in content[:valid_size].decode('utf-8').splitlines() ]
+
+    def read_files(self):
+        with open(path.join(self.folder, 'state.json'), 'r') as fp:
+            state = json.load(fp)
+        self.dimension = state['dimension']
+        self.ids = self.read_ids()
+        self.map_id2row = { vector_id: row for row, vector_id in enumerate(self.ids) }
+        self.open_vectors(max(len(self.ids), self.initial_capacity))
+
+        centroids_path = path.join(self.folder, 'centroids.npy')
+        if state.get('nlist', 0) == self.nlist and self.nlist > 0 and path.isfile(centroids_path):
+            self.centroids = np.load(centroids_path)
+            assignments = np.load(path.join(self.folder, 'assignments.npy'))[:len(self)]
+            self.assignments[:len(assignments)] = assignments
+            if len(assignments) < len(self):
+                self.assignments[len(assignments):len(self)] = self.assign(self.vectors[len(assignments):len(self)])  # rows added since the last flush
+            self.trained_size = state['trained_size']
+        elif self.nlist > 0 and len(self) >= self.nlist * self.min_rows_per_centroid:
+            self.train()  # the index was built with another nlist
+
+    def append_ids(self, ids:List[str]):
+        # the vectors of these rows are already in the memory map : an id read after a crash always has its vector
+        if self.ids_file is None:
+            self.ids_file = open(path.join(self.folder, 'ids.jsonl'), 'a', encoding='utf-8')
+        self.ids_file.write(''.join( json.dumps(vector_id) + '\n' for vector_id in ids ))
+        self.ids_file.flush()
+
+    def write_files(self, folder:str, with_rows:bool):
+        # every file is written next to its target then renamed : a reader never sees a partial file
+        # with_rows : full copy of the vectors and the ids, for the snapshots, the live files are appended by each add
+        if with_rows:
+            self.vectors[:len(self)].tofile(path.join(folder, 'vectors.f32.tmp'))
+            replace(path.join(folder, 'vectors.f32.tmp'), path.join(folder, 'vectors.f32'))
+            with open(path.join(folder, 'ids.jsonl.tmp'), 'w', encoding='utf-8') as fp:
+                fp.write(''.join( json.dumps(vector_id) + '\n' for vector_id in self.ids ))
+            replace(path.join(folder, 'ids.jsonl.tmp'), path.join(folder, 'ids.jsonl'))
+        for filename, array in [('centroids.npy', self.centroids), ('assignments.npy', self.assignments[:len(self)])]:
+            if self.centroids is None:
+                if path.isfile(path.join(folder, filename)):
+                    remove(path.join(folder, filename))
+                continue
+            with open(path.join(folder, filename + '.tmp'), 'wb') as fp:
+                np.save(fp, array)
+            replace(path.join(folder, filename + '.tmp'), path.join(folder, filename))
+        with open(path.join(folder, 'state.json.tmp'), 'w') as fp:
+            json.dump({'dimension': self.dimension, 'nlist': self.nlist, 'trained_size': self.trained_size}, fp)
+        replace(path.join(folder, 'state.json.tmp'), path.join(folder, 'state.json'))
+
+    def flush(self):
+        # a killed process keeps its adds (page cache), the flush makes them survive a crash of the machine
+        # its cost does not depend on the number of ids, only assignments.npy is rewritten in ivf mode
+        if self.dimension is None:
+            return
+        self.vectors.flush()
+        if self.ids_file is not None:
+            os.fsync(self.ids_file.fileno())
+        self.write_files(self.folder, with_rows=False)
+        self.nb_unflushed = 0
+
+    def add(self, ids:List[str], vectors:np.ndarray) -> Tuple[int, int]:
+        # an id that is already indexed has its vector replaced : returns (nb_added, nb_updated)
+        vectors = normalize_rows(vectors)
+        if len(ids) != len(vectors):
+            raise ValueError(f'{len(ids)} ids for {len(vectors)} vectors')
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+            self.open_vectors(self.initial_capacity)
+            self.write_files(self.folder, with_rows=False)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f'the index holds vectors of dimension {self.dimension}, got {vectors.shape[1]}')
+
+        rows = np.empty(len(ids), dtype=np.int64)
+        new_ids = []
+        for idx, vector_id in enumerate(ids):
+            row = self.map_id2row.get(vector_id, None)
+            if row is None:
+                row = len(self.ids)
+                self.map_id2row[vector_id] = row
+                self.ids.append(vector_id)
+                new_ids.append(vector_id)
+            rows[idx] = row
+        if len(self) > self.capacity:
+            self.open_vectors(max(2 * self.capacity, len(self)))
+        self.vectors[rows] = vectors
+        self.append_ids(new_ids)
+
+        if self.nlist > 0 and len(self) >= max(self.nlist * self.min_rows_per_centroid, 4 * self.trained_size):
+            self.train()  # first training, or the collection has grown enough to drift from its centroids
+        elif self.centroids is not None:
+            self.assignments[rows] = self.assign(vectors)
+            self.inverted_lists = None
+
+        self.nb_unflushed += len(ids)
+        if self.nb_unflushed >= self.flush_size:
+            self.flush()
+        return len(new_ids), len(ids) - len(new_ids)
+
+    def assign(self, vectors:np.ndarray) -> np.ndarray:
+        clusters = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), self.block_size):
+            clusters[start:start + self.block_size] = np.argmax(vectors[start:start + self.block_size] @ self.centroids.T, axis=1)
+        return clusters
+
+    def train(self, nb_iterations:int=10, sample_per_centroid:int=256):
+        # spherical kmeans on a sample of the rows, then every row is assigned to its closest centroid
+        rng = np.random.default_rng(0)
+        size = len(self)
+        sample_size = min(size, self.nlist * sample_per_centroid)
+        sample = np.asarray(self.vectors[np.sort(rng.choice(size, sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, self.nlist, replace=False)]
+        for _ in range(nb_iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(labels, minlength=self.nlist)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            non_empty = counts > 0
+            sums = centroids.copy()  # an empty cluster keeps its centroid
+            sums[non_empty] = np.add.reduceat(sample[np.argsort(labels, kind='stable')], starts[non_empty], axis=0)
+            centroids = normalize_rows(sums)
+
+        self.centroids = centroids
+        self.assignments[:size] = self.assign(self.vectors[:size])
+        self.inverted_lists = None
+        self.trained_size = size
+        self.write_files(self.folder, with_rows=False)
+
+    def get_inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.inverted_lists is None:
+            assignments = self.assignments[:len(self)]
+            order = np.argsort(assignments, kind='stable')
+            bounds = np.searchsorted(assignments[order], np.arange(self.nlist + 1))
+            self.inverted_lists = (order, bounds)
+        return self.inverted_lists
+
+    def search(self, queries:np.ndarray, top_k:int, nprobe:Optional[int]=None) -> List[List[Tuple[str, float]]]:
+        # top_k rows by cosine for each query, best first
+        queries = normalize_rows(queries)
+        if len(self) == 0:
+            return [ [] for _ in queries ]
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f'the index holds vectors of dimension {self.dimension}, got {queries.shape[1]}')
+        top_k = min(top_k, len(self))
+
+        if self.centroids is None:
+            scores, rows = self.search_exact(queries, top_k)
+            return [ self.make_matches(query_scores, query_rows) for query_scores, query_rows in zip(scores, rows) ]
+
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        order, bounds = self.get_inverted_lists()
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        matches = []
+        for query, query_probes in zip(queries, probes):
+            candidates = np.sort(np.concatenate([ order[bounds[cluster]:bounds[cluster + 1]] for cluster in query_probes ]))  # sequential reads of the memory map
+            if len(candidates) == 0:
+                matches.append([])
+                continue
+            scores, rows = select_top_k((self.vectors[candidates] @ query)[None, :], candidates[None, :], min(top_k, len(candidates)))
+            matches.append(self.make_matches(scores[0], rows[0]))
+        return matches
+
+    def search_exact(self, queries:np.ndarray, top_k:int) -> Tuple[np.ndarray, np.ndarray]:
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), self.block_size):
+            block = self.vectors[start:min(start + self.block_size, len(self))]
+            block_scores = queries @ block.T
+            block_rows = np.broadcast_to(np.arange(start, start + len(block)), block_scores.shape)
+            block_scores, block_rows = select_top_k(block_scores, block_rows, min(top_k, len(block)))
+            best_scores, best_rows = select_top_k(np.hstack([best_scores, block_scores]), np.hstack([best_rows, block_rows]), top_k)
+        return best_scores, best_rows
+
+    def make_matches(self, scores:np.ndarray, rows:np.ndarray) -> List[Tuple[str, float]]:
+        return [ (self.ids[row], float(score)) for score, row in zip(scores, rows) ]
+
+    def get_snapshot_folder(self, name:str) -> str:
+        if not re.match(r'^[A-Za-z0-9_-]+$', name):
+            raise ValueError(f'invalid snapshot name : {name} (letters, digits, - and _ only)')
+        return path.join(self.folder, 'snapshots', name)
+
+    def snapshot(self, name:str):
+        snapshot_folder = self.get_snapshot_folder(name)
+        if self.dimension is None:
+            raise ValueError('the index is empty')
+        makedirs(snapshot_folder, exist_ok=True)
+        self.flush()
+        self.write_files(snapshot_folder, with_rows=True)
+
+    def load(self, name:str):
+        # the snapshot replaces the live files of the index
+        snapshot_folder = self.get_snapshot_folder(name)
+        if not path.isfile(path.join(snapshot_folder, 'state.json')):
+            raise FileNotFoundError(f'the snapshot {name} does not exist')
+        self.reset()  # closes the ids file before it is replaced
+        for filename in INDEX_FILES:
+            if path.isfile(path.join(snapshot_folder, filename)):
+                shutil.copyfile(path.join(snapshot_folder, filename), path.join(self.folder, filename + '.tmp'))
+                replace(path.join(self.folder, filename + '.tmp'), path.join(self.folder, filename))
+            elif path.isfile(path.join(self.folder, filename)):
+                remove(path.join(self.folder, filename))
+        self.read_files()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self),
+            'dimension': self.dimension,
+            'capacity': self.capacity,
+            'mode': 'ivf' if self.centroids is not None else 'exact',
+            'nlist': self.nlist,
+            'nprobe': self.nprobe
+        }
@@ -0,0 +1,126 @@
+import asyncio as aio
+
+import time
+
+import numpy as np
+
+from uuid import uuid4
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+# status of a job : pending => running => done | failed | cancelled
+JOB_FINISHED = ['done', 'failed', 'cancelled']
+
+class Job:
+    # texts of a job are sent to the vectorizers by chunks, the embeddings are kept in the order of the items
+    def __init__(self, request_ids:List[str], texts:List[str], options:Dict[str, Any], model:str):
+        self.job_id = uuid4().hex
+        self.model = model
+        self.request_ids = request_ids
+        self.texts:Optional[List[str]] = texts  # released once every chunk was sent
+        self.options = options  # precision and weighting forwarded to the vectorizers
+
+        self.status = 'pending'
+        self.error_message:Optional[str] = None
+        self.embeddings:List[Optional[np.ndarray]] = [None] * len(texts)
+        self.completed:List[int] = []  # indices of the items in completion order, failed items included
+        self.nb_failed = 0
+        self.nbytes = sum( len(text) for text in texts )
+
+        self.created_at = time.time()
+        self.finished_at:Optional[float] = None
+        self.progress = aio.Condition()  # notified after each chunk, the streaming responses wait on it
+
+    def __len__(self) -> int:
+        return len(self.request_ids)
+
+    def is_finished(self) -> bool:
+        return self.status in JOB_FINISHED
+
+    def iter_chunks(self, chunk_size:int) -> Iterator[Tuple[List[int], List[str]]]:
+        for start in range(0, len(self.texts), chunk_size):
+            indices = list(range(start, min(start + chunk_size, len(self.texts))))
+            yield indices, [ self.texts[idx] for idx in indices ]
+
+    async def complete(self, indices:List[int], embeddings:List[Optional[np.ndarray]]):
+        for idx, embedding in zip(indices, embeddings):
+            self.embeddings[idx] = embedding
+            if embedding is None:
+                self.nb_failed += 1
+            else:
+                self.nbytes += embedding.nbytes
+            self.completed.append(idx)
+        async with self.progress:
+            self.progress.notify_all()
+
+    async def finish(self, status:str, error_message:Optional[str]=None):
+        self.status = status
+        self.error_message = error_message
+        self.finished_at = time.time()
+        if self.texts is not None:
+            self.nbytes -= sum( len(text) for text in self.texts )
+            self.texts = None
+        async with self.progress:
+            self.progress.notify_all()
+
+    def summary(self, ttl:float) -> Dict[str, Any]:
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'model': self.model,
+            'nb_items': len(self),
+            'nb_completed': len(self.completed),
+            'nb_failed': self.nb_failed,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'expires_at': self.finished_at + ttl if self.finished_at is not None else None
+        }
+
+class JobStore:
+    # finished jobs are kept ttl seconds, the oldest finished jobs are evicted first when the store is full
+    # running jobs are never evicted : a new job is refused while they fill the store
+    def __init__(self, max_jobs:int, max_bytes:int, ttl:float):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.ttl = ttl  # s
+        self.jobs:Dict[str, Job] = OrderedDict()  # insertion order
+        self.evictions = 0
+
+    def nbytes(self) -> int:
+        return sum( job.nbytes for job in self.jobs.values() )
+
+    def evict(self, nb_jobs:int=0, nb_bytes:int=0):
+        # nb_jobs, nb_bytes : room to make for a new job
+        now = time.time()
+        for job_id in [ job_id for job_id, job in self.jobs.items() if job.is_finished() and now - job.finished_at > self.ttl ]:
+            del self.jobs[job_id]
+            self.evictions += 1
+
+        finished_jobs = sorted(( job for job in self.jobs.values() if job.is_finished() ), key=lambda job: job.finished_at)
+        nbytes = self.nbytes()
+        for job in finished_jobs:
+            if len(self.jobs) + nb_jobs <= self.max_jobs and nbytes + nb_bytes <= self.max_bytes:
+                break
+            del self.jobs[job.job_id]
+            nbytes -= job.nbytes
+            self.evictions += 1
+
+    def add(self, job:Job) -> bool:
+        self.evict(nb_jobs=1, nb_bytes=job.nbytes)
+        if len(self.jobs) >= self.max_jobs or self.nbytes() + job.nbytes > self.max_bytes:
+            return False
+        self.jobs[job.job_id] = job
+        return True
+
+    def get(self, job_id:str) -> Optional[Job]:
+        self.evict()
+        return self.jobs.get(job_id, None)
+
+    def remove(self, job_id:str) -> Optional[Job]:
+        return self.jobs.pop(job_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        statuses = {status: 0 for status in ['pending', 'running'] + JOB_FINISHED}
+        for job in self.jobs.values():
+            statuses[job.status] += 1
+        return {'jobs': statuses, 'bytes': self.nbytes(), 'evictions': self.evictions}
@@ -0,0 +1,109 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import List, Dict, Tuple, Any, Iterator, Optional
+
+# prometheus text exposition without the prometheus_client dependency
+# a registry is serialized to a json snapshot, the vectorizers push their snapshots to the server through the broker
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+class Histogram:
+    def __init__(self, buckets:Tuple[float, ...]=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'buckets': self.buckets, 'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+class MetricsRegistry:
+    def __init__(self):
+        self.map_name2description:Dict[str, Tuple[str, str]] = {}  # name => (type, help)
+        self.map_name2samples:Dict[str, Dict[Tuple[Tuple[str, str], ...], Any]] = {}  # name => labels => value or histogram
+        self.map_name2buckets:Dict[str, Tuple[float, ...]] = {}
+
+    def describe(self, name:str, metric_type:str, help_message:str, buckets:Optional[Tuple[float, ...]]=None):
+        self.map_name2description[name] = (metric_type, help_message)
+        self.map_name2samples.setdefault(name, {})
+        if buckets is not None:
+            self.map_name2buckets[name] = buckets
+
+    def inc(self, name:str, value:float=1, **labels:str):
+        samples = self.map_name2samples[name]
+        key = tuple(sorted(labels.items()))
+        samples[key] = samples.get(key, 0) + value
+
+    def set(self, name:str, value:float, **labels:str):
+        self.map_name2samples[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name:str, value:float, **labels:str):
+        samples = self.map_name2samples[name]
+        key = tuple(sorted(labels.items()))
+        if key not in samples:
+            samples[key] = Histogram(self.map_name2buckets.get(name, LATENCY_BUCKETS))
+        samples[key].observe(value)
+
+    @contextmanager
+    def timer(self, name:str, **labels:str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = {}
+        for name, (metric_type, help_message) in self.map_name2description.items():
+            samples = []
+            for key, value in self.map_name2samples[name].items():
+                sample = {'labels': dict(key)}
+                if isinstance(value, Histogram):
+                    sample.update(value.snapshot())
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            snapshot[name] = {'type': metric_type, 'help': help_message, 'samples': samples}
+        return snapshot
+
+def format_labels(labels:Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = [ (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in sorted(labels.items()) ]
+    return '{' + ','.join( f'{key}="{value}"' for key, value in escaped ) + '}'
+
+def format_value(value:float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_metrics(snapshots:List[Tuple[Dict[str, str], Dict[str, Any]]]) -> str:
+    # snapshots : (extra labels, snapshot), a metric exposed by several processes is written once with all its samples
+    map_name2metric = {}
+    for extra_labels, snapshot in snapshots:
+        for name, metric in snapshot.items():
+            entry = map_name2metric.setdefault(name, {'type': metric['type'], 'help': metric['help'], 'samples': []})
+            entry['samples'].extend( (dict(sample['labels'], **extra_labels), sample) for sample in metric['samples'] )
+
+    lines = []
+    for name, metric in map_name2metric.items():
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for labels, sample in metric['samples']:
+            if metric['type'] != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {format_value(sample["value"])}')
+                continue
+            cumulative_count = 0
+            for upper_bound, count in zip(sample['buckets'] + [float('inf')], sample['counts']):
+                cumulative_count += count
+                lines.append(f'{name}_bucket{format_labels(dict(labels, le=format_value(float(upper_bound))))} {cumulative_count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(float(sample["sum"]))}')
+            lines.append(f'{name}_count{format_labels(labels)} {sample["count"]}')
+    return '\n'.join(lines) + '\n'
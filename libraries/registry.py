@@ -0,0 +1,73 @@
+import re
+import json
+
+from typing import List, Dict, Any, Tuple, Optional
+
+from libraries.backends import SENTENCE_SPLITTERS, ENCODER_BACKENDS
+
+# a model registry is a json file of named model pairs, each one is served by its own broker and vectorizers
+# {
+#     "default": "fr",
+#     "models": {
+#         "fr": {"transformer_model_name": "Sahajtomar/french_semantic", "language_model_name": "fr_core_news_md", "num_vectorizers": 2},
+#         "en": {"transformer_model_name": "sentence-transformers/all-MiniLM-L6-v2", "language_model_name": "en_core_web_sm", "idle_timeout": 600}
+#     }
+# }
+# the settings missing from an entry take the values of the start-services options
+
+MODEL_SETTINGS = [
+    'transformer_model_name', 'language_model_name', 'sentence_splitter', 'encoder_backend', 'num_vectorizers', 'num_threads',
+    'idle_timeout', 'router_address', 'backend_address', 'publisher_address'
+]
+ADDRESS_SETTINGS = ['router_address', 'backend_address', 'publisher_address']
+
+def derive_address(address:str, model_name:str) -> str:
+    # ipc://router.ipc => ipc://router-en.ipc : each model gets its own sockets
+    if not address.startswith('ipc://'):
+        raise ValueError(f'{address} can not be derived for the model {model_name}, set the addresses of this model in the registry')
+    root, extension = re.match(r'^(.*?)(\.[^./]*)?$', address).groups()
+    return f'{root}-{model_name}{extension or ""}'
+
+def check_model_settings(model_name:str, settings:Dict[str, Any]):
+    if not re.match(r'^[A-Za-z0-9_-]+$', model_name):
+        raise ValueError(f'invalid model name : {model_name} (letters, digits, - and _ only)')
+    unknown_settings = set(settings.keys()) - set(MODEL_SETTINGS)
+    if len(unknown_settings) > 0:
+        raise ValueError(f'unknown settings for the model {model_name} : {sorted(unknown_settings)}')
+    if settings['sentence_splitter'] not in SENTENCE_SPLITTERS:
+        raise ValueError(f'unknown sentence splitter for the model {model_name} : {settings["sentence_splitter"]}')
+    if settings['encoder_backend'] not in ENCODER_BACKENDS:
+        raise ValueError(f'unknown encoder backend for the model {model_name} : {settings["encoder_backend"]}')
+    if settings.get('num_vectorizers', 1) < 1:
+        raise ValueError(f'the model {model_name} needs at least one vectorizer')
+
+def load_model_registry(registry_path:Optional[str], defaults:Dict[str, Any]) -> Tuple[str, Dict[str, Dict[str, Any]]]:
+    # returns the name of the default model and the settings of every model
+    # without registry, the start-services options describe a single model named default
+    if registry_path is None:
+        return 'default', {'default': dict(defaults)}
+
+    with open(registry_path, 'r') as fp:
+        registry = json.load(fp)
+    if len(registry.get('models', {})) == 0:
+        raise ValueError(f'{registry_path} does not describe any model')
+
+    map_model2settings = {}
+    for model_index, (model_name, entry) in enumerate(registry['models'].items()):
+        settings = dict(defaults)
+        settings.update(entry)
+        check_model_settings(model_name, settings)
+        if model_index > 0:  # the first model keeps the addresses of the options
+            for key in ADDRESS_SETTINGS:
+                if key not in entry and key in defaults:
+                    settings[key] = derive_address(defaults[key], model_name)
+        map_model2settings[model_name] = settings
+
+    addresses:List[str] = [ settings[key] for settings in map_model2settings.values() for key in ADDRESS_SETTINGS if key in settings ]
+    if len(set(addresses)) < len(addresses):
+        raise ValueError(f'{registry_path} : two models share the same address')
+
+    default_model = registry.get('default', next(iter(map_model2settings)))
+    if default_model not in map_model2settings:
+        raise ValueError(f'the default model {default_model} is not in {registry_path}')
+    return default_model, map_model2settings
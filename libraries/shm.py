@@ -0,0 +1,113 @@
+import json
+
+import numpy as np
+
+from uuid import uuid4
+from typing import Any, Dict, List, Optional, Tuple, Callable
+
+# shared memory transport between a vectorizer (writer) and the server (reader), both on the same host
+# the segment of a vectorizer : [state of each slot (1 byte)][padding][slot_0][slot_1]...[slot_n-1]
+# the vectorizer writes the embeddings of a reply into a free slot, marks it as used and sends only the slot index
+# the server reads the slot as numpy views and marks it as free once the response is sent
+# a reply that does not fit into a slot, or that finds no free slot, falls back to the inline transport
+# multiprocessing.shared_memory needs python >= 3.8 : it is imported only when the shm transport is used
+
+SLOT_FREE = 0
+SLOT_USED = 1
+ALIGNMENT = 64
+
+def align(offset:int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def attach_segment(name:str) -> Any:
+    # the reader must not unlink the segment of the writer when it exits
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # python >= 3.13
+    except TypeError:
+        # python < 3.13 registers the segment again : the spawned processes share the resource tracker of main.py
+        # so the registration is a no-op and the unlink of the writer unregisters the segment once for all 
+        return shared_memory.SharedMemory(name=name)
+
+class SharedEmbeddingWriter:
+    def __init__(self, nb_slots:int, slot_size:int):
+        self.nb_slots = nb_slots
+        self.slot_size = align(slot_size)
+        self.data_offset = align(nb_slots)
+        from multiprocessing import shared_memory
+        self.segment = shared_memory.SharedMemory(name=f'embedding-{uuid4().hex[:16]}', create=True, size=self.data_offset + nb_slots * self.slot_size)
+        self.states = np.ndarray((nb_slots,), dtype=np.uint8, buffer=self.segment.buf)
+        self.states[:] = SLOT_FREE
+        self.cursor = 0
+
+    def acquire_slot(self) -> Optional[int]:
+        free_slots = np.flatnonzero(self.states == SLOT_FREE)
+        if len(free_slots) == 0:
+            return None
+        # round robin : the slot released last is reused last
+        position = np.searchsorted(free_slots, self.cursor) % len(free_slots)
+        slot = int(free_slots[position])
+        self.cursor = (slot + 1) % self.nb_slots
+        return slot
+
+    def encode_reply(self, header:Dict[str, Any], embeddings:List[Optional[np.ndarray]], precision:str='float32') -> Optional[List[bytes]]:
+        arrays = [ np.ascontiguousarray(embedding, dtype=precision) if embedding is not None else None for embedding in embeddings ]
+        size = sum( align(array.nbytes) for array in arrays if array is not None )
+        if size > self.slot_size:
+            return None
+        slot = self.acquire_slot()
+        if slot is None:
+            return None
+
+        items = []
+        offset = self.data_offset + slot * self.slot_size
+        for array in arrays:
+            if array is None:
+                items.append({'status': False})
+                continue
+            np.ndarray(array.shape, dtype=array.dtype, buffer=self.segment.buf, offset=offset)[...] = array
+            items.append({'status': True, 'dtype': array.dtype.name, 'shape': list(array.shape), 'offset': offset})
+            offset += align(array.nbytes)
+
+        self.states[slot] = SLOT_USED  # the server owns the slot until it releases it
+        encoded_header = json.dumps(dict(header, items=items, transport='shm', segment=self.segment.name, slot=slot)).encode()
+        return [encoded_header]
+
+    def close(self):
+        del self.states  # the numpy view must be released before the segment
+        self.segment.close()
+        self.segment.unlink()
+
+class SharedEmbeddingReader:
+    def __init__(self):
+        self.map_name2segment:Dict[str, Any] = {}  # name => multiprocessing.shared_memory.SharedMemory
+
+    def get_segment(self, name:str) -> Any:
+        if name not in self.map_name2segment:
+            self.map_name2segment[name] = attach_segment(name)
+        return self.map_name2segment[name]
+
+    def read(self, header:Dict[str, Any]) -> Tuple[List[Optional[np.ndarray]], Callable[[], None]]:
+        segment = self.get_segment(header['segment'])
+        embeddings = []
+        for item in header['items']:
+            if not item['status']:
+                embeddings.append(None)
+                continue
+            # read-only view on the slot, no copy
+            embedding = np.ndarray(item['shape'], dtype=item['dtype'], buffer=segment.buf, offset=item['offset'])
+            embedding.flags.writeable = False
+            embeddings.append(embedding)
+
+        slot = header['slot']
+        def release():
+            segment.buf[slot] = SLOT_FREE
+        return embeddings, release
+
+    def close(self):
+        for segment in self.map_name2segment.values():
+            try:
+                segment.close()
+            except BufferError:
+                pass  # a view is still alive, the mapping is released with the process
+        self.map_name2segment.clear()
@@ -0,0 +1,58 @@
+import inspect 
+
+from os import path, makedirs 
+from time import perf_counter 
+from typing import Optional 
+
+from libraries.log import logger 
+
+# a snapshot is a local copy of a model that loads without any network access : 
+#   transformer/<model_name>      : the sentence transformer saved as safetensors 
+#   spacy-<splitter>/<model_name> : the spacy pipeline already reduced to the components of the sentence splitter 
+# heavy libraries are imported inside the functions : the cli imports this module 
+
+def get_snapshot_path(cache_folder:str, kind:str, model_name:str) -> str:
+    return path.join(cache_folder, 'snapshots', kind, model_name.strip('/').replace('/', '__'))
+
+def find_snapshot(cache_folder:str, kind:str, model_name:str) -> Optional[str]:
+    snapshot_path = get_snapshot_path(cache_folder, kind, model_name)
+    return snapshot_path if path.isdir(snapshot_path) else None 
+
+def prepare_transformer_snapshot(model_name:str, cache_folder:str) -> str:
+    from libraries.strategies import load_sentence_transformer
+
+    snapshot_path = get_snapshot_path(cache_folder, 'transformer', model_name)
+    start = perf_counter()
+    sentence_model = load_sentence_transformer(model_name, cache_folder)  # downloads the weights into the cache 
+    logger.debug(f'{model_name} was loaded from the hub cache in {perf_counter() - start:.1f}s')
+    # safe_serialization appeared in sentence-transformers 2.3 (python >= 3.8), older versions save pytorch_model.bin 
+    save_parameters = inspect.signature(sentence_model.save).parameters
+    save_kwargs = {'safe_serialization': True} if 'safe_serialization' in save_parameters else {}
+    sentence_model.save(snapshot_path, create_model_card=False, **save_kwargs)
+    
+    start = perf_counter()
+    load_sentence_transformer(snapshot_path, cache_folder)
+    logger.success(f'{model_name} snapshot was saved to {snapshot_path}, it loads in {perf_counter() - start:.1f}s')
+    return snapshot_path 
+
+def prepare_spacy_snapshot(language_model_name:str, sentence_splitter:str, cache_folder:str) -> Optional[str]:
+    import spacy 
+    from libraries.splitters import SentenceSplitter
+
+    if sentence_splitter in ['sentencizer', 'regex']:
+        logger.debug(f'the {sentence_splitter} splitter does not need any spacy model')
+        return None 
+    
+    if not spacy.util.is_package(language_model_name) and not path.isdir(language_model_name):
+        from spacy.cli import download 
+        download(language_model_name)
+
+    snapshot_path = get_snapshot_path(cache_folder, f'spacy-{sentence_splitter}', language_model_name)
+    splitter = SentenceSplitter(sentence_splitter, language_model_name)
+    makedirs(path.dirname(snapshot_path), exist_ok=True)
+    splitter.spacy_model.to_disk(snapshot_path)
+
+    start = perf_counter()
+    SentenceSplitter(sentence_splitter, language_model_name, snapshot_path=snapshot_path)
+    logger.success(f'{language_model_name} snapshot ({sentence_splitter}) was saved to {snapshot_path}, it loads in {perf_counter() - start:.1f}s')
+    return snapshot_path 
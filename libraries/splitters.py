@@ -0,0 +1,73 @@
+import re
+
+import spacy
+
+from spacy.language import Language
+from typing import List, Iterator, Optional
+
+from libraries.strategies import clean_sentences, split_text, to_sentences_batch, stream_sentences
+from libraries.backends import SENTENCE_SPLITTERS
+
+# components that never set sentence boundaries
+UNUSED_COMPONENTS = ['tagger', 'morphologizer', 'attribute_ruler', 'lemmatizer', 'ner', 'entity_ruler', 'textcat', 'textcat_multilabel']
+
+# titles and abbreviations followed by a capitalized word : their period never ends a sentence
+ABBREVIATIONS = ['Dr', 'Pr', 'Me', 'Mme', 'Mmes', 'Mlle', 'Mlles', 'MM', 'Mgr', 'St', 'Ste', 'Mr', 'Mrs', 'Ms', 'Prof', 'Jr', 'Sr', 'cf', 'art', 'fig', 'vol', 'no']
+
+class SentenceSplitter:
+    # full        : the whole spacy pipeline (reference, slowest)
+    # parser      : spacy pipeline reduced to tok2vec + parser, same boundaries as full
+    # senter      : spacy pipeline reduced to its senter component
+    # sentencizer : rule based spacy sentencizer on a blank pipeline
+    # regex       : punctuation and line breaks, no spacy at all
+    # a boundary follows a final punctuation and precedes anything but a lowercase word
+    # but not after an initial (M. Dupont, S.A.R.L.) or a usual abbreviation (Dr. Martin)
+    boundary_pattern = re.compile(
+        r'(?<=[.!?…])(?<!\b[A-Z]\.)' + ''.join( rf'(?<!\b{abbreviation}\.)' for abbreviation in ABBREVIATIONS ) + r'\s+(?=[^a-zà-ÿ\s])|\n+'
+    )
+
+    def __init__(self, backend:str, language_model_name:str, n_process:int=1, batch_size:int=32, snapshot_path:Optional[str]=None):
+        if backend not in SENTENCE_SPLITTERS:
+            raise ValueError(f'unknown sentence splitter : {backend}, available : {SENTENCE_SPLITTERS}')
+        self.backend = backend
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.spacy_model = self.load_spacy_model(backend, language_model_name, snapshot_path)
+
+    def load_spacy_model(self, backend:str, language_model_name:str, snapshot_path:Optional[str]=None) -> Optional[Language]:
+        if snapshot_path is not None and backend in ['full', 'parser', 'senter']:
+            return spacy.load(snapshot_path)  # saved by prepare-models, already reduced to the components of the backend 
+        if backend == 'full':
+            return spacy.load(language_model_name)
+        if backend == 'parser':
+            return spacy.load(language_model_name, exclude=UNUSED_COMPONENTS + ['senter'])
+        if backend == 'senter':
+            spacy_model = spacy.load(language_model_name, exclude=UNUSED_COMPONENTS + ['tok2vec', 'parser'])
+            spacy_model.enable_pipe('senter')
+            return spacy_model
+        if backend == 'sentencizer':
+            spacy_model = spacy.blank(language_model_name.split('_')[0])  # fr_core_news_md => fr
+            spacy_model.add_pipe('sentencizer')
+            return spacy_model
+        return None
+
+    def regex_split(self, text:str) -> List[str]:
+        return self.boundary_pattern.split(text)
+
+    def split(self, text:str, valid_length:int=1) -> List[str]:
+        return self.split_many([text], valid_length)[0]
+
+    def split_many(self, texts:List[str], valid_length:int=1) -> List[List[str]]:
+        if self.spacy_model is None:
+            return [ clean_sentences(self.regex_split(text), valid_length) for text in texts ]
+
+        n_process = self.n_process if len(texts) >= 2 * self.batch_size else 1  # worker processes only pay off on large batches
+        return to_sentences_batch(texts, self.spacy_model, valid_length, batch_size=self.batch_size, n_process=n_process)
+
+    def stream(self, text:str, valid_length:int=1, chunk_length:int=100000) -> Iterator[str]:
+        if self.spacy_model is None:
+            for chunk in split_text(text, chunk_length):
+                yield from clean_sentences(self.regex_split(chunk), valid_length)
+            return
+
+        yield from stream_sentences(text, self.spacy_model, valid_length, chunk_length=chunk_length)
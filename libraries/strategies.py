@@ -2,16 +2,17 @@ import re
 
 import spacy 
 import numpy as np 
-import networkx as nx
 import unicodedata
 
 import operator as op 
+import itertools as it 
 
 from math import ceil 
+from time import perf_counter 
 from spacy.language import Language
 from sentence_transformers import SentenceTransformer
 
-from typing import List, Tuple  
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional, Any, Callable
 
 def load_language_model(model_name:str) -> Language:
     model = spacy.load(name=model_name)
@@ -21,16 +22,82 @@ def load_sentence_transformer(model_name:str, cache_folder:str='cache', device:s
     sentence_model = SentenceTransformer(model_name, cache_folder=cache_folder, device=device)
     return sentence_model
 
-def to_sentences(text:str, spacy_model:Language, valid_length:str) -> List[str]:
-    document = spacy_model(text)
+def clean_sentences(sentences:Iterable[str], valid_length:int) -> List[str]:
     sentences_iter = map(
-        lambda sent: unicodedata.normalize("NFKD", sent.text), 
-        document.sents
+        lambda sent: unicodedata.normalize("NFKD", sent), 
+        sentences
     )
     sentences = [ re.sub(r"  +", '', sent).replace('\n', '') for sent in sentences_iter ]
     sentences = [ sent for sent in sentences if len(sent.split(' ')) > valid_length]
     return sentences
 
+def to_sentences(text:str, spacy_model:Language, valid_length:str) -> List[str]:
+    document = spacy_model(text)
+    return clean_sentences((sent.text for sent in document.sents), valid_length)
+
+def to_sentences_batch(texts:List[str], spacy_model:Language, valid_length:int, batch_size:int=32, n_process:int=1) -> List[List[str]]:
+    documents = spacy_model.pipe(texts, batch_size=batch_size, n_process=n_process)
+    return [ clean_sentences((sent.text for sent in document.sents), valid_length) for document in documents ]
+
+def estimate_nb_sentences(text:str) -> int:
+    # cheap estimate used to route long documents before any spacy call : it counts the runs of punctuation and of line breaks, 
+    # so it may differ from the number of sentences of the splitter (abbreviations, missing final punctuation, short fragments) 
+    return len(re.findall(r'[.!?]+|\n+', text))
+
+def split_text(text:str, chunk_length:int) -> Iterator[str]:
+    # cuts on line breaks (or sentence ends) so that spacy never sees the whole text 
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_length, len(text))
+        if end < len(text):
+            boundary = max(text.rfind('\n', start, end), text.rfind('. ', start, end))
+            if boundary > start:
+                end = boundary + 1
+        yield text[start:end]
+        start = end 
+
+def stream_sentences(text:str, spacy_model:Language, valid_length:int, chunk_length:int=100000, batch_size:int=4) -> Iterator[str]:
+    documents = spacy_model.pipe(split_text(text, chunk_length), batch_size=batch_size)
+    for document in documents:
+        yield from clean_sentences((sent.text for sent in document.sents), valid_length)
+
+def batchify(items:Iterable[Any], batch_size:int) -> Iterator[List[Any]]:
+    items_iter = iter(items)
+    batch = list(it.islice(items_iter, batch_size))
+    while len(batch) > 0:
+        yield batch 
+        batch = list(it.islice(items_iter, batch_size))
+
+def normalize_embeddings(embeddings:np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / (norms + 1e-8)
+
+def compute_streaming_textrank_embedding(embedding_chunks:Iterable[np.ndarray]) -> Optional[np.ndarray]:
+    # degree weighting without the n x n matrix : with normalized embeddings u_i and s = sum_j u_j 
+    # score_i = u_i . s / n and the document embedding is sum_i e_i * score_i / n = (sum_i e_i u_i^T) s / n^2 
+    # memory grows with the chunk size and the dimension, never with the number of sentences 
+    nb_nodes = 0
+    normalized_sum = None 
+    outer_sum = None 
+    for embeddings in embedding_chunks:
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        normalized_embeddings = normalize_embeddings(embeddings)
+        if outer_sum is None:
+            normalized_sum = np.zeros(embeddings.shape[1])
+            outer_sum = np.zeros((embeddings.shape[1], embeddings.shape[1]))
+        normalized_sum += normalized_embeddings.sum(axis=0)
+        outer_sum += embeddings.T @ normalized_embeddings
+        nb_nodes += len(embeddings)
+    
+    if nb_nodes == 0:
+        return None 
+    return (outer_sum @ normalized_sum / nb_nodes ** 2).astype(np.float32)
+
+def compute_degree_scores(embeddings:np.ndarray) -> np.ndarray:
+    # mean cosine similarity of each sentence to the others without the n x n matrix : score_i = u_i . s / n 
+    normalized_embeddings = normalize_embeddings(np.asarray(embeddings, dtype=np.float64))
+    return normalized_embeddings @ normalized_embeddings.sum(axis=0) / len(normalized_embeddings)
+
 def compute_fingerprint(document:List[str], vectorizer:SentenceTransformer, device:str='cpu') -> np.ndarray:
     embedding = vectorizer.encode(
         sentences=document,
@@ -46,14 +113,164 @@ def compute_pairwise_matrix(embeddings:np.ndarray) -> np.ndarray:
     similarity_matrix =  dot_scores / (norms + 1e-8)
     return similarity_matrix 
 
-def semantic_textrank(adjacency_matrix:np.ndarray) -> List[Tuple[int, float]]:
-    nb_nodes = len(adjacency_matrix)
-    initial_scores = np.sum(adjacency_matrix, axis=1) / nb_nodes
+def make_token_budget_batches(token_lengths:np.ndarray, token_budget:int, max_batch_size:int) -> List[np.ndarray]:
+    # length buckets : sentences sorted by token length, longest first 
+    # a batch is cut as soon as its padded size (nb_sentences x longest sentence) would exceed the token budget 
+    sorted_indices = np.argsort(-np.asarray(token_lengths), kind='stable')
+    batches = []
+    start = 0 
+    while start < len(sorted_indices):
+        longest = max(int(token_lengths[sorted_indices[start]]), 1)
+        nb_sentences = min(max(token_budget // longest, 1), max_batch_size)
+        batches.append(sorted_indices[start:start + nb_sentences])
+        start += nb_sentences
+    return batches 
 
-    graph:nx.Graph = nx.from_numpy_array(adjacency_matrix)
-    for node in graph.nodes():
-        graph.nodes[node]['weight'] = initial_scores[node]
+class EncodeScheduler:
+    # encoder : any backend of libraries.encoders (torch, quantized, onnx) 
+    # sentences are tokenized once up front and encoded in token-budget batches, embeddings come back in the original order 
+    def __init__(self, encoder:Any, token_budget:int=8192, max_batch_size:int=256, on_batch:Optional[Callable[[int], None]]=None):
+        self.encoder = encoder 
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.on_batch = on_batch  # called with the number of sentences of each encode call 
+        self.counters = {'sentences': 0, 'batches': 0, 'tokens': 0, 'padded_tokens': 0}
+        self.duration = 0.0 
+
+    def encode(self, sentences:List[str]) -> np.ndarray:
+        start = perf_counter()
+        input_ids = self.encoder.tokenize(sentences)
+        token_lengths = np.array([ len(ids) for ids in input_ids ], dtype=np.int64)
+        embeddings = None 
+        for indices in make_token_budget_batches(token_lengths, self.token_budget, self.max_batch_size):
+            batch_embeddings = self.encoder.encode_tokenized([ input_ids[idx] for idx in indices ])
+            if embeddings is None:
+                embeddings = np.empty((len(sentences), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+            embeddings[indices] = batch_embeddings
+            self.counters['batches'] += 1 
+            self.counters['padded_tokens'] += len(indices) * int(token_lengths[indices[0]])
+            if self.on_batch is not None:
+                self.on_batch(len(indices))
+        
+        self.counters['sentences'] += len(sentences)
+        self.counters['tokens'] += int(np.sum(token_lengths))
+        self.duration += perf_counter() - start 
+        return embeddings 
+
+    def stats(self) -> Dict[str, float]:
+        padding_ratio = 1 - self.counters['tokens'] / max(self.counters['padded_tokens'], 1)
+        tokens_per_second = self.counters['tokens'] / max(self.duration, 1e-9)
+        return dict(self.counters, padding_ratio=round(padding_ratio, 4), tokens_per_second=round(tokens_per_second, 1))
+
+def batched_pagerank(adjacency_matrices:np.ndarray, nb_nodes:Optional[np.ndarray]=None, alpha:float=0.85, personalization:Optional[np.ndarray]=None, tol:float=1e-6, max_iter:int=100) -> np.ndarray:
+    # power method over a batch of padded graphs : adjacency_matrices (b, n, n), nb_nodes (b,) valid nodes per graph 
+    # same model as nx.pagerank on weighted graphs : negative similarities are clipped, dangling mass follows the personalization 
+    nb_graphs, max_nodes, _ = adjacency_matrices.shape
+    if nb_nodes is None:
+        nb_nodes = np.full(nb_graphs, max_nodes)
+    node_mask = (np.arange(max_nodes)[None, :] < nb_nodes[:, None]).astype(np.float64)
+
+    weights = np.clip(adjacency_matrices, 0, None) * node_mask[:, :, None] * node_mask[:, None, :]
+    out_weights = np.sum(weights, axis=2, keepdims=True)
+    transition_matrices = np.divide(weights, out_weights, out=np.zeros_like(weights), where=out_weights > 0)
+    dangling_mask = (out_weights[:, :, 0] == 0) * node_mask
+
+    if personalization is None:
+        personalization = node_mask
+    personalization = personalization * node_mask
+    personalization = personalization / np.sum(personalization, axis=1, keepdims=True)
+
+    scores = node_mask / nb_nodes[:, None]
+    for _ in range(max_iter):
+        dangling_mass = np.sum(scores * dangling_mask, axis=1, keepdims=True)
+        propagated_scores = np.matmul(scores[:, None, :], transition_matrices)[:, 0, :]
+        next_scores = alpha * (propagated_scores + dangling_mass * personalization) + (1 - alpha) * personalization
+        errors = np.sum(np.abs(next_scores - scores), axis=1)
+        scores = next_scores
+        if np.all(errors < nb_nodes * tol):  # early stopping : every graph has converged 
+            break 
+    return scores 
+
+def power_pagerank(adjacency_matrix:np.ndarray, alpha:float=0.85, personalization:Optional[np.ndarray]=None, tol:float=1e-6, max_iter:int=100) -> np.ndarray:
+    if personalization is not None:
+        personalization = personalization[None, :]
+    scores = batched_pagerank(adjacency_matrix[None, :, :], alpha=alpha, personalization=personalization, tol=tol, max_iter=max_iter)
+    return scores[0]
+
+def add_timing(timings:Optional[Dict[str, float]], stage:str, start:float) -> float:
+    # accumulates the time spent in a stage since start, returns the new start 
+    now = perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start 
+    return now 
+
+def compute_textrank_embeddings(embeddings_per_document:List[np.ndarray], weighting:str='degree', alpha:float=0.9, max_elements:int=4000000, timings:Optional[Dict[str, float]]=None) -> List[np.ndarray]:
+    # timings : optional accumulator of the time spent in the 'pairwise' and 'weighting' stages 
+    if weighting == 'degree':
+        return [ compute_textrank_embedding(embeddings, timings=timings) for embeddings in embeddings_per_document ]
+    
+    if weighting != 'pagerank':
+        raise ValueError(f'unknown weighting : {weighting}')
     
-    node_scores = nx.pagerank(graph, alpha=0.9)
-    return list(node_scores.keys()), list(node_scores.values())
+    # documents of similar sizes are padded together, a group holds at most max_elements adjacency cells 
+    sorted_indices = sorted(range(len(embeddings_per_document)), key=lambda idx: len(embeddings_per_document[idx]))
+    groups = []
+    for idx in sorted_indices:
+        nb_nodes = len(embeddings_per_document[idx])
+        if len(groups) > 0 and (len(groups[-1]) + 1) * nb_nodes ** 2 <= max_elements:
+            groups[-1].append(idx)
+        else:
+            groups.append([idx])
+    
+    document_embeddings = [None] * len(embeddings_per_document)
+    for group in groups:
+        start = perf_counter()
+        nb_nodes = np.array([ len(embeddings_per_document[idx]) for idx in group ])
+        adjacency_matrices = np.zeros((len(group), nb_nodes.max(), nb_nodes.max()), dtype=np.float32)
+        for row, idx in enumerate(group):
+            adjacency_matrices[row, :nb_nodes[row], :nb_nodes[row]] = compute_pairwise_matrix(embeddings_per_document[idx])
+        start = add_timing(timings, 'pairwise', start)
+        scores = batched_pagerank(adjacency_matrices, nb_nodes=nb_nodes, alpha=alpha)
+        for row, idx in enumerate(group):
+            # pagerank scores sum to 1 : weighted average of the sentence embeddings 
+            document_embeddings[idx] = (scores[row, :nb_nodes[row]] @ embeddings_per_document[idx]).astype(np.float32)
+        add_timing(timings, 'weighting', start)
+    return document_embeddings 
+
+def compute_textrank_embedding(embeddings:np.ndarray, weighting:str='degree', timings:Optional[Dict[str, float]]=None) -> np.ndarray:
+    if weighting != 'degree':
+        return compute_textrank_embeddings([embeddings], weighting=weighting, timings=timings)[0]
+    nb_nodes = len(embeddings)
+    if nb_nodes == 1:
+        return embeddings[0]
+    start = perf_counter()
+    adjacency_matrix = compute_pairwise_matrix(embeddings)
+    start = add_timing(timings, 'pairwise', start)
+    scores = np.sum(adjacency_matrix, axis=1) / nb_nodes 
+    embedding = np.mean(embeddings * scores[:, None], axis=0)
+    add_timing(timings, 'weighting', start)
+    return embedding 
+
+def semantic_textrank(adjacency_matrix:np.ndarray, alpha:float=0.9, personalization:Optional[np.ndarray]=None) -> Tuple[List[int], List[float]]:
+    node_scores = power_pagerank(adjacency_matrix, alpha=alpha, personalization=personalization)
+    return list(range(len(node_scores))), node_scores.tolist()
 
+def compute_textrank_details(embeddings:np.ndarray, weighting:str='degree', alpha:float=0.9, timings:Optional[Dict[str, float]]=None) -> Tuple[np.ndarray, np.ndarray]:
+    # one similarity matrix for both the document embedding and the ranking of its sentences by semantic_textrank 
+    if weighting not in ['degree', 'pagerank']:
+        raise ValueError(f'unknown weighting : {weighting}')
+    nb_nodes = len(embeddings)
+    if nb_nodes == 1:
+        return embeddings[0], np.ones(1)
+    start = perf_counter()
+    adjacency_matrix = compute_pairwise_matrix(embeddings)
+    start = add_timing(timings, 'pairwise', start)
+    _, node_scores = semantic_textrank(adjacency_matrix, alpha=alpha)
+    sentence_scores = np.array(node_scores)
+    if weighting == 'pagerank':
+        embedding = (sentence_scores @ embeddings).astype(np.float32)
+    else:
+        degree_scores = np.sum(adjacency_matrix, axis=1) / nb_nodes 
+        embedding = np.mean(embeddings * degree_scores[:, None], axis=0)
+    add_timing(timings, 'weighting', start)
+    return embedding, sentence_scores 
@@ -0,0 +1,53 @@
+import json
+
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Tuple
+
+# wire format of a vectorizer reply : [header, buffer_0, ..., buffer_k]
+# the json header describes every item (status, dtype, shape), each successful item is followed by its raw buffer
+# an item may carry details (ranked sentences...) : their sentence embeddings follow the document embedding as a second buffer
+
+def encode_reply(header:Dict[str, Any], embeddings:List[Optional[np.ndarray]], precision:str='float32', details:Optional[List[Optional[Dict[str, Any]]]]=None) -> List[Any]:
+    items = []
+    buffers = []
+    details = details if details is not None else [None] * len(embeddings)
+    for embedding, item_details in zip(embeddings, details):
+        if embedding is None:
+            items.append({'status': False})
+            continue
+        embedding = np.ascontiguousarray(embedding, dtype=precision)
+        item = {'status': True, 'dtype': embedding.dtype.name, 'shape': list(embedding.shape)}
+        buffers.append(embedding)  # numpy arrays expose the buffer protocol : zeromq sends them without copy
+        if item_details is not None:
+            item['details'] = { key: value for key, value in item_details.items() if key != 'sentence_embeddings' }
+            if item_details.get('sentence_embeddings', None) is not None:
+                sentence_embeddings = np.ascontiguousarray(item_details['sentence_embeddings'], dtype=precision)
+                item['details']['sentence_embeddings'] = {'dtype': sentence_embeddings.dtype.name, 'shape': list(sentence_embeddings.shape)}
+                buffers.append(sentence_embeddings)
+        items.append(item)
+
+    encoded_header = json.dumps(dict(header, items=items)).encode()
+    return [encoded_header] + buffers
+
+def decode_reply(frames:List[Any]) -> Tuple[Dict[str, Any], Optional[List[Optional[np.ndarray]]], Optional[List[Optional[Dict[str, Any]]]]]:
+    header = json.loads(bytes(frames[0]))
+    if header.get('transport') == 'shm':
+        return header, None, None  # the embeddings live in a shared memory slot : see libraries.shm 
+    buffers = iter(frames[1:])
+    embeddings = []
+    details = []
+    for item in header['items']:
+        if not item['status']:
+            embeddings.append(None)
+            details.append(None)
+            continue
+        # read-only view on the zeromq frame, no copy
+        embedding = np.frombuffer(next(buffers), dtype=item['dtype']).reshape(item['shape'])
+        embeddings.append(embedding)
+        item_details = item.get('details', None)
+        if item_details is not None and 'sentence_embeddings' in item_details:
+            layout = item_details['sentence_embeddings']
+            item_details['sentence_embeddings'] = np.frombuffer(next(buffers), dtype=layout['dtype']).reshape(layout['shape'])
+        details.append(item_details)
+    return header, embeddings, details
@@ -1,8 +1,5 @@
+import sys
 import click 
-import uvicorn
-
-import torch as th 
-import torch.multiprocessing as tmp 
 
 from loguru import logger 
 from typing import List, Tuple, Dict, Optional 
@@ -13,8 +10,23 @@ from time import perf_counter, sleep
 
 import multiprocessing as mp 
 
-from server import start_server
-from vectorizer import start_vectorizer
+from libraries.backends import SENTENCE_SPLITTERS, ENCODER_BACKENDS
+from libraries.registry import load_model_registry
+
+# the processes are spawned : each one imports only the modules of its role 
+# the server never imports torch, spacy or sentence-transformers 
+
+def run_server(**kwargs):
+    from server import start_server
+    start_server(**kwargs)
+
+def run_broker(**kwargs):
+    from broker import start_broker
+    start_broker(**kwargs)
+
+def run_vectorizer(**kwargs):
+    from vectorizer import start_vectorizer
+    start_vectorizer(**kwargs)
 
 @click.group(chain=False, invoke_without_command=True)
 @click.option('--transformers_cache', envvar='TRANSFORMERS_CACHE', required=True)
@@ -34,65 +46,264 @@ def command_line_interface(ctx:click.core.Context, transformers_cache:str, gpu_i
 @click.option('--transformer_model_name', type=str, default='Sahajtomar/french_semantic')
 @click.option('--language_model_name', type=str, default='fr_core_news_md')
 @click.option('--router_address', type=str, default='ipc://router.ipc')
+@click.option('--backend_address', type=str, default='ipc://backend.ipc')
 @click.option('--publisher_address', type=str, default='ipc://publisher.ipc')
 @click.option('--mounting_path', type=str, default='/')
+@click.option('--model_registry', help='json file of named model pairs, each one served by its own broker and vectorizers, the options below are the defaults of every model', type=click.Path(exists=True, dir_okay=False), default=None)
+@click.option('--idle_timeout', help='time (s) without request after which a vectorizer unloads its models, they are reloaded by the next request', type=click.IntRange(min=1), default=None)
+@click.option('--request_timeout', help='default deadline (ms) of a request when the client does not set timeout_ms', type=click.IntRange(min=1), default=60000)
+@click.option('--max_inflight', help='maximum number of requests forwarded to the vectorizers at the same time, default : 2 * num_vectorizers * max_batch_size', type=click.IntRange(min=1), default=None)
+@click.option('--max_queue_depth', help='maximum number of requests waiting for admission, beyond that the server answers 429', type=click.IntRange(min=0), default=1024)
+@click.option('--max_queue_wait', help='maximum time (ms) a request waits for admission before a 429', type=click.IntRange(min=0), default=10000)
+@click.option('--job_chunk_size', help='number of texts of a job sent to the vectorizers per request', type=click.IntRange(min=1), default=32)
+@click.option('--max_running_jobs', help='number of jobs processed at the same time, the others stay pending', type=click.IntRange(min=1), default=4)
+@click.option('--max_jobs', help='maximum number of jobs held by the job store', type=click.IntRange(min=1), default=1000)
+@click.option('--job_store_size', help='maximum size (MB) of the texts and results held by the job store', type=click.IntRange(min=1), default=512)
+@click.option('--job_ttl', help='time (s) the results of a finished job are kept', type=click.IntRange(min=1), default=3600)
+@click.option('--index_path', help='folder of the vector index of each model, enables the /index routes', type=click.Path(file_okay=False), default=None)
+@click.option('--index_nlist', help='number of clusters of the approximate (ivf) search, 0 keeps the exact search', type=click.IntRange(min=0), default=0)
+@click.option('--index_nprobe', help='number of clusters scanned by a query in ivf mode', type=click.IntRange(min=1), default=8)
+@click.option('--max_batch_size', help='maximum number of requests the vectorizer packs into one encode call', type=click.IntRange(min=1), default=32)
+@click.option('--max_batch_wait', help='maximum time (ms) the vectorizer waits for pending requests to fill a batch', type=click.IntRange(min=0), default=5)
+@click.option('--num_vectorizers', help='number of vectorizer processes (model replicas) behind the broker', type=click.IntRange(min=1), default=1)
+@click.option('--num_threads', help='number of torch threads per vectorizer, default : cpu_count // num_vectorizers', type=click.IntRange(min=1), default=None)
+@click.option('--cache_size', help='size (MB) of the in-memory embedding cache of each vectorizer, 0 disables the cache', type=click.IntRange(min=0), default=0)
+@click.option('--cache_path', help='folder of the on-disk embedding store, the store survives restarts', type=click.Path(file_okay=False), default=None)
+@click.option('--cache_disk_capacity', help='maximum number of embeddings held by the on-disk store of each vectorizer', type=click.IntRange(min=1), default=1000000)
+@click.option('--streaming_threshold', help='estimated number of sentences above which a document is embedded in streaming mode', type=click.IntRange(min=1), default=2000)
+@click.option('--streaming_chunk_size', help='number of sentences encoded per chunk in streaming mode', type=click.IntRange(min=1), default=256)
+@click.option('--sentence_splitter', help='sentence splitting backend : full, parser (spacy model reduced to its parser), senter, sentencizer or regex', type=click.Choice(SENTENCE_SPLITTERS), default='parser')
+@click.option('--spacy_n_process', help='number of processes used by nlp.pipe inside each vectorizer', type=click.IntRange(min=1), default=1)
+@click.option('--spacy_batch_size', help='batch size of nlp.pipe', type=click.IntRange(min=1), default=32)
+@click.option('--encoder_backend', help='inference backend of the sentence transformer : torch (fp32), quantized (dynamic int8, cpu), onnx (onnxruntime, cpu) or mock (deterministic fake model for benchmarks)', type=click.Choice(ENCODER_BACKENDS), default='torch')
+@click.option('--token_budget', help='maximum number of (padded) tokens per encode call, sentences are bucketed by token length', type=click.IntRange(min=1), default=8192)
+@click.option('--max_encode_batch_size', help='maximum number of sentences per encode call', type=click.IntRange(min=1), default=256)
+@click.option('--mock_token_latency', help='simulated compute time (ms) per token of the mock encoder', type=click.FloatRange(min=0), default=0.0)
+@click.option('--warmup_lengths', help='comma separated sequence lengths (tokens) of the dummy encodes run before a vectorizer reports ready, empty to disable', type=str, default='16,64,256')
+@click.option('--onnx_num_threads', help='intra-op threads of the onnxruntime session, default : num_threads', type=click.IntRange(min=1), default=None)
+@click.option('--transport', help='how the vectorizers hand the embeddings to the server : inline (zeromq frames) or shm (shared memory slots, single host)', type=click.Choice(['inline', 'shm']), default='inline')
+@click.option('--shm_slots', help='number of shared memory slots per vectorizer', type=click.IntRange(min=1), default=128)
+@click.option('--shm_slot_size', help='size (KB) of a shared memory slot, bigger replies fall back to the inline transport', type=click.IntRange(min=1), default=256)
 @click.pass_context
-def start_services(ctx:click.core.Context, port:int, hostname:str, transformer_model_name:str, language_model_name:str, router_address:str, publisher_address:str, mounting_path:str):
+def start_services(ctx:click.core.Context, port:int, hostname:str, transformer_model_name:str, language_model_name:str, router_address:str, backend_address:str, publisher_address:str, mounting_path:str, model_registry:Optional[str], idle_timeout:Optional[int], request_timeout:int, max_inflight:Optional[int], max_queue_depth:int, max_queue_wait:int, job_chunk_size:int, max_running_jobs:int, max_jobs:int, job_store_size:int, job_ttl:int, index_path:Optional[str], index_nlist:int, index_nprobe:int, max_batch_size:int, max_batch_wait:int, num_vectorizers:int, num_threads:Optional[int], cache_size:int, cache_path:Optional[str], cache_disk_capacity:int, streaming_threshold:int, streaming_chunk_size:int, sentence_splitter:str, spacy_n_process:int, spacy_batch_size:int, encoder_backend:str, onnx_num_threads:Optional[int], token_budget:int, max_encode_batch_size:int, mock_token_latency:float, warmup_lengths:str, transport:str, shm_slots:int, shm_slot_size:int):
     assert mounting_path.startswith('/')
+    if transport == 'shm' and sys.version_info < (3, 8):
+        raise click.BadParameter('the shared memory transport needs python >= 3.8', param_hint='--transport')
     cache_folder = ctx.obj['cache_folder']
+    defaults = {
+        'transformer_model_name': transformer_model_name,
+        'language_model_name': language_model_name,
+        'sentence_splitter': sentence_splitter,
+        'encoder_backend': encoder_backend,
+        'num_vectorizers': num_vectorizers,
+        'num_threads': num_threads,
+        'idle_timeout': idle_timeout,
+        'router_address': router_address,
+        'backend_address': backend_address,
+        'publisher_address': publisher_address
+    }
+    try:
+        default_model, map_model2settings = load_model_registry(model_registry, defaults)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--model_registry')
     
-    workers_barrier = mp.Barrier(parties=2)
+    total_num_vectorizers = sum( settings['num_vectorizers'] for settings in map_model2settings.values() )
+    if max_inflight is None:
+        max_inflight = 2 * total_num_vectorizers * max_batch_size  # enough to fill the next batch of every vectorizer 
+    
+    workers_barrier = mp.Barrier(parties=total_num_vectorizers + len(map_model2settings) + 1)  # server + brokers + vectorizers 
 
     server_process = mp.Process(
-        target=start_server, 
+        target=run_server, 
         kwargs={
             'port': port, 
             'hostname': hostname, 
             'mounting_path': mounting_path, 
-            'router_address': router_address, 
-            'publisher_address': publisher_address,
-            'workers_barrier': workers_barrier
-        }
-    ) 
-    
-    vectorizer_process = mp.Process(
-        target=start_vectorizer,
-        kwargs={
-            'transformer_model_name': transformer_model_name,
-            'language_model_name': language_model_name, 
-            'cache_folder': cache_folder,
-            'router_address': router_address, 
-            'publisher_address': publisher_address,
+            'models': { model_name: {key: settings[key] for key in ['router_address', 'publisher_address']} for model_name, settings in map_model2settings.items() },
+            'default_model': default_model,
             'workers_barrier': workers_barrier,
-            'gpu_index': ctx.obj['gpu_index']
+            'request_timeout': request_timeout,
+            'max_inflight': max_inflight,
+            'max_queue_depth': max_queue_depth,
+            'max_queue_wait': max_queue_wait,
+            'job_chunk_size': job_chunk_size,
+            'max_running_jobs': max_running_jobs,
+            'max_jobs': max_jobs,
+            'job_store_size': job_store_size,
+            'job_ttl': job_ttl,
+            'index_path': index_path,
+            'index_nlist': index_nlist,
+            'index_nprobe': index_nprobe
         }
-    )
+    ) 
+
+    # one broker and its vectorizers per model 
+    broker_processes = []
+    vectorizer_processes = []
+    map_model2processes:Dict[str, List[mp.Process]] = {}  # the broker of each model followed by its vectorizers 
+    for model_name, settings in map_model2settings.items():
+        model_num_threads = settings['num_threads']
+        if model_num_threads is None:
+            model_num_threads = max(1, mp.cpu_count() // total_num_vectorizers)
+        # the on-disk store is not shared : each vectorizer owns its files 
+        cache_prefix = '' if model_registry is None else f'{model_name}-'
+        
+        broker_process = mp.Process(
+            target=run_broker,
+            kwargs={
+                'router_address': settings['router_address'],
+                'backend_address': settings['backend_address'],
+                'publisher_address': settings['publisher_address'],
+                'workers_barrier': workers_barrier
+            }
+        )
+        model_vectorizer_processes = [
+            mp.Process(
+                target=run_vectorizer,
+                kwargs={
+                    'transformer_model_name': settings['transformer_model_name'],
+                    'language_model_name': settings['language_model_name'], 
+                    'cache_folder': cache_folder,
+                    'backend_address': settings['backend_address'], 
+                    'workers_barrier': workers_barrier,
+                    'gpu_index': ctx.obj['gpu_index'],
+                    'num_threads': model_num_threads,
+                    'max_batch_size': max_batch_size,
+                    'max_batch_wait': max_batch_wait,
+                    'cache_size': cache_size,
+                    'cache_path': path.join(cache_path, f'{cache_prefix}vectorizer-{worker_index:02d}') if cache_path is not None else None,
+                    'cache_disk_capacity': cache_disk_capacity,
+                    'streaming_threshold': streaming_threshold,
+                    'streaming_chunk_size': streaming_chunk_size,
+                    'sentence_splitter': settings['sentence_splitter'],
+                    'spacy_n_process': spacy_n_process,
+                    'spacy_batch_size': spacy_batch_size,
+                    'encoder_backend': settings['encoder_backend'],
+                    'onnx_num_threads': onnx_num_threads,
+                    'token_budget': token_budget,
+                    'max_encode_batch_size': max_encode_batch_size,
+                    'mock_token_latency': mock_token_latency,
+                    'warmup_lengths': [ int(length) for length in warmup_lengths.split(',') if length.strip() != '' ],
+                    'transport': transport,
+                    'shm_slots': shm_slots,
+                    'shm_slot_size': shm_slot_size,
+                    'idle_timeout': settings['idle_timeout']
+                }
+            )
+            for worker_index in range(settings['num_vectorizers'])
+        ]
+        broker_processes.append(broker_process)
+        vectorizer_processes.extend(model_vectorizer_processes)
+        map_model2processes[model_name] = [broker_process] + model_vectorizer_processes
+        logger.debug(f"model {model_name} : {settings['transformer_model_name']} + {settings['language_model_name']} on {settings['num_vectorizers']} vectorizers ({settings['router_address']})")
+    processes = [server_process] + broker_processes + vectorizer_processes
 
     try:
-        vectorizer_process.start()
+        for broker_process in broker_processes:
+            broker_process.start()
+        for vectorizer_process in vectorizer_processes:
+            vectorizer_process.start()
         server_process.start()
 
+        # a model is down once its broker or all its vectorizers are gone, the server keeps serving the other models 
+        nb_alive_vectorizers = total_num_vectorizers
+        alive_models = set(map_model2processes.keys())
         keep_loop = True 
         while keep_loop:
             sleep(1)
-            if not vectorizer_process.is_alive() or not server_process.is_alive():
+            alive_vectorizers = [ process for process in vectorizer_processes if process.is_alive() ]
+            if len(alive_vectorizers) < nb_alive_vectorizers:
+                nb_alive_vectorizers = len(alive_vectorizers)
+                logger.warning(f'a vectorizer is down, {nb_alive_vectorizers}/{total_num_vectorizers} vectorizers are still alive')
+            for model_name in sorted(alive_models):
+                broker_process, *model_vectorizer_processes = map_model2processes[model_name]
+                if broker_process.is_alive() and any( process.is_alive() for process in model_vectorizer_processes ):
+                    continue 
+                logger.error(f'model {model_name} is down, the server keeps serving the other models')
+                alive_models.discard(model_name)
+                for process in model_vectorizer_processes:
+                    process.terminate()  # without their broker, the vectorizers can not receive any request 
+            if len(alive_models) == 0 or not server_process.is_alive():
                 keep_loop = False 
         # ...!
         logger.warning('some problems to start all workrs')
         workers_barrier.abort()
     except KeyboardInterrupt:
         logger.debug('ctl+c ...!') 
-        vectorizer_process.join()
-        server_process.join()
+        for process in processes:
+            process.join()
     except Exception as e:
         logger.error(e)
     finally:
-        vectorizer_process.terminate()
-        server_process.terminate()
-        vectorizer_process.join()
-        server_process.join()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+@command_line_interface.command()
+@click.option('--transformer_model_name', type=str, default='Sahajtomar/french_semantic')
+@click.option('--language_model_name', type=str, default='fr_core_news_md')
+@click.option('--sentence_splitter', help='the spacy pipeline is saved reduced to the components of this splitter', type=click.Choice(SENTENCE_SPLITTERS), default='parser')
+@click.option('--encoder_backend', help='onnx also exports the onnx graph', type=click.Choice(ENCODER_BACKENDS), default='torch')
+@click.option('--model_registry', help='prepares every model of the registry, the options above are their defaults', type=click.Path(exists=True, dir_okay=False), default=None)
+@click.pass_context
+def prepare_models(ctx:click.core.Context, transformer_model_name:str, language_model_name:str, sentence_splitter:str, encoder_backend:str, model_registry:Optional[str]):
+    # downloads the models and saves snapshots that start-services loads from disk 
+    from libraries.snapshots import prepare_transformer_snapshot, prepare_spacy_snapshot
+
+    cache_folder = ctx.obj['cache_folder']
+    defaults = {
+        'transformer_model_name': transformer_model_name,
+        'language_model_name': language_model_name,
+        'sentence_splitter': sentence_splitter,
+        'encoder_backend': encoder_backend
+    }
+    try:
+        _, map_model2settings = load_model_registry(model_registry, defaults)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--model_registry')
+    
+    for model_name, settings in map_model2settings.items():
+        logger.debug(f"model {model_name} : {settings['transformer_model_name']} + {settings['language_model_name']}")
+        prepare_spacy_snapshot(settings['language_model_name'], settings['sentence_splitter'], cache_folder)
+        if settings['encoder_backend'] != 'mock':
+            prepare_transformer_snapshot(settings['transformer_model_name'], cache_folder)
+        if settings['encoder_backend'] == 'onnx':
+            from libraries.encoders import load_encoder
+            load_encoder('onnx', settings['transformer_model_name'], cache_folder, device=None)  # exports the graph once 
+    logger.success('models are ready, start-services will load them from the snapshots')
+
+@command_line_interface.command()
+@click.option('--transformer_model_name', type=str, default='Sahajtomar/french_semantic')
+@click.option('--encoder_backend', help='backend compared to the fp32 torch reference', type=click.Choice(ENCODER_BACKENDS), default='onnx')
+@click.option('--num_threads', type=click.IntRange(min=1), default=None)
+@click.option('--repeat', help='number of copies of the sample corpus', type=click.IntRange(min=1), default=5)
+@click.option('--min_cosine', help='the check fails if the mean cosine agreement is below this value', type=click.FloatRange(min=-1, max=1), default=0.99)
+@click.pass_context
+def check_encoder(ctx:click.core.Context, transformer_model_name:str, encoder_backend:str, num_threads:Optional[int], repeat:int, min_cosine:float):
+    from libraries.corpus import french_paragraphs
+    from libraries.splitters import SentenceSplitter
+    from libraries.encoders import load_encoder, check_encoder_agreement
+    import torch as th 
+
+    if num_threads is not None:
+        th.set_num_threads(num_threads)
+    device = th.device('cpu')
+    splitter = SentenceSplitter('regex', language_model_name='fr')
+    sentences = [ sent for sentences in splitter.split_many(french_paragraphs * repeat) for sent in sentences ]
+
+    reference_encoder = load_encoder('torch', transformer_model_name, ctx.obj['cache_folder'], device)
+    candidate_encoder = load_encoder(encoder_backend, transformer_model_name, ctx.obj['cache_folder'], device, num_threads=num_threads)
+    reference_encoder.encode(sentences[:32])  # warmup 
+    candidate_encoder.encode(sentences[:32])
+
+    report = check_encoder_agreement(reference_encoder, candidate_encoder, sentences)
+    logger.info(f"{encoder_backend} vs torch on {report['nb_sentences']} sentences : mean cosine {report['mean_cosine']:.5f} | min {report['min_cosine']:.5f} | p01 {report['p01_cosine']:.5f} | speedup x{report['speedup']:.2f}")
+    if report['mean_cosine'] < min_cosine:
+        logger.error(f'{encoder_backend} backend disagrees with the fp32 reference : {report["mean_cosine"]:.5f} < {min_cosine}')
+        ctx.exit(1)
+    logger.success(f'{encoder_backend} backend is approved')
 
 if __name__ == '__main__':
-    if th.cuda.is_available():
-        tmp.set_start_method('spawn')
+    mp.set_start_method('spawn')  # a forked child would inherit the imports of the parent, and cuda does not support fork 
     command_line_interface()
\ No newline at end of file
@@ -4,23 +4,76 @@ from asyncio import Lock, Semaphore, Condition, Event
 import zmq 
 import zmq.asyncio as aiozmq  
 
-import pickle 
+import json 
 import time 
+import base64 
 import uvicorn
 
+import numpy as np 
+
 import multiprocessing as mp 
 from os import path 
+from functools import partial
+from uuid import uuid4
+from contextlib import AsyncExitStack
+from typing import List, Tuple, Dict, Optional, Any, Callable 
 
-from fastapi import FastAPI, APIRouter, UploadFile, BackgroundTasks
+from fastapi import FastAPI, APIRouter, UploadFile, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import Response, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.openapi.utils import get_openapi
 
 from loguru import logger 
 
-from api_schema import ServerStatus
+try:
+    import msgpack  # optional : application/x-msgpack responses 
+except ImportError:
+    msgpack = None 
+
+from libraries.transport import decode_reply
+from libraries.shm import SharedEmbeddingReader
+from libraries.admission import AdmissionController, AdmissionRejected, PRIORITY_RANKS
+from libraries.metrics import MetricsRegistry, render_metrics
+from libraries.jobs import Job, JobStore
+from libraries.index import VectorIndex
+
+from api_schema import ServerStatus, EmbeddingFormat, GenericResponseModel, SentenceModel, SentenceDetailsRequestModel
 from api_schema import EntrypointResponseModel, EntrypointResponseContentModel 
 from api_schema import ComputeEmbeddingRequestModel, ComputeEmbeddingResponseModel, ComputeEmbeddingResponseContentModel
+from api_schema import ComputeEmbeddingsRequestModel, ComputeEmbeddingsResponseModel
+from api_schema import RequestPriority, JobRequestModel, JobResponseModel, JobContentModel
+from api_schema import IndexAddRequestModel, IndexQueryRequestModel, IndexSnapshotRequestModel, IndexResponseModel, IndexContentModel
+
+class UnknownModel(Exception):
+    def __init__(self, model:str, models:List[str]):
+        super(UnknownModel, self).__init__(f'unknown model {model}, available models : {models}')
+        self.model = model 
+
+class ModelChannel:
+    # sockets and state of the server towards the broker of one model 
+    def __init__(self, name:str, router_address:str, publisher_address:str):
+        self.name = name 
+        self.router_address = router_address
+        self.publisher_address = publisher_address
+        self.pending_requests:Dict[str, aio.Future] = {}
+        self.broker_status = {'workers': 0, 'credits': 0}  # READY once a vectorizer has loaded and warmed up its models 
+        self.map_worker2metrics:Dict[str, Dict[str, Any]] = {}  # latest snapshot pushed by each vectorizer 
+
+    def connect(self, ctx:aiozmq.Context):
+        # long-lived sockets shared by all the requests 
+        self.dealer_socket:aiozmq.Socket = ctx.socket(zmq.DEALER)
+        self.dealer_socket.setsockopt(zmq.SNDHWM, 0)  # the admission controller already bounds the number of pending requests 
+        self.dealer_socket.connect(self.router_address)
+
+        self.subscriber_socket:aiozmq.Socket = ctx.socket(zmq.SUB)
+        self.subscriber_socket.connect(self.publisher_address)
+        self.subscriber_socket.setsockopt(zmq.SUBSCRIBE, b'EXIT_LOOP')
+        self.subscriber_socket.setsockopt(zmq.SUBSCRIBE, b'METRICS')
+        self.subscriber_socket.setsockopt(zmq.SUBSCRIBE, b'STATUS')
+
+    def close(self):
+        self.dealer_socket.close(linger=0)
+        self.subscriber_socket.close(linger=0)
 
 class APIServer:
     app_description = {
@@ -31,21 +84,53 @@ class APIServer:
         """
     }
 
-    def __init__(self, port:int, host:str, router_address:str, publisher_address:str, mounting_path:str, workers_barrier:mp.Barrier):
+    map_loop_status2error = {
+        0: 'TIMEOUT... this request was not processed before its deadline',
+        2: 'Vectorizer is not available',
+        3: 'Vectorizer was not able to compute the embedding' 
+    }
+
+    map_loop_status2reason = {0: 'timeout', 2: 'unavailable', 3: 'failed'}
+
+    def __init__(self, port:int, host:str, models:Dict[str, Dict[str, str]], default_model:str, mounting_path:str, workers_barrier:mp.Barrier, request_timeout:int=60000, max_inflight:int=64, max_queue_depth:int=1024, max_queue_wait:int=10000, job_chunk_size:int=32, max_running_jobs:int=4, max_jobs:int=1000, job_store_size:int=512, job_ttl:int=3600, index_path:Optional[str]=None, index_nlist:int=0, index_nprobe:int=8):
         
         self.port = port 
         self.host = host 
         self.mounting_path = mounting_path
+        self.request_timeout = request_timeout  # ms, used when the client does not set its own timeout 
         self.workers_barrier = workers_barrier
+        self.max_inflight = max_inflight
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait  # ms 
+        self.job_chunk_size = job_chunk_size  # texts per request sent to the vectorizers 
+        self.max_running_jobs = max_running_jobs
+        self.job_store = JobStore(max_jobs=max_jobs, max_bytes=job_store_size * 1024 * 1024, ttl=job_ttl)
+        self.job_tasks:Dict[str, aio.Task] = {}
 
-        self.router_address = router_address
-        self.publisher_address = publisher_address        
-        self.opened_sockets = 0 
+        # one vector index per model under index_path, opened by its first request : None disables the /index routes 
+        self.index_path = index_path
+        self.index_nlist = index_nlist  # 0 : exact search 
+        self.index_nprobe = index_nprobe
+        self.indexes:Dict[str, VectorIndex] = {}
+        self.index_locks:Dict[str, Lock] = {}  # created at startup, inside the running loop 
+
+        # one broker per model : models maps the name of a model to its router_address and publisher_address 
+        self.default_model = default_model
+        self.channels = { model_name: ModelChannel(model_name, **addresses) for model_name, addresses in models.items() }
+
+        self.metrics = MetricsRegistry()
+        self.metrics.describe('embedding_http_requests_total', 'counter', 'number of http requests by route and status code')
+        self.metrics.describe('embedding_http_request_duration_seconds', 'histogram', 'duration of the http requests by route')
+        self.metrics.describe('embedding_errors_total', 'counter', 'number of failed embeddings by reason (timeout, unavailable, failed, rejected, exception)')
+        self.metrics.describe('embedding_jobs_total', 'counter', 'number of finished jobs by status')
 
         self.core = FastAPI(**self.app_description, docs_url='/')
+        self.core.middleware('http')(self.observe_http_request)
 
         self.core.add_event_handler('startup', self.handle_startup)
         self.core.add_event_handler('shutdown', self.handle_shutdown)
+        self.core.add_exception_handler(AdmissionRejected, self.handle_admission_rejected)
+        self.core.add_exception_handler(UnknownModel, self.handle_unknown_model)
         
         self.core.add_api_route(
             path='/heartbit', 
@@ -53,69 +138,429 @@ class APIServer:
             methods=['GET'], 
             response_model=EntrypointResponseModel
         )
+        self.core.add_api_route(
+            path='/metrics', 
+            endpoint=self.handle_metrics, 
+            methods=['GET'], 
+            response_class=PlainTextResponse
+        )
         self.core.add_api_route(
             path='/compute_embedding', 
             endpoint=self.handle_compute_embedding, 
             methods=['POST'], 
             response_model=ComputeEmbeddingResponseModel
         )
+        self.core.add_api_route(
+            path='/compute_embeddings', 
+            endpoint=self.handle_compute_embeddings, 
+            methods=['POST'], 
+            response_model=ComputeEmbeddingsResponseModel
+        )
+        self.core.add_api_route(
+            path='/jobs', 
+            endpoint=self.handle_create_job, 
+            methods=['POST'], 
+            response_model=JobResponseModel,
+            status_code=202
+        )
+        self.core.add_api_route(
+            path='/jobs/{job_id}', 
+            endpoint=self.handle_get_job, 
+            methods=['GET'], 
+            response_model=JobResponseModel
+        )
+        self.core.add_api_route(
+            path='/jobs/{job_id}', 
+            endpoint=self.handle_delete_job, 
+            methods=['DELETE'], 
+            response_model=JobResponseModel
+        )
+        self.core.add_api_route(
+            path='/jobs/{job_id}/results', 
+            endpoint=self.handle_stream_job, 
+            methods=['GET'], 
+            response_class=StreamingResponse
+        )
+        self.core.add_api_route(
+            path='/index/add', 
+            endpoint=self.handle_index_add, 
+            methods=['POST'], 
+            response_model=IndexResponseModel
+        )
+        self.core.add_api_route(
+            path='/index/query', 
+            endpoint=self.handle_index_query, 
+            methods=['POST'], 
+            response_model=IndexResponseModel
+        )
+        self.core.add_api_route(
+            path='/index/snapshot', 
+            endpoint=self.handle_index_snapshot, 
+            methods=['POST'], 
+            response_model=IndexResponseModel
+        )
+        self.core.add_api_route(
+            path='/index/load', 
+            endpoint=self.handle_index_load, 
+            methods=['POST'], 
+            response_model=IndexResponseModel
+        )
     
     async def handle_startup(self):
         self.ctx = aiozmq.Context()
-        self.ctx.set(zmq.MAX_SOCKETS, 32768)
-        self.access_card = Semaphore(value=4096, loop=aio.get_event_loop())
-        self.socket_mutex = Lock(loop=aio.get_event_loop())
+        self.shm_reader = SharedEmbeddingReader()  # used only when the vectorizers reply through shared memory 
+        self.admission = AdmissionController(max_inflight=self.max_inflight, max_queue_depth=self.max_queue_depth, max_queue_wait=self.max_queue_wait)
+        self.job_semaphore = Semaphore(self.max_running_jobs)
+        self.index_locks = { name: Lock() for name in self.channels }
+        
+        for channel in self.channels.values():
+            channel.connect(self.ctx)
+
         logger.debug('server is waiting for vectorizer to be ready')
-        self.workers_barrier.wait()  # wait vectorizer to be ready...! 
-        self.vectorizer_is_alive = Event(loop=aio.get_event_loop())
-        self.vectorizer_is_alive.set()
+        self.workers_barrier.wait()  # wait the brokers and the vectorizers to be connected...! 
+        self.background_tasks = []
+        for channel in self.channels.values():
+            channel.is_alive = Event()  # the loop argument was removed in python 3.10
+            channel.is_alive.set()
+            self.background_tasks.append(aio.create_task(self.dispatch_responses(channel)))
+            self.background_tasks.append(aio.create_task(self.listen_events(channel)))
         logger.success('server is up... zeromq was initialized')
     
     async def handle_shutdown(self):
+        for task in self.job_tasks.values():
+            task.cancel()
+        await aio.gather(*self.job_tasks.values(), return_exceptions=True)
+        for task in self.background_tasks:
+            task.cancel()
+        await aio.gather(*self.background_tasks, return_exceptions=True)
+        for index in self.indexes.values():
+            index.flush()
+        for channel in self.channels.values():
+            channel.close()
         self.ctx.term()
+        self.shm_reader.close()
         logger.success('server is down and has released its ressources')
+
+    async def dispatch_responses(self, channel:ModelChannel):
+        # routes each reply of the vectorizer to the request waiting for it 
+        while True:
+            try:
+                frames = await channel.dealer_socket.recv_multipart(copy=False)
+                header, embeddings, details = decode_reply(frames[1:])  # frames[0] is the empty delimiter 
+                if header.get('status') == 'unavailable':  # the broker has lost the vectorizer holding this request 
+                    future = channel.pending_requests.pop(header['correlation_id'], None)
+                    if future is not None and not future.done():
+                        future.set_result((2, None, None, None))
+                    continue 
+                release = None 
+                if header.get('transport') == 'shm':
+                    embeddings, release = self.shm_reader.read(header)
+                future = channel.pending_requests.pop(header['correlation_id'], None)
+                if future is not None and not future.done():
+                    future.set_result((1, embeddings, details, release))  # successfull response 
+                elif release is not None:
+                    release()  # nobody waits for this reply anymore : the slot goes back to the vectorizer 
+            except aio.CancelledError:
+                break 
+            except Exception as e:
+                logger.error(e)
+    
+    async def listen_events(self, channel:ModelChannel):
+        while True:
+            try:
+                topic, payload = await channel.subscriber_socket.recv_multipart()
+                if topic == b'STATUS':
+                    channel.broker_status = json.loads(payload)
+                if topic == b'METRICS':
+                    worker_metrics = json.loads(payload)
+                    channel.map_worker2metrics[worker_metrics['worker']] = worker_metrics['metrics']
+                if topic == b'EXIT_LOOP':
+                    logger.warning(f'vectorizers of the model {channel.name} are down, all its pending requests will be released')
+                    channel.is_alive.clear()
+                    pending_requests = list(channel.pending_requests.values())
+                    channel.pending_requests.clear()
+                    for future in pending_requests:
+                        if not future.done():
+                            future.set_result((2, None, None, None))
+            except aio.CancelledError:
+                break 
+            except Exception as e:
+                logger.error(e)
         
+    def get_channel(self, model:Optional[str]) -> ModelChannel:
+        channel = self.channels.get(model or self.default_model, None)
+        if channel is None:
+            raise UnknownModel(model, list(self.channels.keys()))
+        return channel 
+
     async def handle_entrypoint(self):
+        # READY once every model has at least one vectorizer that has loaded and warmed up its models 
+        models = { 
+            name: dict(channel.broker_status, alive=channel.is_alive.is_set(), default=name == self.default_model) 
+            for name, channel in self.channels.items() 
+        }
+        nb_ready_workers = sum( channel.broker_status['workers'] for channel in self.channels.values() )
+        if all( channel.broker_status['workers'] > 0 for channel in self.channels.values() ):
+            server_status, message = ServerStatus.READY, f'server is ready to process incoming request ({nb_ready_workers} vectorizers)'
+        else:
+            server_status, message = ServerStatus.ALIVE, 'server is alive, the vectorizers are loading their models'
         return JSONResponse(
             status_code=200,
             content=EntrypointResponseModel(
                 status=True,
                 content=EntrypointResponseContentModel(
-                    status=ServerStatus.ALIVE,
-                    message='server is alive and ready to process incoming request'
+                    status=server_status,
+                    message=message,
+                    admission=self.admission.stats(),
+                    models=models
                 )
             ).dict()
         )
     
-    async def handle_compute_embedding(self, incoming_req:ComputeEmbeddingRequestModel):
-        async with self.access_card:
-            async with self.socket_mutex:
-                if not self.vectorizer_is_alive.is_set():
-                    logger.warning(f'server can not process the incoming req : vectorizer is down')
-                    return JSONResponse(
-                        status_code=500,
-                        content=ComputeEmbeddingResponseModel(
-                            status=False,
-                            request_id=incoming_req.request_id,
-                            content=ComputeEmbeddingResponseContentModel(),
-                            error_message='vectorizer is not alive ...!' 
-                        ).dict()
-                    )
-                
-            try:
-                dealer_socket:aiozmq.Socket = self.ctx.socket(zmq.DEALER)
-                dealer_socket.connect(self.router_address)
+    async def observe_http_request(self, request:Request, call_next):
+        start = time.perf_counter()
+        response = await call_next(request)
+        route = request.scope.get('route')
+        path = route.path if route is not None else 'unknown'  # bounded cardinality : one label per route 
+        self.metrics.inc('embedding_http_requests_total', path=path, status=str(response.status_code))
+        self.metrics.observe('embedding_http_request_duration_seconds', time.perf_counter() - start, path=path)
+        return response 
+
+    async def handle_metrics(self):
+        admission_stats = self.admission.stats()
+        job_stats = self.job_store.stats()
+        queue_metrics = {
+            'embedding_inflight_requests': {
+                'type': 'gauge', 
+                'help': 'number of requests forwarded to the vectorizers', 
+                'samples': [{'labels': {}, 'value': admission_stats['inflight']}]
+            },
+            'embedding_queue_depth': {
+                'type': 'gauge', 
+                'help': 'number of requests waiting for admission', 
+                'samples': [ {'labels': {'priority': priority}, 'value': depth} for priority, depth in admission_stats['queue_depths'].items() ]
+            },
+            'embedding_queue_wait_seconds': {
+                'type': 'histogram', 
+                'help': 'time spent by the admitted requests in the queue', 
+                'samples': [ dict(self.admission.wait_histograms[priority].snapshot(), labels={'priority': priority}) for priority in PRIORITY_RANKS ]
+            },
+            'embedding_vectorizers_alive': {
+                'type': 'gauge', 
+                'help': '1 while at least one vectorizer of the model is alive', 
+                'samples': [ {'labels': {'model': name}, 'value': int(channel.is_alive.is_set())} for name, channel in self.channels.items() ]
+            },
+            'embedding_jobs': {
+                'type': 'gauge', 
+                'help': 'number of jobs held by the job store by status', 
+                'samples': [ {'labels': {'status': status}, 'value': count} for status, count in job_stats['jobs'].items() ]
+            },
+            'embedding_job_store_bytes': {
+                'type': 'gauge', 
+                'help': 'texts and embeddings held by the job store', 
+                'samples': [{'labels': {}, 'value': job_stats['bytes']}]
+            },
+            'embedding_vectorizers_ready': {
+                'type': 'gauge', 
+                'help': 'number of vectorizers that have loaded and warmed up their models', 
+                'samples': [ {'labels': {'model': name}, 'value': channel.broker_status['workers']} for name, channel in self.channels.items() ]
+            },
+            'embedding_index_vectors': {
+                'type': 'gauge', 
+                'help': 'number of vectors held by the index of each model', 
+                'samples': [ {'labels': {'model': name}, 'value': len(index)} for name, index in self.indexes.items() ]
+            }
+        }
+        snapshots = [({}, self.metrics.snapshot()), ({}, queue_metrics)]
+        for name, channel in self.channels.items():
+            snapshots.extend( ({'model': name, 'worker': worker}, snapshot) for worker, snapshot in channel.map_worker2metrics.items() )
+        return PlainTextResponse(render_metrics(snapshots), media_type='text/plain; version=0.0.4')
+
+    async def handle_unknown_model(self, request:Request, exc:UnknownModel):
+        self.metrics.inc('embedding_errors_total', reason='unknown_model')
+        return JSONResponse(
+            status_code=404,
+            content=GenericResponseModel(
+                status=False,
+                content=None,
+                error_message=str(exc)
+            ).dict()
+        )
+
+    async def handle_admission_rejected(self, request:Request, exc:AdmissionRejected):
+        logger.warning(f'server has rejected a request : {exc.reason}')
+        self.metrics.inc('embedding_errors_total', reason='rejected')
+        return JSONResponse(
+            status_code=429,
+            headers={'Retry-After': str(exc.retry_after)},
+            content=GenericResponseModel(
+                status=False,
+                content=None,
+                error_message=f'{exc.reason}, retry after {exc.retry_after}s'
+            ).dict()
+        )
+
+    def make_deadline(self, timeout_ms:Optional[int]) -> float:
+        if timeout_ms is None or timeout_ms <= 0:
+            timeout_ms = self.request_timeout
+        return time.monotonic() + timeout_ms / 1000
+
+    async def forward_to_vectorizer(self, channel:ModelChannel, texts:List[str], deadline:float, options:Optional[Dict[str, Any]]=None, releases:Optional[AsyncExitStack]=None) -> Tuple[int, Optional[List[np.ndarray]], Optional[List[Optional[Dict[str, Any]]]]]:
+        # releases : a shared memory slot is released when the caller closes the stack, once its response is built 
+        # without releases the embeddings are copied and the slot is released right away 
+        # details : per text, the sentence level outputs requested through options['details'] 
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return 0, None, None 
+        
+        correlation_id = uuid4().hex 
+        future = aio.get_event_loop().create_future()
+        channel.pending_requests[correlation_id] = future 
+        logger.debug(f'server get a new request for making embedding...! {len(channel.pending_requests)}')
+        
+        try:
+            # monotonic clocks are not comparable between hosts : the vectorizer gets a wall clock deadline 
+            header = dict(options or {}, correlation_id=correlation_id, deadline=time.time() + remaining)
+            header = json.dumps(header).encode()
+            # one text per frame : the vectorizer encodes all of them in a single pass 
+            await channel.dealer_socket.send_multipart([b'', header] + [ text.encode('utf-8') for text in texts ])
+            keep_loop, embeddings, details, release = await aio.wait_for(future, timeout=deadline - time.monotonic())
+            if release is not None:
+                if releases is not None:
+                    releases.callback(release)
+                else:
+                    embeddings = [ np.array(embedding) if embedding is not None else None for embedding in embeddings ]
+                    release()
+            logger.debug(f'server has finished to process the embedding request...!')
+        except aio.TimeoutError:
+            keep_loop, embeddings, details = 0, None, None 
+        except aio.CancelledError:
+            # the reply may have arrived just before the cancellation : its slot must go back to the vectorizer 
+            if future.done() and not future.cancelled() and future.result()[3] is not None:
+                future.result()[3]()
+            raise 
+        finally:
+            channel.pending_requests.pop(correlation_id, None)
+        
+        return keep_loop, embeddings, details 
 
-                subscriber_socket:aiozmq.Socket = self.ctx.socket(zmq.SUB)
-                subscriber_socket.connect(self.publisher_address)
-                subscriber_socket.setsockopt(zmq.SUBSCRIBE, b'EXIT_LOOP')
+    def negotiate_format(self, request:Request, supported_formats:List[EmbeddingFormat]) -> Optional[EmbeddingFormat]:
+        accept = request.headers.get('accept', '')
+        media_types = [ part.split(';')[0].strip() for part in accept.split(',') if part.strip() != '' ]
+        if len(media_types) == 0:
+            return EmbeddingFormat.JSON
+        for media_type in media_types:
+            if media_type in ['*/*', 'application/*']:
+                return EmbeddingFormat.JSON
+            for response_format in supported_formats:
+                if media_type == response_format.value:
+                    return response_format
+        return None 
 
-                poller = aiozmq.Poller()
-                poller.register(dealer_socket, zmq.POLLIN)
-                poller.register(subscriber_socket, zmq.POLLIN)
+    def supported_formats(self, allow_binary:bool) -> List[EmbeddingFormat]:
+        supported_formats = [EmbeddingFormat.JSON, EmbeddingFormat.BASE64]
+        if msgpack is not None:
+            supported_formats.append(EmbeddingFormat.MSGPACK)
+        if allow_binary:
+            supported_formats.append(EmbeddingFormat.BINARY)
+        return supported_formats
+
+    def make_details_options(self, incoming_req:SentenceDetailsRequestModel) -> Optional[Dict[str, Any]]:
+        if incoming_req.top_k == 0 and not incoming_req.return_sentences and not incoming_req.return_sentence_embeddings:
+            return None  # the vectorizer can serve the document embedding from its cache 
+        return {
+            'top_k': incoming_req.top_k,
+            'return_sentences': incoming_req.return_sentences,
+            'return_sentence_embeddings': incoming_req.return_sentence_embeddings
+        }
+
+    def make_sentences(self, sentences:List[Dict[str, Any]], sentence_embeddings:Optional[np.ndarray], response_format:EmbeddingFormat) -> List[Dict[str, Any]]:
+        if sentence_embeddings is None or response_format == EmbeddingFormat.MSGPACK:
+            bodies = [ SentenceModel(**sentence).dict() for sentence in sentences ]
+            if sentence_embeddings is not None:  # msgpack carries the raw buffers 
+                for body, sentence in zip(bodies, sentences):
+                    body['encoded_embedding'] = sentence_embeddings[sentence['index']].tobytes()
+            return bodies 
+        if response_format == EmbeddingFormat.JSON:
+            return [ SentenceModel(**sentence, embedding=sentence_embeddings[sentence['index']].tolist()).dict() for sentence in sentences ]
+        return [ SentenceModel(**sentence, encoded_embedding=base64.b64encode(sentence_embeddings[sentence['index']]).decode()).dict() for sentence in sentences ]
+
+    def make_item_body(self, request_id:str, embedding:Optional[np.ndarray], response_format:EmbeddingFormat, details:Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
+        if embedding is None:  
+            return ComputeEmbeddingResponseModel(
+                status=False,
+                request_id=request_id,
+                content=None,
+                error_message=self.map_loop_status2error[3]
+            ).dict()
+        
+        if response_format == EmbeddingFormat.JSON:
+            content = ComputeEmbeddingResponseContentModel(embedding=embedding.tolist(), dtype=embedding.dtype.name)
+        elif response_format == EmbeddingFormat.BASE64:
+            content = ComputeEmbeddingResponseContentModel(encoded_embedding=base64.b64encode(embedding).decode(), dtype=embedding.dtype.name)
+        else:  # msgpack carries the raw buffer 
+            content = ComputeEmbeddingResponseContentModel(dtype=embedding.dtype.name)
+        
+        body = ComputeEmbeddingResponseModel(status=True, request_id=request_id, content=content).dict()
+        if response_format == EmbeddingFormat.MSGPACK:
+            body['content']['encoded_embedding'] = embedding.tobytes()
+        if details is not None:
+            if 'summary' in details:
+                body['content']['summary'] = self.make_sentences(details['summary'], None, response_format)
+            if 'sentences' in details:
+                body['content']['sentences'] = self.make_sentences(details['sentences'], details.get('sentence_embeddings', None), response_format)
+        return body 
+
+    def make_response(self, body:Dict[str, Any], response_format:EmbeddingFormat) -> Response:
+        if response_format == EmbeddingFormat.MSGPACK:
+            return Response(status_code=200, content=msgpack.packb(body), media_type=response_format.value)
+        return JSONResponse(status_code=200, content=body, media_type=response_format.value)
+
+    def make_not_acceptable_response(self, request:Request, supported_formats:List[EmbeddingFormat], response_model:Any, **kwargs) -> JSONResponse:
+        return JSONResponse(
+            status_code=406,
+            content=response_model(
+                status=False,
+                error_message=f'can not produce {request.headers.get("accept")}, supported formats : {[ fmt.value for fmt in supported_formats ]}',
+                **kwargs
+            ).dict()
+        )
+
+    async def handle_compute_embedding(self, incoming_req:ComputeEmbeddingRequestModel, request:Request):
+        deadline = self.make_deadline(incoming_req.timeout_ms)
+        supported_formats = self.supported_formats(allow_binary=True)
+        response_format = self.negotiate_format(request, supported_formats)
+        if response_format is None:
+            return self.make_not_acceptable_response(request, supported_formats, ComputeEmbeddingResponseModel, request_id=incoming_req.request_id)
+
+        channel = self.get_channel(incoming_req.model)
+        # the shared memory slots of the reply are released once the response is built, even when building it fails 
+        async with self.admission.admit(incoming_req.priority.value, deadline), AsyncExitStack() as releases:
+            if not channel.is_alive.is_set():
+                logger.warning(f'server can not process the incoming req : vectorizer is down')
+                self.metrics.inc('embedding_errors_total', reason='unavailable')
+                return JSONResponse(
+                    status_code=500,
+                    content=ComputeEmbeddingResponseModel(
+                        status=False,
+                        request_id=incoming_req.request_id,
+                        content=ComputeEmbeddingResponseContentModel(),
+                        error_message='vectorizer is not alive ...!' 
+                    ).dict()
+                )
+                
+            try:
+                keep_loop, embeddings, details = await self.forward_to_vectorizer(
+                    channel,
+                    [incoming_req.text], 
+                    deadline, 
+                    options={'precision': incoming_req.precision.value, 'weighting': incoming_req.weighting.value, 'details': self.make_details_options(incoming_req)},
+                    releases=releases
+                )
             except Exception as e:
                 error = f'Error => {e}'
                 logger.error(error)
+                self.metrics.inc('embedding_errors_total', reason='exception')
                 
                 return JSONResponse(
                     status_code=500,
@@ -127,101 +572,354 @@ class APIServer:
                     ).dict()
                 )
             
-            async with self.socket_mutex:
-                self.opened_sockets += 1
-                logger.debug(f'server get a new request for making embedding...! {self.opened_sockets}')
-
-            map_loop_status2error = {
-                0: 'TIMEOUT... this request take too long time to be processed >= 60s',
-                2: 'Vectorizer is not available',
-                3: 'Vectorizer was not able to compute the embedding' 
-            }
-
-            try:
-                await dealer_socket.send(b'', flags=zmq.SNDMORE)
-                await dealer_socket.send_string(incoming_req.text)
-                
-                counter = 0
-                keep_loop = 0 
-                while keep_loop == 0 and counter < 1200000:
-                    map_socket2status = dict(await poller.poll(100))
-                    dealer_polled_status = map_socket2status.get(dealer_socket, None)
-                    subscriber_polled_status = map_socket2status.get(subscriber_socket, None)
-                    if dealer_polled_status == zmq.POLLIN:
-                        _, encoded_rsp = await dealer_socket.recv_multipart()
-                        embedding = pickle.loads(encoded_rsp)
-                        logger.debug(f'server has finished to process the embedding request...!')
-                        if embedding is None:
-                            keep_loop = 3 
-                        else:
-                            keep_loop = 1  # successfull response 
-                    if subscriber_polled_status == zmq.POLLIN:
-                        topic, _ = await subscriber_socket.recv_multipart()
-                        if topic == b'EXIT_LOOP':
-                            async with self.socket_mutex:
-                                if self.vectorizer_is_alive.is_set():
-                                    self.vectorizer_is_alive.clear()
-                            keep_loop = 2 
-                    counter += 100 # 100ms 
-                # end while loop 
-
-                poller.unregister(dealer_socket)
-                poller.unregister(subscriber_socket)
-                dealer_socket.close(linger=0)
-                subscriber_socket.close(linger=0)
-
-                async with self.socket_mutex:
-                    self.opened_sockets -= 1
-                    
-                if keep_loop in [0, 2, 3]:
-                    return JSONResponse(
-                        status_code=500,
-                        content=ComputeEmbeddingResponseModel(
-                            status=False,
-                            request_id=incoming_req.request_id,
-                            content=None,
-                            error_message=map_loop_status2error[keep_loop]
-                        ).dict()
-                    )
+            if keep_loop == 1 and embeddings[0] is None:
+                keep_loop = 3 
                 
-                assert keep_loop == 1 
+            if keep_loop in [0, 2, 3]:
+                self.metrics.inc('embedding_errors_total', reason=self.map_loop_status2reason[keep_loop])
                 return JSONResponse(
-                    status_code=200,
+                    status_code=500,
                     content=ComputeEmbeddingResponseModel(
-                        status=True,
+                        status=False,
                         request_id=incoming_req.request_id,
-                        content=ComputeEmbeddingResponseContentModel(
-                            embedding=embedding.tolist()
-                        )
+                        content=None,
+                        error_message=self.map_loop_status2error[keep_loop]
+                    ).dict()
+                )
+            
+            assert keep_loop == 1 
+            embedding = embeddings[0]
+            if response_format == EmbeddingFormat.BINARY:
+                return Response(
+                    status_code=200,
+                    content=embedding.tobytes(),
+                    media_type=response_format.value,
+                    headers={
+                        'X-Request-Id': incoming_req.request_id,
+                        'X-Embedding-Dtype': embedding.dtype.name,
+                        'X-Embedding-Shape': ','.join(map(str, embedding.shape))
+                    }
+                )
+            return self.make_response(self.make_item_body(incoming_req.request_id, embedding, response_format, details[0] if details is not None else None), response_format)
+        # end admission context manager 
+
+    async def handle_compute_embeddings(self, incoming_req:ComputeEmbeddingsRequestModel, request:Request):
+        deadline = self.make_deadline(incoming_req.timeout_ms)
+        supported_formats = self.supported_formats(allow_binary=False)
+        response_format = self.negotiate_format(request, supported_formats)
+        if response_format is None:
+            return self.make_not_acceptable_response(request, supported_formats, ComputeEmbeddingsResponseModel)
+
+        channel = self.get_channel(incoming_req.model)
+        # the shared memory slots of the reply are released once the response is built, even when building it fails 
+        async with self.admission.admit(incoming_req.priority.value, deadline), AsyncExitStack() as releases:
+            if not channel.is_alive.is_set():
+                logger.warning(f'server can not process the incoming req : vectorizer is down')
+                self.metrics.inc('embedding_errors_total', reason='unavailable')
+                return JSONResponse(
+                    status_code=500,
+                    content=ComputeEmbeddingsResponseModel(
+                        status=False,
+                        error_message='vectorizer is not alive ...!' 
                     ).dict()
                 )
+            
+            if len(incoming_req.items) == 0:
+                return JSONResponse(
+                    status_code=200,
+                    content=ComputeEmbeddingsResponseModel(status=True).dict()
+                )
 
+            try:
+                keep_loop, embeddings, details = await self.forward_to_vectorizer(
+                    channel,
+                    [ item.text for item in incoming_req.items ], 
+                    deadline, 
+                    options={'precision': incoming_req.precision.value, 'weighting': incoming_req.weighting.value, 'details': self.make_details_options(incoming_req)},
+                    releases=releases
+                )
             except Exception as e:
                 error = f'Error => {e}'
                 logger.error(error)
-
-                poller.unregister(dealer_socket)
-                poller.unregister(subscriber_socket)
-                dealer_socket.close(linger=0)
-                subscriber_socket.close(linger=0)
-                
-                async with self.socket_mutex:
-                    self.opened_sockets -= 1
-                
+                self.metrics.inc('embedding_errors_total', reason='exception')
                 return JSONResponse(
                     status_code=500,
-                    content=ComputeEmbeddingResponseModel(
+                    content=ComputeEmbeddingsResponseModel(
                         status=False,
-                        request_id=incoming_req.request_id,
-                        content=ComputeEmbeddingResponseContentModel(),
                         error_message=error 
                     ).dict()
                 )
-        # end semaphore acess card context manager 
+            
+            if keep_loop in [0, 2]:
+                self.metrics.inc('embedding_errors_total', reason=self.map_loop_status2reason[keep_loop])
+                return JSONResponse(
+                    status_code=500,
+                    content=ComputeEmbeddingsResponseModel(
+                        status=False,
+                        error_message=self.map_loop_status2error[keep_loop]
+                    ).dict()
+                )
+            
+            assert keep_loop == 1 
+            nb_failures = sum( embedding is None for embedding in embeddings )
+            if nb_failures > 0:
+                self.metrics.inc('embedding_errors_total', nb_failures, reason=self.map_loop_status2reason[3])
+            # a faulty document does not fail the others 
+            details = details if details is not None else [None] * len(embeddings)
+            item_bodies = [ self.make_item_body(item.request_id, embedding, response_format, item_details) for item, embedding, item_details in zip(incoming_req.items, embeddings, details) ]
+            body = ComputeEmbeddingsResponseModel(status=True).dict()
+            body['content'] = item_bodies 
+            return self.make_response(body, response_format)
+        # end admission context manager 
+
+    async def run_job(self, job:Job):
+        # the chunks of a job wait in the admission queue at bulk priority : the interactive requests go first 
+        try:
+            async with self.job_semaphore:
+                job.status = 'running'
+                for indices, texts in job.iter_chunks(self.job_chunk_size):
+                    keep_loop, embeddings = await self.forward_job_chunk(job, texts)
+                    if keep_loop == 2:
+                        await job.finish('failed', self.map_loop_status2error[2])
+                        break 
+                    if keep_loop == 0:
+                        self.metrics.inc('embedding_errors_total', len(texts), reason=self.map_loop_status2reason[0])
+                        embeddings = [None] * len(texts)
+                    await job.complete(indices, embeddings)
+                else:
+                    await job.finish('done')
+        except aio.CancelledError:
+            await job.finish('cancelled')
+            raise 
+        except Exception as e:
+            logger.error(e)
+            await job.finish('failed', f'Error => {e}')
+        finally:
+            self.job_tasks.pop(job.job_id, None)
+            self.metrics.inc('embedding_jobs_total', status=job.status)
+            logger.debug(f'job {job.job_id} is {job.status} : {len(job.completed)}/{len(job)} items, {job.nb_failed} failures')
+    
+    async def forward_job_chunk(self, job:Job, texts:List[str]) -> Tuple[int, Optional[List[np.ndarray]]]:
+        channel = self.get_channel(job.model)
+        while True:
+            if not channel.is_alive.is_set():
+                return 2, None 
+            deadline = self.make_deadline(None)
+            try:
+                async with self.admission.admit(RequestPriority.BULK.value, deadline):
+                    keep_loop, embeddings, _ = await self.forward_to_vectorizer(channel, texts, deadline, options=job.options)
+                    return keep_loop, embeddings 
+            except AdmissionRejected as e:
+                await aio.sleep(e.retry_after)  # the queue is full : the job backs off instead of failing 
+
+    def make_job_not_found_response(self, job_id:str) -> JSONResponse:
+        return JSONResponse(
+            status_code=404,
+            content=JobResponseModel(
+                status=False,
+                error_message=f'job {job_id} does not exist or has expired'
+            ).dict()
+        )
+
+    def make_job_body(self, job:Job, response_format:Optional[EmbeddingFormat]=None) -> Dict[str, Any]:
+        body = JobResponseModel(status=job.status != 'failed', content=JobContentModel(**job.summary(self.job_store.ttl))).dict()
+        body['error_message'] = job.error_message
+        if response_format is not None:
+            body['content']['results'] = [ self.make_item_body(job.request_ids[idx], job.embeddings[idx], response_format) for idx in sorted(job.completed) ]
+        return body 
+
+    async def handle_create_job(self, incoming_req:JobRequestModel):
+        channel = self.get_channel(incoming_req.model)
+        if not channel.is_alive.is_set():
+            self.metrics.inc('embedding_errors_total', reason='unavailable')
+            return JSONResponse(
+                status_code=500,
+                content=JobResponseModel(
+                    status=False,
+                    error_message='vectorizer is not alive ...!' 
+                ).dict()
+            )
+
+        job = Job(
+            request_ids=[ item.request_id for item in incoming_req.items ], 
+            texts=[ item.text for item in incoming_req.items ], 
+            options={'precision': incoming_req.precision.value, 'weighting': incoming_req.weighting.value},
+            model=channel.name
+        )
+        if not self.job_store.add(job):
+            raise AdmissionRejected('the job store is full', retry_after=60)
+        self.job_tasks[job.job_id] = aio.create_task(self.run_job(job))
+        logger.debug(f'server has created the job {job.job_id} ({len(job)} items)')
+        return JSONResponse(status_code=202, content=self.make_job_body(job))
+
+    async def handle_get_job(self, job_id:str, request:Request, results:bool=True):
+        # results=false returns only the progress of the job 
+        job = self.job_store.get(job_id)
+        if job is None:
+            return self.make_job_not_found_response(job_id)
+        if not results:
+            return JSONResponse(status_code=200, content=self.make_job_body(job))
+
+        supported_formats = self.supported_formats(allow_binary=False)
+        response_format = self.negotiate_format(request, supported_formats)
+        if response_format is None:
+            return self.make_not_acceptable_response(request, supported_formats, JobResponseModel)
+        return self.make_response(self.make_job_body(job, response_format), response_format)
+
+    async def handle_delete_job(self, job_id:str):
+        job = self.job_store.remove(job_id)
+        if job is None:
+            return self.make_job_not_found_response(job_id)
+        task = self.job_tasks.get(job_id, None)
+        if task is not None:
+            task.cancel()
+            await aio.gather(task, return_exceptions=True)
+        return JSONResponse(status_code=200, content=self.make_job_body(job))
+
+    async def stream_job(self, job:Job, response_format:EmbeddingFormat):
+        # one line per item in completion order, the last line is the summary of the job 
+        cursor = 0 
+        while True:
+            async with job.progress:
+                await job.progress.wait_for(lambda: len(job.completed) > cursor or job.is_finished())
+            while cursor < len(job.completed):
+                idx = job.completed[cursor]
+                cursor += 1
+                yield json.dumps(self.make_item_body(job.request_ids[idx], job.embeddings[idx], response_format)) + '\n'
+            if job.is_finished() and cursor == len(job.completed):
+                break 
+        yield json.dumps(self.make_job_body(job)) + '\n'
+
+    async def handle_stream_job(self, job_id:str, encoded:bool=False):
+        # encoded=true : base64 of the raw buffers instead of lists of floats 
+        job = self.job_store.get(job_id)
+        if job is None:
+            return self.make_job_not_found_response(job_id)
+        response_format = EmbeddingFormat.BASE64 if encoded else EmbeddingFormat.JSON
+        return StreamingResponse(self.stream_job(job, response_format), media_type='application/x-ndjson')
+
+    def get_index(self, channel:ModelChannel) -> VectorIndex:
+        if channel.name not in self.indexes:
+            self.indexes[channel.name] = VectorIndex(path.join(self.index_path, channel.name), nlist=self.index_nlist, nprobe=self.index_nprobe)
+        return self.indexes[channel.name]
+
+    async def run_on_index(self, channel:ModelChannel, operation:Callable[[VectorIndex], Any]) -> Any:
+        # scans and writes run in a thread : numpy releases the gil and the event loop keeps serving the other requests
+        index = self.get_index(channel)
+        async with self.index_locks[channel.name]:
+            return await aio.get_event_loop().run_in_executor(None, partial(operation, index))
+
+    async def embed_for_index(self, channel:ModelChannel, texts:List[str], incoming_req:Any) -> Tuple[int, Optional[List[np.ndarray]]]:
+        deadline = self.make_deadline(incoming_req.timeout_ms)
+        async with self.admission.admit(incoming_req.priority.value, deadline):
+            if not channel.is_alive.is_set():
+                return 2, None
+            # the index holds float32 : no precision option
+            keep_loop, embeddings, _ = await self.forward_to_vectorizer(channel, texts, deadline, options={'precision': 'float32', 'weighting': incoming_req.weighting.value})
+            return keep_loop, embeddings
+
+    def make_index_response(self, channel:ModelChannel, **content) -> JSONResponse:
+        stats = self.get_index(channel).stats()
+        return JSONResponse(
+            status_code=200,
+            content=IndexResponseModel(
+                status=True,
+                content=IndexContentModel(model=channel.name, size=stats['size'], dimension=stats['dimension'], mode=stats['mode'], **content)
+            ).dict()
+        )
+
+    def make_index_error_response(self, status_code:int, error_message:str) -> JSONResponse:
+        return JSONResponse(
+            status_code=status_code,
+            content=IndexResponseModel(
+                status=False,
+                error_message=error_message
+            ).dict()
+        )
+
+    def make_index_disabled_response(self) -> JSONResponse:
+        return self.make_index_error_response(404, 'the index is disabled, start the services with --index_path')
+
+    async def handle_index_add(self, incoming_req:IndexAddRequestModel):
+        # the texts are embedded by the vectorizers of the model, the request_id of each item becomes its id in the index
+        if self.index_path is None:
+            return self.make_index_disabled_response()
+        channel = self.get_channel(incoming_req.model)
+        if len(incoming_req.items) == 0:
+            return self.make_index_response(channel, nb_added=0, nb_updated=0, failed=[])
+
+        keep_loop, embeddings = await self.embed_for_index(channel, [ item.text for item in incoming_req.items ], incoming_req)
+        if keep_loop in [0, 2]:
+            self.metrics.inc('embedding_errors_total', reason=self.map_loop_status2reason[keep_loop])
+            return self.make_index_error_response(500, self.map_loop_status2error[keep_loop])
+
+        failed = [ item.request_id for item, embedding in zip(incoming_req.items, embeddings) if embedding is None ]
+        if len(failed) > 0:
+            self.metrics.inc('embedding_errors_total', len(failed), reason=self.map_loop_status2reason[3])
+        ids = [ item.request_id for item, embedding in zip(incoming_req.items, embeddings) if embedding is not None ]
+        nb_added, nb_updated = 0, 0
+        if len(ids) > 0:
+            vectors = np.stack([ embedding for embedding in embeddings if embedding is not None ])
+            try:
+                nb_added, nb_updated = await self.run_on_index(channel, lambda index: index.add(ids, vectors))
+            except ValueError as e:
+                return self.make_index_error_response(400, str(e))
+        return self.make_index_response(channel, nb_added=nb_added, nb_updated=nb_updated, failed=failed)
+
+    async def handle_index_query(self, incoming_req:IndexQueryRequestModel):
+        # top_k ids by cosine similarity with the embedding of the text, or with the given embedding
+        if self.index_path is None:
+            return self.make_index_disabled_response()
+        if (incoming_req.text is None) == (incoming_req.embedding is None):
+            return self.make_index_error_response(400, 'a query needs either a text or an embedding')
+        channel = self.get_channel(incoming_req.model)
+
+        if incoming_req.text is not None:
+            keep_loop, embeddings = await self.embed_for_index(channel, [incoming_req.text], incoming_req)
+            if keep_loop == 1 and embeddings[0] is None:
+                keep_loop = 3
+            if keep_loop in [0, 2, 3]:
+                self.metrics.inc('embedding_errors_total', reason=self.map_loop_status2reason[keep_loop])
+                return self.make_index_error_response(500, self.map_loop_status2error[keep_loop])
+            query = embeddings[0]
+        else:
+            query = np.asarray(incoming_req.embedding, dtype=np.float32)
+
+        try:
+            matches = await self.run_on_index(channel, lambda index: index.search(query, incoming_req.top_k, incoming_req.nprobe))
+        except ValueError as e:
+            return self.make_index_error_response(400, str(e))
+        return self.make_index_response(channel, matches=[ {'id': vector_id, 'score': score} for vector_id, score in matches[0] ])
+
+    async def handle_index_snapshot(self, incoming_req:IndexSnapshotRequestModel):
+        # compact copy of the index under <index_path>/<model>/snapshots/<name>
+        if self.index_path is None:
+            return self.make_index_disabled_response()
+        channel = self.get_channel(incoming_req.model)
+        try:
+            await self.run_on_index(channel, lambda index: index.snapshot(incoming_req.name))
+        except ValueError as e:
+            return self.make_index_error_response(400, str(e))
+        logger.debug(f'server has saved the index of the model {channel.name} to the snapshot {incoming_req.name}')
+        return self.make_index_response(channel)
+
+    async def handle_index_load(self, incoming_req:IndexSnapshotRequestModel):
+        # the snapshot replaces the current content of the index
+        if self.index_path is None:
+            return self.make_index_disabled_response()
+        channel = self.get_channel(incoming_req.model)
+        try:
+            await self.run_on_index(channel, lambda index: index.load(incoming_req.name))
+        except ValueError as e:
+            return self.make_index_error_response(400, str(e))
+        except FileNotFoundError as e:
+            return self.make_index_error_response(404, str(e))
+        logger.debug(f'server has loaded the snapshot {incoming_req.name} into the index of the model {channel.name}')
+        return self.make_index_response(channel)
 
     def start(self):
         uvicorn.run(app=self.core, port=self.port, host=self.host, root_path=self.mounting_path)
 
-def start_server(port:int, hostname:str, router_address:str, publisher_address:str, mounting_path:str, workers_barrier:mp.Barrier):
-    server_ = APIServer(port=port, host=hostname, router_address=router_address, publisher_address=publisher_address, mounting_path=mounting_path, workers_barrier=workers_barrier)
+def start_server(port:int, hostname:str, models:Dict[str, Dict[str, str]], default_model:str, mounting_path:str, workers_barrier:mp.Barrier, request_timeout:int, max_inflight:int, max_queue_depth:int, max_queue_wait:int, job_chunk_size:int, max_running_jobs:int, max_jobs:int, job_store_size:int, job_ttl:int, index_path:Optional[str], index_nlist:int, index_nprobe:int):
+    server_ = APIServer(port=port, host=hostname, models=models, default_model=default_model, mounting_path=mounting_path, workers_barrier=workers_barrier, request_timeout=request_timeout, max_inflight=max_inflight, max_queue_depth=max_queue_depth, max_queue_wait=max_queue_wait, job_chunk_size=job_chunk_size, max_running_jobs=max_running_jobs, max_jobs=max_jobs, job_store_size=job_store_size, job_ttl=job_ttl, index_path=index_path, index_nlist=index_nlist, index_nprobe=index_nprobe)
     server_.start()
\ No newline at end of file
@@ -0,0 +1,99 @@
+import unittest
+
+import numpy as np
+
+from libraries.encoders import MockEncoder, pad_input_ids
+from libraries.strategies import EncodeScheduler, make_token_budget_batches
+
+SENTENCES = [
+    'Une phrase courte.',
+    ' '.join(['mot'] * 40),
+    'Le chat dort sur le canapé du salon.',
+    'Oui.',
+    ' '.join(['texte'] * 200),
+    'Deux phrases identiques.',
+    'Deux phrases identiques.',
+    ' '.join(['long'] * 17)
+]
+
+class RecordingEncoder(MockEncoder):
+    # keeps the token ids of each encode call
+    def __init__(self, **kwargs):
+        super(RecordingEncoder, self).__init__(**kwargs)
+        self.batches = []
+
+    def encode_tokenized(self, input_ids):
+        self.batches.append(input_ids)
+        return super(RecordingEncoder, self).encode_tokenized(input_ids)
+
+class TestTokenBudgetBatches(unittest.TestCase):
+    def test_every_index_once_longest_first(self):
+        token_lengths = np.array([5, 30, 12, 3, 30, 7, 7, 19])
+        batches = make_token_budget_batches(token_lengths, token_budget=64, max_batch_size=4)
+        indices = np.concatenate(batches)
+        self.assertEqual(sorted(indices.tolist()), list(range(len(token_lengths))))
+        self.assertTrue(np.all(np.diff(token_lengths[indices]) <= 0))
+
+    def test_budget_and_batch_size_limits(self):
+        token_lengths = np.random.default_rng(0).integers(1, 128, size=500)
+        for token_budget, max_batch_size in [(256, 64), (1024, 8), (64, 256)]:
+            for batch in make_token_budget_batches(token_lengths, token_budget, max_batch_size):
+                self.assertLessEqual(len(batch), max_batch_size)
+                self.assertTrue(len(batch) * token_lengths[batch].max() <= token_budget or len(batch) == 1)
+
+    def test_sentence_longer_than_the_budget(self):
+        batches = make_token_budget_batches(np.array([300, 10, 10]), token_budget=100, max_batch_size=8)
+        self.assertEqual([ batch.tolist() for batch in batches ], [[0], [1, 2]])
+
+class TestMockEncoder(unittest.TestCase):
+    def test_encode_tokenized_matches_encode(self):
+        encoder = MockEncoder(dimension=32)
+        embeddings = encoder.encode(SENTENCES)
+        np.testing.assert_array_equal(encoder.encode_tokenized(encoder.tokenize(SENTENCES)), embeddings)
+        np.testing.assert_array_equal(embeddings[5], embeddings[6])
+
+    def test_deterministic(self):
+        np.testing.assert_array_equal(MockEncoder(dimension=32).encode(SENTENCES), MockEncoder(dimension=32).encode(SENTENCES))
+
+    def test_tokenize_truncates(self):
+        encoder = MockEncoder(dimension=32, max_seq_length=16)
+        input_ids = encoder.tokenize(SENTENCES)
+        self.assertTrue(all( len(ids) <= 16 for ids in input_ids ))
+        np.testing.assert_array_equal(encoder.count_tokens(SENTENCES), [ len(ids) for ids in input_ids ])
+        self.assertEqual(len(input_ids[0]), len(SENTENCES[0].split()) + 2)
+
+class TestPadInputIds(unittest.TestCase):
+    def test_padding_and_mask(self):
+        padded_ids, attention_mask = pad_input_ids([[7, 8, 9], [4], [5, 6]], pad_token_id=0)
+        np.testing.assert_array_equal(padded_ids, [[7, 8, 9], [4, 0, 0], [5, 6, 0]])
+        np.testing.assert_array_equal(attention_mask, [[1, 1, 1], [1, 0, 0], [1, 1, 0]])
+        self.assertEqual(padded_ids.dtype, np.int64)
+
+class TestEncodeScheduler(unittest.TestCase):
+    def test_original_order(self):
+        encoder = RecordingEncoder(dimension=32)
+        scheduler = EncodeScheduler(encoder, token_budget=64, max_batch_size=3)
+        np.testing.assert_array_equal(scheduler.encode(SENTENCES), MockEncoder(dimension=32).encode(SENTENCES))
+        self.assertGreater(len(encoder.batches), 1)
+
+    def test_batches_respect_the_limits(self):
+        encoder = RecordingEncoder(dimension=32)
+        scheduler = EncodeScheduler(encoder, token_budget=64, max_batch_size=3)
+        scheduler.encode(SENTENCES)
+        for input_ids in encoder.batches:
+            self.assertLessEqual(len(input_ids), 3)
+            longest = max( len(ids) for ids in input_ids )
+            self.assertTrue(len(input_ids) * longest <= 64 or len(input_ids) == 1)
+        self.assertEqual(sum( len(input_ids) for input_ids in encoder.batches ), len(SENTENCES))
+
+    def test_counters(self):
+        encoder = MockEncoder(dimension=32)
+        scheduler = EncodeScheduler(encoder, token_budget=64, max_batch_size=3)
+        scheduler.encode(SENTENCES)
+        stats = scheduler.stats()
+        self.assertEqual(stats['sentences'], len(SENTENCES))
+        self.assertEqual(stats['tokens'], int(np.sum(encoder.count_tokens(SENTENCES))))
+        self.assertGreaterEqual(stats['padded_tokens'], stats['tokens'])
+
+if __name__ == '__main__':
+    unittest.main()
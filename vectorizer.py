@@ -1,64 +1,402 @@
 import zmq 
+import json 
 
+import gc 
+import os 
 import numpy as np 
 import multiprocessing as mp 
 
 import torch as th 
 import operator as op 
+import itertools as it 
 
-from time import sleep, perf_counter
+from time import sleep, perf_counter, time 
+from typing import List, Dict, Tuple, Any, Optional 
 from libraries.log import logger 
+from libraries.cache import EmbeddingCache
+from libraries.transport import encode_reply
+from libraries.shm import SharedEmbeddingWriter
+from libraries.metrics import MetricsRegistry, SIZE_BUCKETS
 from libraries.strategies import (
-    load_language_model, load_sentence_transformer, 
-    compute_pairwise_matrix,
-    to_sentences
+    compute_textrank_embeddings, compute_streaming_textrank_embedding, compute_textrank_details, EncodeScheduler,
+    compute_degree_scores, estimate_nb_sentences, batchify
 )
+from libraries.splitters import SentenceSplitter
+from libraries.encoders import load_encoder
+from libraries.snapshots import find_snapshot
 
 #docker run --rm -it --name embedding -v /home/ibrahima/Volume/transformers_cache/:/home/solver/transformers_cache -p 8090:8000 embedding:gpu-0.0 start-services --port 8000 --hostname '0.0.0.0' --mounting_path '/'
 
 
 class ZMQVectorizer:
-    def __init__(self, workers_barrier:mp.Barrier, router_address:str, publisher_address:str, transformer_model_name:str, language_model_name:str, cache_folder:str, gpu_index:int):
+    metrics_push_interval = 1.0  # s, snapshots are pushed to the server through the broker at most once per interval 
+
+    def __init__(self, workers_barrier:mp.Barrier, backend_address:str, transformer_model_name:str, language_model_name:str, cache_folder:str, gpu_index:int, num_threads:int=None, max_batch_size:int=32, max_batch_wait:int=5, cache_size:int=0, cache_path:Optional[str]=None, cache_disk_capacity:int=1000000, streaming_threshold:int=2000, streaming_chunk_size:int=256, sentence_splitter:str='parser', spacy_n_process:int=1, spacy_batch_size:int=32, encoder_backend:str='torch', onnx_num_threads:Optional[int]=None, token_budget:int=8192, max_encode_batch_size:int=256, mock_token_latency:float=0.0, warmup_lengths:Optional[List[int]]=None, transport:str='inline', shm_slots:int=128, shm_slot_size:int=256, idle_timeout:Optional[int]=None):
         self.workers_barrier = workers_barrier
         self.gpu_index = gpu_index
-        self.router_address = router_address
-        self.publisher_address = publisher_address
+        self.num_threads = num_threads
+        self.backend_address = backend_address
 
         self.language_model_name = language_model_name
+        self.sentence_splitter_name = sentence_splitter
+        self.spacy_n_process = spacy_n_process
+        self.spacy_batch_size = spacy_batch_size
         self.transformer_model_name = transformer_model_name 
         self.cache_folder = cache_folder
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait  # ms 
+        self.streaming_threshold = streaming_threshold  # sentences 
+        self.streaming_chunk_size = streaming_chunk_size
+        self.encoder_backend = encoder_backend
+        self.onnx_num_threads = onnx_num_threads if onnx_num_threads is not None else num_threads 
+        self.token_budget = token_budget
+        self.max_encode_batch_size = max_encode_batch_size
+        self.mock_token_latency = mock_token_latency
+        self.warmup_lengths = warmup_lengths if warmup_lengths is not None else [16, 64, 256]  # tokens 
+        self.transport = transport 
+        self.shm_slots = shm_slots
+        self.shm_slot_size = shm_slot_size  # KB 
+        self.shm_writer:Optional[SharedEmbeddingWriter] = None 
+        self.idle_timeout = idle_timeout  # s, None : the models stay loaded 
+        self.models_loaded = False 
+        self.last_activity = perf_counter()
+        
+        self.embedding_cache = None 
+        if cache_size > 0:
+            self.embedding_cache = EmbeddingCache(
+                namespace=f'{transformer_model_name}|{encoder_backend}|{language_model_name}', 
+                max_bytes=cache_size * 1024 * 1024, 
+                disk_folder=cache_path, 
+                disk_capacity=cache_disk_capacity
+            )
+        self.metrics = MetricsRegistry()
+        self.metrics.describe('vectorizer_stage_duration_seconds', 'histogram', 'time spent by the vectorizer in each stage of a batch')
+        self.metrics.describe('vectorizer_batch_requests', 'histogram', 'number of requests per micro-batch', buckets=SIZE_BUCKETS)
+        self.metrics.describe('vectorizer_sentences_per_document', 'histogram', 'number of sentences per document', buckets=SIZE_BUCKETS)
+        self.metrics.describe('vectorizer_encode_batch_size', 'histogram', 'number of sentences per encode call', buckets=SIZE_BUCKETS)
+        self.metrics.describe('vectorizer_texts_total', 'counter', 'number of texts processed by the vectorizer')
+        self.metrics.describe('vectorizer_dropped_requests_total', 'counter', 'number of requests dropped because their deadline had passed')
+        self.metrics.describe('vectorizer_replies_total', 'counter', 'number of replies sent to the server by transport')
+        self.metrics.describe('vectorizer_models_loaded', 'gauge', '1 while the models are loaded, 0 once unloaded after idle_timeout')
+        self.metrics.describe('vectorizer_model_loads_total', 'counter', 'number of times the models were loaded')
         self.zeromq_initialized = 0 
+        self.is_registered = False  # READY was sent to the broker 
+
+    def push_metrics(self):
+        payload = {'worker': str(os.getpid()), 'metrics': self.metrics.snapshot()}
+        try:
+            self.dealer_socket.send_multipart([b'METRICS', json.dumps(payload).encode()], flags=zmq.NOBLOCK)
+        except zmq.Again:
+            pass  # metrics are best effort 
+
+    def collect_batch(self, timeout:Optional[int]=None) -> List[List[bytes]]:
+        # timeout (ms) : an empty batch is returned when no request came in, None waits forever 
+        if timeout is not None and self.dealer_socket.poll(timeout) != zmq.POLLIN:
+            return []
+        batch = [self.dealer_socket.recv_multipart()]  # wait for the first request of the batch 
+        batch_deadline = perf_counter() + self.max_batch_wait / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = max(batch_deadline - perf_counter(), 0) 
+            polled_status = self.dealer_socket.poll(int(remaining * 1000))
+            if polled_status != zmq.POLLIN:
+                break 
+            batch.append(self.dealer_socket.recv_multipart())
+        return [ frames for frames in batch if frames != [b'PING'] ]  # liveness probes of the broker 
+
+    def drop_expired_requests(self, batch:List[List[bytes]]) -> List[List[bytes]]:
+        # nobody will read the embedding of a request whose deadline has passed 
+        valid_requests = []
+        current_time = time()
+        for frames in batch:
+            try:
+                header = json.loads(frames[2])
+                expired = header.get('deadline', None) is not None and header['deadline'] < current_time
+            except Exception as e:
+                logger.error(e)
+                expired = False 
+            if expired:
+                self.dealer_socket.send_multipart([b'DROP', header['correlation_id'].encode()])  # the broker gets its slot back 
+            else:
+                valid_requests.append(frames)
+        
+        if len(valid_requests) < len(batch):
+            logger.warning(f'vectorizer has dropped {len(batch) - len(valid_requests)} expired requests')
+            self.metrics.inc('vectorizer_dropped_requests_total', len(batch) - len(valid_requests))
+        return valid_requests 
+
+    def encode(self, sentences:List[str]) -> np.ndarray:
+        if self.embedding_cache is None:
+            return self.encode_scheduler.encode(sentences)
+        
+        keys = [ self.embedding_cache.make_key('sentence', sent) for sent in sentences ]
+        embeddings = [ self.embedding_cache.get(key) for key in keys ]
+        
+        # shared sentences (inside the batch or already cached) are encoded only once 
+        map_key2missing_sentence = {}
+        for key, sent, embedding in zip(keys, sentences, embeddings):
+            if embedding is None:
+                map_key2missing_sentence[key] = sent 
+        
+        if len(map_key2missing_sentence) > 0:
+            missing_keys = list(map_key2missing_sentence.keys())
+            missing_embeddings = self.encode_scheduler.encode(list(map_key2missing_sentence.values()))
+            for key, embedding in zip(missing_keys, missing_embeddings):
+                self.embedding_cache.put(key, embedding)
+            map_key2embedding = dict(zip(missing_keys, missing_embeddings))
+            embeddings = [ embedding if embedding is not None else map_key2embedding[key] for key, embedding in zip(keys, embeddings) ]
+        
+        return np.stack(embeddings)
+
+    def is_long_text(self, text:str) -> bool:
+        # the only streaming switch : the document key and process_texts must take the same decision, 
+        # the estimate may differ from the real number of sentences but the cached weighting is always the applied one 
+        return estimate_nb_sentences(text) > self.streaming_threshold
+
+    def make_document_key(self, text:str, weighting:str, is_long:bool) -> bytes:
+        # a document embedding depends on the sentence splitter and on the weighting actually applied : 
+        # the long documents are streamed with the degree weighting whatever the requested one 
+        if is_long:
+            weighting = 'degree'
+        return self.embedding_cache.make_key(f'document:{self.sentence_splitter_name}:{weighting}', text)
+
+    def make_details(self, sentences:List[str], sentence_scores:np.ndarray, sentence_embeddings:np.ndarray, detail_options:Dict[str, Any]) -> Dict[str, Any]:
+        # summary : the top_k sentences by score | sentences : every sentence in document order 
+        details = {}
+        top_k = detail_options.get('top_k', 0)
+        if top_k > 0:
+            ranked_indices = np.argsort(-sentence_scores, kind='stable')[:top_k]
+            details['summary'] = [ {'index': int(idx), 'text': sentences[idx], 'score': float(sentence_scores[idx])} for idx in ranked_indices ]
+        if detail_options.get('return_sentences', False) or detail_options.get('return_sentence_embeddings', False):
+            details['sentences'] = [ {'index': idx, 'text': sentence, 'score': float(score)} for idx, (sentence, score) in enumerate(zip(sentences, sentence_scores)) ]
+        if detail_options.get('return_sentence_embeddings', False):
+            details['sentence_embeddings'] = sentence_embeddings
+        return details 
+
+    def process_long_text(self, text:str, weighting:str, detail_options:Optional[Dict[str, Any]]=None) -> Tuple[np.ndarray, Optional[Dict[str, Any]]]:
+        if weighting != 'degree':
+            logger.warning(f'{weighting} weighting needs the whole similarity matrix, the streaming mode uses the degree weighting')
+        
+        start = perf_counter()
+        sentences_iter = self.sentence_splitter.stream(text, valid_length=1)
+        details = None 
+        if detail_options is None:
+            embedding_chunks = map(self.encode, batchify(sentences_iter, self.streaming_chunk_size))
+            embedding = compute_streaming_textrank_embedding(embedding_chunks)
+        else:
+            # the sentences are ranked by their degree : the sentence embeddings are kept, the n x n matrix is still never built 
+            sentences = list(sentences_iter)
+            embedding_chunks = [ self.encode(chunk) for chunk in batchify(sentences, self.streaming_chunk_size) ]
+            embedding = compute_streaming_textrank_embedding(embedding_chunks)
+            if embedding is not None:
+                sentence_embeddings = np.concatenate(embedding_chunks)
+                details = self.make_details(sentences, compute_degree_scores(sentence_embeddings), sentence_embeddings, detail_options)
+        if embedding is None:  # can not split text to sentences 
+            embedding = self.encode([text])[0]
+            if detail_options is not None:
+                details = self.make_details([text], np.ones(1), embedding[None, :], detail_options)
+        duration = perf_counter() - start 
+        self.metrics.observe('vectorizer_stage_duration_seconds', duration, stage='stream')
+        logger.debug(f'vectorizer has streamed a document of {len(text)} characters in {duration * 1000:.1f}ms')
+        return embedding, details 
+
+    def process_texts(self, texts:List[str], weightings:List[str], detail_options:Optional[List[Optional[Dict[str, Any]]]]=None) -> Tuple[List[np.ndarray], List[Optional[Dict[str, Any]]]]:
+        # detail_options : per text, None or the sentence level outputs to return (top_k, return_sentences, return_sentence_embeddings) 
+        if len(texts) == 0:
+            return [], []
+        
+        detail_options = detail_options if detail_options is not None else [None] * len(texts)
+        embeddings = [None] * len(texts)
+        details = [None] * len(texts)
+        long_flags = [ self.is_long_text(text) for text in texts ]
+        if self.embedding_cache is not None:
+            document_keys = [ self.make_document_key(text, weighting, is_long) for text, weighting, is_long in zip(texts, weightings, long_flags) ]
+            # the cache holds only document embeddings : the texts asking for details are always recomputed 
+            embeddings = [ self.embedding_cache.get(key) if options is None else None for key, options in zip(document_keys, detail_options) ]
+        
+        pending_indices = [ idx for idx, embedding in enumerate(embeddings) if embedding is None ]
+        
+        # long documents are streamed one by one : their similarity matrix is never materialized 
+        long_indices = [ idx for idx in pending_indices if long_flags[idx] ]
+        for idx in long_indices:
+            embeddings[idx], details[idx] = self.process_long_text(texts[idx], weightings[idx], detail_options[idx])
+            if self.embedding_cache is not None:
+                self.embedding_cache.put(document_keys[idx], embeddings[idx])
+        
+        pending_indices = [ idx for idx in pending_indices if embeddings[idx] is None ]
+        if len(pending_indices) == 0:
+            return embeddings, details 
+        
+        pending_texts = [ texts[idx] for idx in pending_indices ]
+        with self.metrics.timer('vectorizer_stage_duration_seconds', stage='split'):
+            sentences_per_text = self.sentence_splitter.split_many(pending_texts, valid_length=1)
+        # can not split text to sentences => the whole text is encoded 
+        sentences_per_text = [ sentences if len(sentences) > 0 else [text] for text, sentences in zip(pending_texts, sentences_per_text) ]
+        for sentences in sentences_per_text:
+            self.metrics.observe('vectorizer_sentences_per_document', len(sentences))
+        
+        packed_sentences = list(it.chain(*sentences_per_text))
+        with self.metrics.timer('vectorizer_stage_duration_seconds', stage='encode'):
+            packed_embeddings = self.encode(packed_sentences)
+
+        offsets = np.cumsum([0] + [ len(sentences) for sentences in sentences_per_text ])
+        map_weighting2indices = {}
+        for idx in pending_indices:
+            if detail_options[idx] is None:
+                map_weighting2indices.setdefault(weightings[idx], []).append(idx)
+        map_idx2position = { idx: position for position, idx in enumerate(pending_indices) }
+        
+        timings = {}
+        # the same encode pass gives the document embedding, the ranking of the sentences and their embeddings 
+        for idx in pending_indices:
+            if detail_options[idx] is None:
+                continue 
+            position = map_idx2position[idx]
+            sentence_embeddings = packed_embeddings[offsets[position]:offsets[position + 1]]
+            embeddings[idx], sentence_scores = compute_textrank_details(sentence_embeddings, weighting=weightings[idx], timings=timings)
+            details[idx] = self.make_details(sentences_per_text[position], sentence_scores, sentence_embeddings, detail_options[idx])
+            if self.embedding_cache is not None:
+                self.embedding_cache.put(document_keys[idx], embeddings[idx])
+
+        # documents sharing the same weighting are scored together (one batched pagerank for the whole group) 
+        for weighting, indices in map_weighting2indices.items():
+            positions = [ map_idx2position[idx] for idx in indices ]
+            embeddings_per_document = [ packed_embeddings[offsets[pos]:offsets[pos + 1]] for pos in positions ]
+            document_embeddings = compute_textrank_embeddings(embeddings_per_document, weighting=weighting, timings=timings)
+            for idx, document_embedding in zip(indices, document_embeddings):
+                embeddings[idx] = document_embedding 
+                if self.embedding_cache is not None:
+                    self.embedding_cache.put(document_keys[idx], document_embedding)
+        for stage, duration in timings.items():
+            self.metrics.observe('vectorizer_stage_duration_seconds', duration, stage=stage)
+        return embeddings, details 
+
+    def process_batch(self, encoded_texts:List[bytes], weightings:List[str], detail_options:List[Optional[Dict[str, Any]]]) -> Tuple[List[Optional[np.ndarray]], List[Optional[Dict[str, Any]]]]:
+        texts = []
+        with self.metrics.timer('vectorizer_stage_duration_seconds', stage='decode'):
+            for encoded_text in encoded_texts:
+                try:
+                    texts.append(encoded_text.decode('utf-8'))
+                except Exception as e:
+                    logger.error(e)
+                    texts.append(None)
+        self.metrics.inc('vectorizer_texts_total', len(texts))
+        
+        valid_indices = [ idx for idx, text in enumerate(texts) if text is not None ]
+        embeddings = [None] * len(texts)
+        details = [None] * len(texts)
+        try:
+            valid_embeddings, valid_details = self.process_texts(
+                [ texts[idx] for idx in valid_indices ], 
+                [ weightings[idx] for idx in valid_indices ], 
+                [ detail_options[idx] for idx in valid_indices ]
+            )
+            for idx, embedding, item_details in zip(valid_indices, valid_embeddings, valid_details):
+                embeddings[idx] = embedding 
+                details[idx] = item_details
+        except Exception as e:
+            logger.error(e)
+            # one faulty text should not fail the others => fallback to text by text 
+            for idx in valid_indices:
+                try:
+                    (embeddings[idx],), (details[idx],) = self.process_texts([texts[idx]], [weightings[idx]], [detail_options[idx]])
+                except Exception as e:
+                    logger.error(e)
+        return embeddings, details 
+
+    def parse_headers(self, batch:List[List[bytes]]) -> List[Tuple[List[bytes], Dict[str, Any]]]:
+        # a request without a readable header can not be answered : its slot goes back to the broker 
+        requests = []
+        for frames in batch:
+            try:
+                header = json.loads(frames[2])
+                if not isinstance(header.get('correlation_id', None), str):
+                    raise ValueError(f'request header without correlation_id : {header}')
+                requests.append((frames, header))
+            except Exception as e:
+                logger.error(e)
+                self.dealer_socket.send_multipart([b'DROP', b''])
+        return requests 
+
+    def send_reply(self, client_address:bytes, header:Dict[str, Any], embeddings:List[Optional[np.ndarray]], details:List[Optional[Dict[str, Any]]]):
+        reply_header = {'correlation_id': header['correlation_id']}
+        precision = header.get('precision', 'float32')
+        reply_frames = None 
+        if self.shm_writer is not None and header.get('details', None) is None:
+            # None when the reply does not fit into a slot or when the server holds all of them, details always travel inline 
+            reply_frames = self.shm_writer.encode_reply(reply_header, embeddings, precision)
+        transport = 'shm' if reply_frames is not None else 'inline'
+        if reply_frames is None:
+            reply_frames = encode_reply(header=reply_header, embeddings=embeddings, precision=precision, details=details)
+        self.metrics.inc('vectorizer_replies_total', transport=transport)
+        self.dealer_socket.send_multipart([b'REPLY', header['correlation_id'].encode(), client_address, b''] + reply_frames, copy=False)
+
+    def send_failure(self, client_address:bytes, header:Dict[str, Any], nb_texts:int):
+        # every text of the request has failed : the client gets its error now and the broker gets its slot back 
+        try:
+            reply_frames = encode_reply(header={'correlation_id': header['correlation_id']}, embeddings=[None] * nb_texts)
+            self.dealer_socket.send_multipart([b'REPLY', header['correlation_id'].encode(), client_address, b''] + reply_frames)
+        except Exception as e:
+            logger.error(e)
+            self.dealer_socket.send_multipart([b'DROP', header['correlation_id'].encode()])
 
     def start_loop(self):
-        if self.zeromq_initialized == 0:
+        if not self.is_registered:
             return 0 
 
         logger.debug('vectorizer starts the event loop')        
+        last_flush = perf_counter()
+        last_push = 0.0 
         keep_loop = True 
         while keep_loop:
             try:
-                polled_status = self.router_socket.poll(100)  # 100ms 
-                if polled_status == zmq.POLLIN:
-                    client_address, _, encoded_text = self.router_socket.recv_multipart()
+                # with an idle timeout, the vectorizer wakes up every second to check its idle time 
+                batch = self.drop_expired_requests(self.collect_batch(timeout=1000 if self.idle_timeout is not None else None))
+                if len(batch) > 0:
+                    if not self.models_loaded:
+                        self.reload_models()
+                    start = perf_counter()
+                    # a request is [client_address, delimiter, header, text_0, ..., text_k] 
+                    # each request gets a REPLY (or a DROP) whatever happens to the others : the broker always gets its slots back 
+                    requests = self.parse_headers(batch)
+                    encoded_texts = list(it.chain(*[ frames[3:] for frames, _ in requests ]))
+                    weightings = list(it.chain(*[ [header.get('weighting', 'degree')] * len(frames[3:]) for frames, header in requests ]))
+                    detail_options = list(it.chain(*[ [header.get('details', None)] * len(frames[3:]) for frames, header in requests ]))
                     try:
-                        text = encoded_text.decode('utf-8')
-                        sentences = to_sentences(text, self.language_model, valid_length=1)    
-                        if len(sentences) == 0:  # can not split text to sentences 
-                            embedding = self.transformer_model.encode(text, device=self.device)
-                        else: 
-                            embeddings = self.transformer_model.encode(sentences, device=self.device)
-                            if len(sentences) == 1:
-                                embedding = embeddings[0]
-                            else:
-                                nb_nodes = len(sentences)
-                                adjacency_matrix = compute_pairwise_matrix(embeddings)
-                                scores = np.sum(adjacency_matrix, axis=1) / nb_nodes 
-                                embedding = np.mean(embeddings * scores[:, None], axis=0)
+                        embeddings, details = self.process_batch(encoded_texts, weightings, detail_options)
                     except Exception as e:
                         logger.error(e)
-                        embedding = None 
-                    self.router_socket.send_multipart([client_address, b''], flags=zmq.SNDMORE)
-                    self.router_socket.send_pyobj(embedding)
+                        embeddings, details = [None] * len(encoded_texts), [None] * len(encoded_texts)
+                    offset = 0 
+                    with self.metrics.timer('vectorizer_stage_duration_seconds', stage='reply'):
+                        for (client_address, _, _, *request_texts), header in requests:
+                            request_embeddings = embeddings[offset:offset + len(request_texts)]
+                            request_details = details[offset:offset + len(request_texts)]
+                            offset += len(request_texts)
+                            try:
+                                self.send_reply(client_address, header, request_embeddings, request_details)
+                            except Exception as e:
+                                logger.error(e)
+                                self.send_failure(client_address, header, len(request_texts))
+                    duration = perf_counter() - start 
+                    self.last_activity = perf_counter()
+                    self.metrics.observe('vectorizer_stage_duration_seconds', duration, stage='batch')
+                    self.metrics.observe('vectorizer_batch_requests', len(batch))
+                    logger.debug(f'vectorizer has processed a batch of {len(batch):03d} requests ({len(encoded_texts):03d} texts) in {duration * 1000:.1f}ms')
+                    if self.encode_scheduler is not None:
+                        logger.debug(f'encode scheduler : {self.encode_scheduler.stats()}')
+                    if self.embedding_cache is not None:
+                        logger.debug(f'embedding cache : {self.embedding_cache.stats()}')
+                
+                if self.idle_timeout is not None and self.models_loaded and perf_counter() - self.last_activity > self.idle_timeout:
+                    self.unload_models()
+
+                if perf_counter() - last_push > self.metrics_push_interval:
+                    self.push_metrics()
+                    last_push = perf_counter()
+
+                if self.embedding_cache is not None and perf_counter() - last_flush > 60:
+                    self.embedding_cache.flush()
+                    last_flush = perf_counter()
             except KeyboardInterrupt:
                 keep_loop = False 
                 logger.warning('vectorizer get the ctl+c signal')
@@ -67,47 +405,123 @@ class ZMQVectorizer:
         # end while loop ...!
 
         logger.debug('vectorizer quits the event loop')
-        self.publisher_socket.send(b'EXIT_LOOP', flags=zmq.SNDMORE)
-        self.publisher_socket.send(b'')
-        sleep(0.1)  # wait 10ms 
 
-    def __enter__(self):
+    def load_models(self):
+        logger.debug(f'vectorizer will load the {self.sentence_splitter_name} sentence splitter')
+        self.sentence_splitter = SentenceSplitter(
+            backend=self.sentence_splitter_name, 
+            language_model_name=self.language_model_name, 
+            n_process=self.spacy_n_process, 
+            batch_size=self.spacy_batch_size,
+            snapshot_path=find_snapshot(self.cache_folder, f'spacy-{self.sentence_splitter_name}', self.language_model_name)
+        )
+        logger.debug('vectotorize is loading the transformers model')
+        logger.debug(f'number of detected gpu card : {th.cuda.device_count()}')
+        if self.num_threads is not None:
+            th.set_num_threads(self.num_threads)
+            logger.debug(f'vectorizer will use {self.num_threads} torch threads')
+        self.device = th.device('cpu' if not th.cuda.is_available() else f'cuda:{self.gpu_index}')
+        self.encoder = load_encoder(
+            backend=self.encoder_backend, 
+            model_name=self.transformer_model_name, 
+            cache_folder=self.cache_folder, 
+            device=self.device, 
+            num_threads=self.onnx_num_threads,
+            mock_token_latency=self.mock_token_latency
+        )
+        self.encode_scheduler = EncodeScheduler(
+            self.encoder, 
+            token_budget=self.token_budget, 
+            max_batch_size=self.max_encode_batch_size, 
+            on_batch=lambda nb_sentences: self.metrics.observe('vectorizer_encode_batch_size', nb_sentences)
+        )
+        self.models_loaded = True 
+        self.metrics.set('vectorizer_models_loaded', 1)
+        self.metrics.inc('vectorizer_model_loads_total')
+        logger.success('vectorizer has finished to load the transformers and the language model')
+        logger.success(f'transformer runs on the {self.encoder_backend} backend, device : {self.device}')
+
+    def unload_models(self):
+        # the vectorizer stays registered with the broker : the next request reloads the models 
+        self.encode_scheduler = None 
+        self.encoder = None 
+        self.sentence_splitter = None 
+        gc.collect()
+        if th.cuda.is_available():
+            th.cuda.empty_cache()
+        self.models_loaded = False 
+        self.metrics.set('vectorizer_models_loaded', 0)
+        logger.info(f'vectorizer has unloaded its models after {self.idle_timeout}s without request')
+
+    def reload_models(self):
+        start = perf_counter()
         try:
-            logger.debug('vectorizer will load the language model')
-            self.language_model = load_language_model(self.language_model_name)
-            logger.debug('vectotorize is loading the transformers model')
-            logger.debug(f'number of detected gpu card : {th.cuda.device_count()}')
-            self.device = th.device('cpu' if not th.cuda.is_available() else f'cuda:{self.gpu_index}')
-            self.transformer_model = load_sentence_transformer(self.transformer_model_name, self.cache_folder, device=self.device)
-            logger.success('vectorizer has finished to load the transformers and the language model')
-            logger.success(f'transformer is on the device : {self.device}')
+            self.load_models()
+            self.warmup()  # the first request after an idle period must not pay the cold start again 
+            logger.info(f'vectorizer has reloaded and warmed up its models in {(perf_counter() - start) * 1000:.1f}ms')
         except Exception as e:
-            logger.error(e)
-        else:
-            try:
-                self.ctx = zmq.Context()
-                self.router_socket:zmq.Socket = self.ctx.socket(zmq.ROUTER)
-                self.router_socket.bind(self.router_address)
+            logger.error(e)  # the texts of the batch fail, the next request tries again 
 
-                self.publisher_socket:zmq.Socket = self.ctx.socket(zmq.PUB)
-                self.publisher_socket.bind(self.publisher_address)
+    def warmup(self):
+        # the first calls pay the lazy initialization of the kernels : dummy encodes at a few sequence lengths 
+        # they run on the encoder itself, neither the cache nor the metrics see them 
+        if len(self.warmup_lengths) == 0:
+            return 
+        start = perf_counter()
+        for nb_tokens in self.warmup_lengths:
+            nb_sentences = min(max(self.token_budget // nb_tokens, 1), self.max_encode_batch_size)
+            self.encoder.encode([ ' '.join(['mot'] * nb_tokens) ] * nb_sentences, batch_size=nb_sentences)
+        
+        sentences = self.sentence_splitter.split('Première phrase du document. Deuxième phrase du document.')
+        compute_textrank_embeddings([self.encoder.encode(sentences)], weighting='pagerank')
+        logger.success(f'vectorizer has warmed up in {(perf_counter() - start) * 1000:.1f}ms (sequence lengths : {self.warmup_lengths})')
 
-                self.zeromq_initialized = 1 
-                logger.success('vectorizer has initialized its zeromq ressources')
-                self.workers_barrier.wait()  # wait the server ...! 
-            except Exception as e:
-                logger.error(e)
+    def __enter__(self):
+        try:
+            self.ctx = zmq.Context()
+            self.dealer_socket:zmq.Socket = self.ctx.socket(zmq.DEALER)
+            self.dealer_socket.connect(self.backend_address)
 
+            self.zeromq_initialized = 1 
+            logger.success('vectorizer has initialized its zeromq ressources')
+            self.workers_barrier.wait()  # wait the server, the broker and the other vectorizers ...! 
+        except Exception as e:
+            logger.error(e)
+            self.workers_barrier.abort()  # the other workers must not wait for this one 
+            return self 
+        
+        # the server is already up (ALIVE) : the broker keeps the requests until this vectorizer reports READY 
+        try:
+            self.load_models()
+            self.warmup()
+            if self.transport == 'shm':
+                self.shm_writer = SharedEmbeddingWriter(self.shm_slots, self.shm_slot_size * 1024)
+                logger.debug(f'vectorizer replies through the shared memory segment {self.shm_writer.segment.name}')
+            self.dealer_socket.send_multipart([b'READY', str(self.max_batch_size).encode()])
+            self.is_registered = True 
+        except Exception as e:
+            logger.error(e)
+        
         return self 
     
     def __exit__(self, exc, val, traceback):
+        if self.embedding_cache is not None:
+            self.embedding_cache.flush()
+            logger.debug(f'embedding cache : {self.embedding_cache.stats()}')
         if self.zeromq_initialized == 1:
-            self.publisher_socket.close(linger=0)
-            self.router_socket.close(linger=0)
+            try:
+                # the broker publishes EXIT_LOOP when the last vectorizer leaves 
+                if self.is_registered:
+                    self.dealer_socket.send(b'EXIT', flags=zmq.NOBLOCK)
+            except zmq.Again:
+                logger.warning('vectorizer can not notify the broker : it is already down')
+            self.dealer_socket.close(linger=100)
             self.ctx.term()
             logger.success('vectorizer has reeased all zeromq ressources')
+        if self.shm_writer is not None:
+            self.shm_writer.close()  # the server keeps its mapping until it exits 
         logger.debug('vectorizer shutdown...!')
 
-def start_vectorizer(transformer_model_name:str, cache_folder:str, language_model_name:str, router_address:str, publisher_address:str, workers_barrier:mp.Barrier, gpu_index:int):
-    with ZMQVectorizer(router_address=router_address, publisher_address=publisher_address, transformer_model_name=transformer_model_name, language_model_name=language_model_name, cache_folder=cache_folder, workers_barrier=workers_barrier, gpu_index=gpu_index) as agent:
+def start_vectorizer(transformer_model_name:str, cache_folder:str, language_model_name:str, backend_address:str, workers_barrier:mp.Barrier, gpu_index:int, num_threads:int, max_batch_size:int, max_batch_wait:int, cache_size:int, cache_path:Optional[str], cache_disk_capacity:int, streaming_threshold:int, streaming_chunk_size:int, sentence_splitter:str, spacy_n_process:int, spacy_batch_size:int, encoder_backend:str, onnx_num_threads:Optional[int], token_budget:int, max_encode_batch_size:int, mock_token_latency:float, warmup_lengths:List[int], transport:str, shm_slots:int, shm_slot_size:int, idle_timeout:Optional[int]):
+    with ZMQVectorizer(backend_address=backend_address, transformer_model_name=transformer_model_name, language_model_name=language_model_name, cache_folder=cache_folder, workers_barrier=workers_barrier, gpu_index=gpu_index, num_threads=num_threads, max_batch_size=max_batch_size, max_batch_wait=max_batch_wait, cache_size=cache_size, cache_path=cache_path, cache_disk_capacity=cache_disk_capacity, streaming_threshold=streaming_threshold, streaming_chunk_size=streaming_chunk_size, sentence_splitter=sentence_splitter, spacy_n_process=spacy_n_process, spacy_batch_size=spacy_batch_size, encoder_backend=encoder_backend, onnx_num_threads=onnx_num_threads, token_budget=token_budget, max_encode_batch_size=max_encode_batch_size, mock_token_latency=mock_token_latency, warmup_lengths=warmup_lengths, transport=transport, shm_slots=shm_slots, shm_slot_size=shm_slot_size, idle_timeout=idle_timeout) as agent:
         agent.start_loop()